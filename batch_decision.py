@@ -0,0 +1,435 @@
+# Vectorized decision step for controller parameter sweeps
+#
+# decision_step is a scalar if-chain over one mutable Rover, so trying other
+# values of stop_forward, go_forward, throttle_set or stopped_time_limit means
+# running the whole loop again for every setting. Perception doesn't depend on
+# the decisions (replay takes the pose and speed from the recording), so each
+# recorded frame is reduced once to the handful of numbers decision_step
+# actually reads (frame_features), and DecisionBatch keeps the decision state
+# of any number of controller variants as arrays, one element per variant.
+# decision_kernel is decision_step on all of them at once: every branch of the
+# if-chain becomes a mask of the variants taking it, and a variant gives the
+# same throttle / brake / steer / mode as decision_step would for the same
+# parameters, quirks included.
+#
+# Example: $ python batch_decision.py ../recordings/run1 --stop_forward 200 300 500 \
+#              --go_forward 500 800 --throttle_set .1 .2 .3
+import argparse
+import contextlib
+import itertools
+import os
+import sys
+
+import numpy as np
+
+from perception import perception_step
+from rover_state import RoverState
+from quality import QUALITY_HALF_RES
+from event_log import log
+
+# Mode codes of DecisionBatch.mode
+MODE_FORWARD = 0
+MODE_PICKLE = 1
+MODE_AZIMUTH = 2
+MODE_SAMPLE = 3
+MODE_PLAN = 4
+mode_names = ('forward', 'pickle', 'azimuth', 'sample', 'plan')
+mode_codes = dict((name, code) for code, name in enumerate(mode_names))
+
+# What decision_step reads from Rover for one frame, reduced from the
+# perception outputs. None is stored as nan, the means are computed exactly as
+# decision_step computes them.
+feature_dtype = np.dtype([('vel', np.float64), ('yaw', np.float64), ('total_time', np.float64),
+                          ('near_sample', np.int32), ('picking_up', np.int32),
+                          ('quality_level', np.int32),
+                          ('nav_none', bool), ('nav_count', np.int64), ('nav_mean', np.float64),
+                          ('wal_count', np.int64), ('wal_mean', np.float64), ('wal_length', np.float64),
+                          ('col_count', np.int64), ('col_mean', np.float64),
+                          ('tgt_count', np.int64), ('tgt_any', bool), ('tgt_mean', np.float64),
+                          ('rock_angle', np.float64),
+                          ('frontier_heading', np.float64), ('frontier_count', np.int64),
+                          ('plan_heading', np.float64), ('plan_arrived', bool)])
+
+# Mean of angles in degrees, the same operations in the same order as
+# decision_step so the result matches to the bit
+def _mean_deg(angles):
+    return np.mean(angles * 180/np.pi) if angles.size else np.nan
+
+# Define a function to reduce the Rover after perception_step to the decision
+# inputs of one frame
+def frame_features(Rover):
+    f = np.zeros((), dtype=feature_dtype)
+    f['vel'], f['yaw'] = Rover.vel, Rover.yaw
+    f['total_time'] = np.nan if Rover.total_time is None else Rover.total_time
+    f['near_sample'], f['picking_up'] = Rover.near_sample, Rover.picking_up
+    f['quality_level'] = Rover.quality_level
+    f['nav_none'] = Rover.nav_angles is None
+    if Rover.nav_angles is not None:
+        f['nav_count'] = Rover.nav_angles.size
+        f['nav_mean'] = _mean_deg(Rover.nav_angles)
+    if Rover.wal_angles is not None:
+        f['wal_count'] = Rover.wal_angles.size
+        f['wal_mean'] = _mean_deg(Rover.wal_angles)
+        f['wal_length'] = np.mean(Rover.wal_dists) if Rover.wal_dists.size else np.nan
+    if Rover.col_angles is not None:
+        f['col_count'] = Rover.col_angles.size
+        f['col_mean'] = np.mean(Rover.col_angles) * 180./np.pi if Rover.col_angles.size else np.nan
+    if Rover.tgt_angles is not None:
+        f['tgt_count'] = Rover.tgt_angles.size
+        f['tgt_any'] = Rover.tgt_angles.any()
+        f['tgt_mean'] = _mean_deg(Rover.tgt_angles)
+    f['rock_angle'] = np.nan if Rover.rock_target is None else Rover.rock_target[0]
+    f['frontier_heading'] = np.nan
+    if Rover.frontier_heading is not None:
+        f['frontier_heading'] = Rover.frontier_heading
+        if Rover.nav_angles is not None:
+            frontier = Rover.frontier_heading * np.pi/180
+            f['frontier_count'] = np.count_nonzero(np.abs(Rover.nav_angles - frontier) < 10 * np.pi/180)
+    f['plan_heading'] = np.nan if Rover.plan_heading is None else Rover.plan_heading
+    f['plan_arrived'] = Rover.plan_goal == 'home' and Rover.route is not None and \
+                        Rover.plan_dist < Rover.route.arrive
+    return f
+
+# Decision state and parameters of n controller variants, one array element
+# per variant, starting from the state of Rover (a fresh RoverState if None)
+class DecisionBatch():
+    # Rover fields carried as per variant arrays (None is nan)
+    state_fields = ('throttle', 'brake', 'steer', 'stopped_time', 'stopped_angle', 'tgt_angle',
+                    'bst_nav', 'bst_angle', 'max_vel', 'brake_set', 'plan_turn', 'plan_turn_time')
+    flag_fields = ('sample_detected', 'send_pickup', 'picked_up')
+    # Tunable parameters
+    param_fields = ('stop_forward', 'go_forward', 'throttle_set', 'stopped_time_limit',
+                    'degraded_max_vel', 'frontier_weight', 'frontier_min_nav', 'plan_max_vel',
+                    'plan_turn_enter', 'plan_turn_exit', 'plan_turn_limit')
+
+    def __init__(self, n, Rover=None):
+        if Rover is None:
+            Rover = RoverState()
+        self.n = n
+        self.mode = np.full(n, mode_codes[Rover.mode], dtype=np.int8)
+        for name in self.state_fields + self.param_fields:
+            value = getattr(Rover, name)
+            setattr(self, name, np.full(n, np.nan if value is None else value, dtype=np.float64))
+        for name in self.flag_fields:
+            setattr(self, name, np.full(n, bool(getattr(Rover, name))))
+
+    # Set a parameter (or state field) for all variants, values: scalar or n values
+    def set(self, name, values):
+        getattr(self, name)[:] = values
+
+    # Write the state of variant i back into a Rover
+    def to_rover(self, i, Rover):
+        Rover.mode = mode_names[self.mode[i]]
+        for name in self.state_fields + self.param_fields:
+            value = float(getattr(self, name)[i])
+            setattr(Rover, name, None if np.isnan(value) else value)
+        for name in self.flag_fields:
+            setattr(Rover, name, bool(getattr(self, name)[i]))
+        return Rover
+
+# pickle() (decision.py) for the variants in mask
+def _pickle(b, mask, f, time_limit):
+    slow = mask & (f['vel'] < 0.1)
+    # 'if Rover.stopped_time:', a stop that started at time 0 isn't tracked
+    tracking = slow & ~np.isnan(b.stopped_time) & (b.stopped_time != 0)
+    fire = tracking & (f['total_time'] - b.stopped_time >= time_limit)
+    b.mode[fire] = MODE_PICKLE
+    b.stopped_time[fire] = np.nan
+    b.stopped_time[slow & ~tracking] = f['total_time']
+    b.stopped_time[mask & ~slow] = np.nan
+
+# collision_adj() (decision.py) on the steering of the variants in mask
+def _collision_adj(b, mask, f):
+    if f['col_count'] > 40:
+        col_angle_mean = f['col_mean']
+        if abs(col_angle_mean) < 1.0: col_angle_mean = 15.
+        b.steer[mask] = np.clip(b.steer[mask] - col_angle_mean * f['col_count']/200, -15., 15.)
+
+# Define a function to run decision_step on every variant of a DecisionBatch
+# for one frame of features (see frame_features)
+def decision_kernel(b, f):
+    entry = b.mode.copy()
+    vel, yaw = float(f['vel']), float(f['yaw'])
+
+    # PICKLE
+    act = entry == MODE_PICKLE
+    if f['nav_none']:
+        b.steer[act] = 15.
+        b.throttle[act] = 0.
+        act[:] = False
+    ret = act & ((vel > abs(.1)) | (b.throttle > 0))
+    b.throttle[ret] = 0
+    b.brake[ret] = b.brake_set[ret]
+    act &= ~ret
+    ret = act & (b.brake != 0)
+    b.brake[ret] = 0
+    act &= ~ret
+    ret = act & (np.isnan(b.stopped_angle) | (b.stopped_angle == 0))
+    b.stopped_angle[ret] = yaw
+    b.tgt_angle[ret] = (yaw + 45) % 360
+    b.bst_nav[ret] = b.go_forward[ret]
+    b.bst_angle[ret] = b.tgt_angle[ret]
+    act &= ~ret
+    b.steer[act] = 15
+    better = act & (f['nav_count'] > b.bst_nav)
+    b.bst_nav[better] = f['nav_count']
+    b.bst_angle[better] = yaw
+    turn = act & (np.abs(b.tgt_angle - yaw) < 5)
+    b.tgt_angle[turn] = b.bst_angle[turn]
+    delta = b.tgt_angle - b.stopped_angle
+    nudge = turn & ((delta < -352) | ((delta < 10) & (delta > 0)))
+    b.tgt_angle[nudge] = (b.tgt_angle[nudge] + 20) % 360
+    b.bst_nav[turn] = 0
+    b.stopped_angle[turn] = np.nan
+    b.mode[turn] = MODE_AZIMUTH
+
+    # SAMPLE
+    act = entry == MODE_SAMPLE
+    _pickle(b, act, f, 5)
+    act &= b.mode != MODE_PICKLE
+    if not np.isnan(f['rock_angle']):
+        b.steer[act] = f['rock_angle']
+    elif f['tgt_count']:
+        b.steer[act] = f['tgt_mean']
+    first = act & ~b.sample_detected
+    if abs(vel) >= .1:
+        b.brake_set[first] = 10
+        b.brake[first] = b.brake_set[first]
+        act &= ~first
+    else:
+        b.sample_detected[first] = True
+    b.brake[act] = 0
+    if vel < .5:
+        b.throttle[act] = .1
+    if f['near_sample']:
+        if abs(vel) >= .1:
+            b.throttle[act] = 0
+            b.brake[act] = b.brake_set[act]
+            act[:] = False
+        b.send_pickup[act] = True
+        if f['picking_up']:
+            b.sample_detected[act] = False
+            b.send_pickup[act] = False
+            b.picked_up[act] = True
+            act[:] = False
+    done = act & b.picked_up
+    b.mode[done] = MODE_PICKLE
+    b.picked_up[done] = False
+
+    # AZIMUTH
+    act = entry == MODE_AZIMUTH
+    ret = act & np.isnan(b.tgt_angle)
+    b.mode[ret] = MODE_FORWARD
+    act &= ~ret
+    if abs(vel) >= .1:
+        b.throttle[act] = 0
+        b.brake[act] = b.brake_set[act]
+    else:
+        b.brake[act] = 0
+        b.steer[act] = -15
+        b.mode[act & (np.abs(yaw - b.tgt_angle) < 3)] = MODE_FORWARD
+
+    # PLAN
+    act = entry == MODE_PLAN
+    plan_heading = float(f['plan_heading'])
+    if np.isnan(plan_heading):
+        b.mode[act] = MODE_FORWARD
+    elif f['plan_arrived']:
+        b.throttle[act] = 0
+        b.brake[act] = b.brake_set[act]
+        b.steer[act] = 0
+    else:
+        turning = ~np.isnan(b.plan_turn)
+        enter = act & ~turning & (abs(plan_heading) > b.plan_turn_enter)
+        b.plan_turn[enter] = 1 if plan_heading > 0 else -1
+        b.plan_turn_time[enter] = f['total_time']
+        b.plan_turn[act & turning & (abs(plan_heading) < b.plan_turn_exit)] = np.nan
+        turning = act & ~np.isnan(b.plan_turn)
+        # a stall gives up on the goal in decision_step, the features were
+        # reduced with the planner of the recording so that isn't replayed
+        _pickle(b, act & ~turning, f, b.stopped_time_limit)
+        b.stopped_time[turning] = np.nan
+        act &= b.mode != MODE_PICKLE
+        if f['tgt_any']:
+            b.mode[act] = MODE_SAMPLE
+        else:
+            late = turning & (f['total_time'] - b.plan_turn_time > b.plan_turn_limit)
+            b.plan_turn[late] = np.nan
+            b.mode[late] = MODE_FORWARD
+            turn = turning & ~late
+            if abs(vel) >= .1:
+                b.throttle[turn] = 0
+                b.brake[turn] = b.brake_set[turn]
+            else:
+                b.brake[turn] = 0
+                b.throttle[turn] = 0
+                b.steer[turn] = 15 * b.plan_turn[turn]
+            act &= ~turning
+            b.brake[act] = 0
+            b.throttle[act] = np.where(vel < b.plan_max_vel, b.throttle_set, 0)[act]
+            b.steer[act] = np.clip(plan_heading, -15, 15)
+            _collision_adj(b, act, f)
+
+    # FORWARD
+    act = entry == MODE_FORWARD
+    if f['nav_none']:
+        b.mode[act] = MODE_PICKLE
+        if f['near_sample'] and vel == 0 and not f['picking_up']:
+            b.send_pickup[act] = True
+        return b
+    _pickle(b, act, f, b.stopped_time_limit)
+    if not np.isnan(plan_heading):
+        ret = act & (b.mode == MODE_FORWARD)
+        b.mode[ret] = MODE_PLAN
+        b.plan_turn[ret] = np.nan
+        act &= ~ret
+    nav_count = f['nav_count']
+    go = act & (nav_count >= b.stop_forward)
+    # Step 1: speed
+    wal_length = f['wal_length']
+    max_vel = np.full(b.n, 1.0)
+    if wal_length >= 20:
+        max_vel[:] = np.clip(wal_length/20, 0,3.0)
+    if f['quality_level'] >= QUALITY_HALF_RES:
+        max_vel = np.minimum(max_vel, b.degraded_max_vel)
+    b.max_vel[go] = max_vel[go]
+    b.throttle[go] = np.where(vel < max_vel, b.throttle_set, 0)[go]
+    brake = go & (vel > max_vel) & (vel > 1.0)
+    b.throttle[brake] = 0
+    b.brake[brake] = .03
+    b.brake[go & ~brake] = 0
+    # Step 2: steering, the same for every variant up to the frontier pull
+    if f['wal_count']:
+        wal_angle_mean = np.clip(f['wal_mean'] + 10,-15,15)
+        p_n = np.clip(nav_count/12000.,.1,.9)
+        if wal_angle_mean < -35.: p_n = .8
+    else:
+        wal_angle_mean = 0
+        p_n = 1.
+    if f['col_count']:
+        p_n = np.clip(nav_count/40.,0.1,.9)
+    nav_angle_mean = np.clip(f['nav_mean'],-15,15)
+    steer = np.full(b.n, nav_angle_mean * p_n  + (wal_angle_mean) * (1 - p_n))
+    frontier_heading = float(f['frontier_heading'])
+    if not np.isnan(frontier_heading):
+        pull = (b.frontier_weight > 0) & (f['frontier_count'] >= b.frontier_min_nav)
+        steer[pull] = steer[pull] * (1 - b.frontier_weight[pull]) + \
+                      np.clip(frontier_heading, -15, 15) * b.frontier_weight[pull]
+    b.steer[go] = (b.steer[go] + np.clip(steer[go],-15,15))/2
+    # Step 3: samples
+    if f['tgt_any']:
+        b.mode[go] = MODE_SAMPLE
+    else:
+        _collision_adj(b, go, f)
+    stop = act & ~go & (nav_count < b.stop_forward)
+    b.throttle[stop] = 0
+    b.brake[stop] = b.brake_set[stop]
+    b.steer[stop] = 0
+    b.mode[stop] = MODE_PICKLE
+    b.stopped_time[stop] = np.nan
+    return b
+
+# Define a function to reduce the frames [start, stop) of a recorded run (see
+# replay.load_run) to decision features, running perception_step the way
+# replay_batch does
+def run_features(run, start=0, stop=None, quiet=True):
+    from replay import run_frame
+    if stop is None:
+        stop = run['n_frames']
+    Rover = RoverState()
+    Rover.start_time = run['time'][start]
+    features = np.zeros(stop - start, dtype=feature_dtype)
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull if quiet else sys.stdout), \
+         (log.quiet() if quiet else contextlib.ExitStack()):
+        for i in range(start, stop):
+            Rover.img = run_frame(run, i)
+            Rover.total_time = run['time'][i] - run['time'][start]
+            Rover.vel = run['vel'][i]
+            Rover.pos = (run['x'][i], run['y'][i])
+            Rover.yaw = run['yaw'][i]
+            Rover.pitch = run['pitch'][i]
+            Rover.roll = run['roll'][i]
+            Rover = perception_step(Rover)
+            features[i - start] = frame_features(Rover)
+    return features
+
+# Define a function to run a DecisionBatch through a sequence of frame features
+# record:   also return the per-frame (frames, n) throttle, brake, steer and mode
+# Returns per variant totals: frames spent in each mode (n, modes), mean
+# throttle and pickup commands, plus the per-frame arrays if record
+def run_batch(features, b, record=False):
+    mode_frames = np.zeros((b.n, len(mode_names)), dtype=np.int64)
+    throttle = np.zeros(b.n)
+    pickups = np.zeros(b.n, dtype=np.int64)
+    frames = {}
+    if record:
+        frames = dict((name, np.zeros((len(features), b.n), dtype=dtype)) for name, dtype in
+                      (('throttle', np.float32), ('brake', np.float32), ('steer', np.float32),
+                       ('mode', np.int8)))
+    rows = np.arange(b.n)
+    for i, f in enumerate(features):
+        sent = b.send_pickup.copy()
+        decision_kernel(b, f)
+        mode_frames[rows, b.mode] += 1
+        throttle += b.throttle
+        pickups += b.send_pickup & ~sent
+        for name in frames:
+            frames[name][i] = getattr(b, name)
+    summary = {'mode_frames': mode_frames, 'throttle': throttle / max(len(features), 1),
+               'pickups': pickups}
+    summary.update(frames)
+    return summary
+
+if __name__ == '__main__':
+    from replay import load_run
+    parser = argparse.ArgumentParser(description='Sweep decision parameters over a recorded run')
+    parser.add_argument(
+        'run_folder',
+        type=str,
+        help='Recorded run folder (see replay.py).'
+    )
+    parser.add_argument(
+        '--fps',
+        type=float,
+        default=25.,
+        help='Recording frame rate.'
+    )
+    for name, help_text in (('stop_forward', 'Navigable pixel counts to stop at.'),
+                            ('go_forward', 'Navigable pixel counts to go forward again at.'),
+                            ('throttle_set', 'Throttle settings.'),
+                            ('stopped_time_limit', 'Seconds stopped before pickle mode.')):
+        parser.add_argument(
+            '--' + name,
+            type=float,
+            nargs='+',
+            default=None,
+            help=help_text + ' Default: the RoverState value.'
+        )
+    parser.add_argument(
+        '--top',
+        type=int,
+        default=10,
+        help='Number of variants to list.'
+    )
+    args = parser.parse_args()
+
+    run = load_run(args.run_folder, args.fps)
+    features = run_features(run)
+    defaults = RoverState()
+    names = ('stop_forward', 'go_forward', 'throttle_set', 'stopped_time_limit')
+    values = [getattr(args, name) or [getattr(defaults, name)] for name in names]
+    grid = np.array(list(itertools.product(*values)), dtype=np.float64)
+    b = DecisionBatch(len(grid))
+    for column, name in enumerate(names):
+        b.set(name, grid[:, column])
+    summary = run_batch(features, b)
+    # Rank by the share of frames spent driving (forward or following a plan)
+    driving = (summary['mode_frames'][:, MODE_FORWARD] + summary['mode_frames'][:, MODE_PLAN]) / \
+              float(max(len(features), 1))
+    print('{} variants x {} frames'.format(len(grid), len(features)))
+    print(' '.join('{:>18}'.format(name) for name in names) + '   driving  throttle   pickle')
+    for i in np.argsort(-driving)[:args.top]:
+        print(' '.join('{:>18g}'.format(v) for v in grid[i]) +
+              '   {:6.1%}  {:8.3f}  {:7d}'.format(driving[i], summary['throttle'][i],
+                                                   summary['mode_frames'][i, MODE_PICKLE]))
@@ -0,0 +1,266 @@
+# Benchmarks for the rover control loop
+#
+# stages:   times update_rover, perception_step, decision_step,
+#           create_output_images and the whole loop per frame, and reports
+#           throughput and p50/p95/p99 latency against a frame budget. Results
+#           can be saved as JSON and compared against a previous commit's.
+# wall:     compares the two wall boundary finders
+#
+# Example: $ python benchmark.py stages --json before.json
+#          $ python benchmark.py stages --run ../recordings/run1 --compare before.json
+#          $ python benchmark.py wall --images recorded_image_folder
+import argparse
+import contextlib
+import glob
+import json
+import os
+import subprocess
+import time
+
+import cv2
+import numpy as np
+import matplotlib.image as mpimg
+
+from perception import perspect_transform, wall_binary, wall_boundary, contour_wall, \
+                       get_polar_tables, perception_step
+from decision import decision_step
+from supporting_functions import update_rover, create_output_images, make_telemetry
+from rover_state import RoverState
+from event_log import log
+
+# Same calibration boxes perception_step uses
+source = np.float32([[13,140], [302,140], [200,96], [118,96]])
+destination = np.float32([[155,155],[165,155],[165,145],[155,145]])
+nav_threshold = (190, 180, 160)
+
+# Define a function to draw a rough stand-in for a rover camera frame: a sand
+# colored canyon floor between dark walls, a gold rock and a dark boulder.
+# seed:      varies the wall shape, rock position and pixel noise
+def synthetic_frame(seed=0):
+    rng = np.random.RandomState(seed)
+    img = np.zeros((160, 320, 3), dtype=np.uint8)
+    img[:, :] = (40, 30, 20)
+    horizon = 70 + rng.randint(0, 15)
+    floor = np.array([[0, 160], [320, 160], [320, 100 + rng.randint(0, 30)],
+                      [200 + rng.randint(0, 60), horizon + 5], [100 + rng.randint(0, 40), horizon],
+                      [0, 100 + rng.randint(0, 40)]], dtype=np.int32)
+    cv2.fillPoly(img, [floor], (225, 205, 185))
+    img[:horizon - 20] = (120, 150, 200)
+    cv2.circle(img, (100 + rng.randint(0, 120), 110 + rng.randint(0, 30)), 5, (200, 160, 20), -1)
+    cv2.circle(img, (100 + rng.randint(0, 120), 120 + rng.randint(0, 30)), 8, (20, 15, 10), -1)
+    noise = rng.randint(-20, 21, img.shape)
+    return np.clip(img.astype(int) + noise, 0, 255).astype(np.uint8)
+
+# Define a function to load the frames to benchmark with, either every image in
+# a recorded image folder (see drive_rover.py) or count synthetic frames
+def load_frames(image_folder='', count=200):
+    if image_folder:
+        paths = sorted(glob.glob(os.path.join(image_folder, '*.jpg')))
+        return [np.uint8(mpimg.imread(path)) for path in paths]
+    return [synthetic_frame(seed) for seed in range(count)]
+
+# Define a function to time fn over every item in inputs, returns the per call
+# times in seconds and the outputs of the last pass
+def time_calls(fn, inputs, repeat=3):
+    times = []
+    for r in range(repeat):
+        outputs = []
+        for item in inputs:
+            start = time.perf_counter()
+            outputs.append(fn(item))
+            times.append(time.perf_counter() - start)
+    return np.array(times), outputs
+
+# Compare the band scan wall finder against the full frame contour trace on the
+# same wall images: time per frame and how far the mean wall angle they
+# produce differs (the number decision_step steers on)
+def bench_wall_boundary(frames, repeat=3):
+    imbins = [wall_binary(perspect_transform(img, source, destination), nav_threshold)
+              for img in frames]
+    tables = get_polar_tables(imbins[0].shape, -3)
+
+    contour_times, contour_out = time_calls(lambda imbin: contour_wall(imbin)[1:], imbins, repeat)
+    band_times, band_out = time_calls(wall_boundary, imbins, repeat)
+
+    angle_diffs = []
+    for (xc, yc), (xb, yb) in zip(contour_out, band_out):
+        if xc is None or not xc.size or not xb.size:
+            continue
+        contour_angle = np.mean(tables.gather_points(xc, yc)[3]) * 180 / np.pi
+        band_angle = np.mean(tables.gather_points(xb, yb)[3]) * 180 / np.pi
+        angle_diffs.append(abs(contour_angle - band_angle))
+
+    print('Wall boundary, {} frames x {}'.format(len(frames), repeat))
+    for name, times in (('contour', contour_times), ('band', band_times)):
+        print('  {:8s} mean {:8.1f} us   p95 {:8.1f} us'.format(
+              name, 1e6 * np.mean(times), 1e6 * np.percentile(times, 95)))
+    print('  speedup  {:.1f}x'.format(np.mean(contour_times) / np.mean(band_times)))
+    if angle_diffs:
+        print('  mean wall angle difference {:.2f} deg (max {:.2f} deg)'.format(
+              np.mean(angle_diffs), np.max(angle_diffs)))
+
+# Stages of one telemetry frame, in the order the telemetry handler runs them
+stages = ('update_rover', 'perception', 'decision', 'output_images')
+
+# Define a function to build the telemetry messages to benchmark with
+# run_folder:    recorded run (see replay.load_run), otherwise synthetic frames
+#                driving a slow circle
+def load_telemetry(run_folder='', image_folder='', count=200):
+    samples_pos = ((40, 100, 150), (60, 120, 170))
+    messages = []
+    if run_folder:
+        from replay import load_run, run_frame
+        run = load_run(run_folder)
+        for i in range(run['n_frames']):
+            messages.append(make_telemetry(np.ascontiguousarray(run_frame(run, i)),
+                                           (run['x'][i], run['y'][i]), run['yaw'][i],
+                                           run['pitch'][i], run['roll'][i], run['vel'][i],
+                                           run['throttle'][i], run['steer'][i],
+                                           samples_pos=samples_pos))
+        return messages
+    for i, img in enumerate(load_frames(image_folder, count)):
+        messages.append(make_telemetry(img, (100 + 10 * np.cos(i / 50.), 100 + 10 * np.sin(i / 50.)),
+                                       (i * 360. / 314) % 360, 0.2, 0.3, 1.0, 0.2,
+                                       samples_pos=samples_pos))
+    return messages
+
+# Define a function to run the control loop over the telemetry messages and
+# time every stage of every frame. Console output and events of the stages are
+# discarded.
+# Returns a dict of per-frame times (seconds) for each stage and the loop
+def time_stages(messages, ground_truth=None, repeat=1):
+    if ground_truth is None:
+        truth = np.zeros((200, 200))
+        truth[50:150, 50:150] = 1
+        ground_truth = np.dstack((truth*0, truth*255, truth*0)).astype(np.float)
+    times = dict((stage, []) for stage in stages + ('loop',))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), log.quiet():
+        for r in range(repeat):
+            Rover = RoverState(ground_truth)
+            for data in messages:
+                t0 = time.perf_counter()
+                Rover, image = update_rover(Rover, data)
+                t1 = time.perf_counter()
+                Rover = perception_step(Rover)
+                t2 = time.perf_counter()
+                Rover = decision_step(Rover)
+                t3 = time.perf_counter()
+                create_output_images(Rover)
+                t4 = time.perf_counter()
+                for stage, dt in zip(stages + ('loop',), (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t4 - t0)):
+                    times[stage].append(dt)
+    return dict((stage, np.array(dt)) for stage, dt in times.items())
+
+# Define a function to summarize per-frame times: throughput and latency
+# percentiles in ms, and the fraction of frames over the frame budget
+def summarize(times, budget):
+    summary = {}
+    for stage, dt in times.items():
+        summary[stage] = {'fps': float(1. / np.mean(dt)),
+                          'mean_ms': float(1e3 * np.mean(dt)),
+                          'p50_ms': float(1e3 * np.percentile(dt, 50)),
+                          'p95_ms': float(1e3 * np.percentile(dt, 95)),
+                          'p99_ms': float(1e3 * np.percentile(dt, 99)),
+                          'max_ms': float(1e3 * np.max(dt)),
+                          'over_budget': float(np.mean(dt > budget))}
+    return summary
+
+# Define a function to label results with the commit they were measured on
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+# Define a function to print a summary, with the change against a baseline
+# summary (e.g. from another commit) when given
+def print_summary(summary, budget, baseline=None):
+    print('Frame budget {:.1f} ms'.format(1e3 * budget))
+    print('{:14s} {:>8s} {:>8s} {:>8s} {:>8s} {:>8s} {:>7s}'.format(
+          'stage', 'fps', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', '>budget'))
+    for stage in stages + ('loop',):
+        row = summary[stage]
+        print('{:14s} {:8.1f} {:8.2f} {:8.2f} {:8.2f} {:8.2f} {:6.1f}%'.format(
+              stage, row['fps'], row['p50_ms'], row['p95_ms'], row['p99_ms'], row['max_ms'],
+              100 * row['over_budget']))
+        if baseline is not None and stage in baseline:
+            base = baseline[stage]
+            print('{:14s} {:+7.1f}% {:+7.1f}% {:+7.1f}% {:+7.1f}%'.format(
+                  '  vs baseline',
+                  100 * (row['fps'] / base['fps'] - 1),
+                  100 * (row['p50_ms'] / base['p50_ms'] - 1),
+                  100 * (row['p95_ms'] / base['p95_ms'] - 1),
+                  100 * (row['p99_ms'] / base['p99_ms'] - 1)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rover control loop benchmarks')
+    parser.add_argument(
+        'bench',
+        type=str,
+        nargs='?',
+        choices=['stages', 'wall'],
+        default='stages',
+        help='Benchmark to run.'
+    )
+    parser.add_argument(
+        '--images',
+        type=str,
+        default='',
+        help='Recorded image folder to use instead of synthetic frames.'
+    )
+    parser.add_argument(
+        '--run',
+        type=str,
+        default='',
+        help='Recorded run (frames and telemetry) to use instead of synthetic frames.'
+    )
+    parser.add_argument(
+        '--frames',
+        type=int,
+        default=200,
+        help='Number of synthetic frames.'
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of passes over the frames.'
+    )
+    parser.add_argument(
+        '--budget',
+        type=float,
+        default=40.,
+        help='Frame budget in ms (the simulator runs at 25 fps).'
+    )
+    parser.add_argument(
+        '--json',
+        type=str,
+        default='',
+        help='Save the results to this JSON file.'
+    )
+    parser.add_argument(
+        '--compare',
+        type=str,
+        default='',
+        help='JSON results of an earlier benchmark to compare against.'
+    )
+    args = parser.parse_args()
+
+    if args.bench == 'wall':
+        bench_wall_boundary(load_frames(args.images, args.frames), args.repeat)
+    else:
+        messages = load_telemetry(args.run, args.images, args.frames)
+        budget = args.budget / 1e3
+        summary = summarize(time_stages(messages, repeat=args.repeat), budget)
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)['stages']
+        print('{} frames x {} on commit {}'.format(len(messages), args.repeat, current_commit()))
+        print_summary(summary, budget, baseline)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'commit': current_commit(), 'frames': len(messages),
+                           'repeat': args.repeat, 'budget_ms': args.budget,
+                           'stages': summary}, f, indent=2)
@@ -1,5 +1,8 @@
 import numpy as np
 
+from event_log import log, DEBUG, INFO
+from quality import QUALITY_HALF_RES
+
 
 # This is where you can build a decision tree for determining throttle, brake and steer 
 # commands based on the output of the perception_step() function
@@ -43,6 +46,7 @@ def pickle(Rover, time_limit):
         # so determine if we have exceeded time limit or not
         if Rover.stopped_time:
             if (Rover.total_time - Rover.stopped_time >= time_limit):
+                log.event('stall', INFO, mode=Rover.mode, stopped_for=Rover.total_time - Rover.stopped_time)
                 Rover.mode = 'pickle'
                 Rover.stopped_time = None
         
@@ -74,7 +78,7 @@ def decision_step(Rover):
         # can not be found in the first few 45 degree sweeps, so that it can get itself 
         # out of box canyons reliably.
         
-        print("==================================PICKLE===========================")
+        log.event('decision', DEBUG, every=1., mode='pickle')
         # If we dont have any nav angles at all, then just turn left continuously, until
         # we at least have SOME nav angles. Speeds up the getting to the boundary of a
         # navigable region rather than just going in 45 degree increments.
@@ -142,7 +146,6 @@ def decision_step(Rover):
             Rover.bst_nav = 0
             Rover.stopped_angle = None
             Rover.mode = 'azimuth'
-        print ("===================LEAVING PICKLE===================")
         return Rover
  
 
@@ -156,17 +159,20 @@ def decision_step(Rover):
         # picked_up:         set to True after rover is finished picking up
         # sample_detected:   set to True afet a sample has been detected
         #
-        print ("===================ENTERING SAMPLE===================")
+        log.event('decision', DEBUG, every=1., mode='sample')
         
         # call pickle in case we get stuck for more than 5 seconds we can
         # get ourselves unstuck. If we do trigger a pickle, return.
         Rover = pickle(Rover, 5)
         if Rover.mode == 'pickle': return Rover
         
-        # The rocks are not always detectable on every scan, so make srue
-        # there is valid data in the array, tehn caluclate the steer angle
-        # to the target.
-        if Rover.tgt_angles.size:
+        # The rocks are not always detectable on every scan, so steer on the
+        # tracked rock (see rock_detector.py), which carries over frames the
+        # rock drops out of. Without a tracker, make sure there is valid data
+        # in the array, then calculate the steer angle to the target.
+        if Rover.rock_target is not None:
+            Rover.steer = Rover.rock_target[0]
+        elif Rover.tgt_angles.size:
             Rover.steer = np.mean(Rover.tgt_angles * 180./np.pi)
             
         # If this is the first pass through on this mode, do some things
@@ -195,7 +201,7 @@ def decision_step(Rover):
             if abs(Rover.vel) >= .1:
                 Rover.throttle = 0
                 Rover.brake = Rover.brake_set
-                print ("=1=================LEAVING SAMPLE===================")
+                log.event('sample', DEBUG, every=1., state='braking at sample', vel=Rover.vel)
                 return Rover
             
             # Now that it is stopped, send the pickup command to the rover
@@ -206,7 +212,7 @@ def decision_step(Rover):
             # sample detection event, and assume a successful pickup by 
             # setting picked_up to True.
             while Rover.picking_up:
-                print ("=2=================LEAVING SAMPLE===================")
+                log.event('pickup', INFO, every=1., state='picking up')
                 Rover.sample_detected = False
                 Rover.send_pickup = False
                 Rover.picked_up = True
@@ -215,17 +221,16 @@ def decision_step(Rover):
         # If picked up is True then we must be done. Set picked up to False,
         # and mode to pickle so that we can gracefully leave the sample location.
         if Rover.picked_up:
-            print ("=3================LEAVING SAMPLE===================")
+            log.event('pickup', INFO, state='done')
             Rover.mode = 'pickle'
             Rover.picked_up = False
-        print ("=4================LEAVING SAMPLE===================")
         return Rover
         
     if Rover.mode == 'azimuth':
         
     # In this state, the Rover will stop and turn until it's yaw is approx = to the Rover.tgt_angle
     # Only currently used in pickle mode to have the rover seek the tgt_angle after it is found. 
-        print("==================================AZIMUTH===========================")
+        log.event('decision', DEBUG, every=1., mode='azimuth', yaw=Rover.yaw, tgt_angle=Rover.tgt_angle)
     
     # Check to make sure tgt_angle is valid before proceeding. If not, go into forward mode
         if np.isnan(Rover.tgt_angle):
@@ -249,9 +254,82 @@ def decision_step(Rover):
         # put the rover in forward and leave azimuth mode
         if abs(Rover.yaw - Rover.tgt_angle) < 3:
             Rover.mode = 'forward'
-        print("========================LEAVING AZIMUTH===========================")
         return Rover
     
+    if Rover.mode == 'plan':
+
+        # In this state the rover follows the path planned to Rover.plan_goal (see
+        # path_planner.py): a rock seen earlier but not picked up, or the start once
+        # all the samples are collected. Rover.plan_heading points at a waypoint a
+        # few map cells down the path.
+        log.event('decision', DEBUG, every=1., mode='plan', goal=Rover.plan_goal, dist=Rover.plan_dist)
+
+        # No goal or no path (yet), go back to exploring
+        if Rover.plan_heading is None:
+            Rover.mode = 'forward'
+            return Rover
+
+        # Home, stop here for good
+        if Rover.plan_goal == 'home' and Rover.plan_dist < Rover.route.arrive:
+            Rover.throttle = 0
+            Rover.brake = Rover.brake_set
+            Rover.steer = 0
+            return Rover
+
+        # Waypoint well off to the side: stop and turn toward it on the spot.
+        # The turn keeps its direction until the waypoint is nearly straight
+        # ahead, so a heading hovering around the limit (or around 180 degrees)
+        # doesn't flip between turning and driving, or left and right.
+        if Rover.plan_turn is None and abs(Rover.plan_heading) > Rover.plan_turn_enter:
+            Rover.plan_turn = 1 if Rover.plan_heading > 0 else -1
+            Rover.plan_turn_time = Rover.total_time
+        elif Rover.plan_turn is not None and abs(Rover.plan_heading) < Rover.plan_turn_exit:
+            Rover.plan_turn = None
+
+        # use pickle() to make sure we don't stay here, not moving forever,
+        # but not while turning on the spot on purpose. A stall gives up on
+        # the goal, else the rover would head right back to where it got stuck.
+        if Rover.plan_turn is None:
+            Rover = pickle(Rover, Rover.stopped_time_limit)
+            if Rover.mode == 'pickle':
+                Rover.route.abandon(Rover, 'stalled')
+                return Rover
+        else:
+            Rover.stopped_time = None
+
+        # If we see any gold nuggets, let sample mode take it from here
+        if Rover.tgt_angles is not None and Rover.tgt_angles.any():
+            log.event('sample', INFO, state='detected', tgt_pix=Rover.tgt_angles.size)
+            Rover.mode = 'sample'
+            return Rover
+
+        if Rover.plan_turn is not None:
+            # Turned for too long without lining up, give up on the goal
+            if Rover.total_time - Rover.plan_turn_time > Rover.plan_turn_limit:
+                Rover.route.abandon(Rover, 'turning')
+                Rover.plan_turn = None
+                Rover.mode = 'forward'
+                return Rover
+            if abs(Rover.vel) >= .1:
+                Rover.throttle = 0
+                Rover.brake = Rover.brake_set
+                return Rover
+            Rover.brake = 0
+            Rover.throttle = 0
+            Rover.steer = 15 * Rover.plan_turn
+            return Rover
+
+        # Else drive toward it, keeping clear of obstacles right in front
+        Rover.brake = 0
+        if Rover.vel < Rover.plan_max_vel:
+            Rover.throttle = Rover.throttle_set
+        else:
+            Rover.throttle = 0
+        Rover.steer = np.clip(Rover.plan_heading, -15, 15)
+        if Rover.col_angles is not None:
+            Rover.steer = collision_adj(Rover.steer, Rover.col_angles)
+        return Rover
+
     # Do we have any valid Nav agles? We could just be looking at a black wall.
     if Rover.nav_angles is not None:
         
@@ -282,10 +360,17 @@ def decision_step(Rover):
             #
             #
             
-            print("==================================FORWARD===========================")
+            log.event('decision', DEBUG, every=1., mode='forward')
             # use pickle() to make srue we don't stay in forward, not moving forever.
             Rover = pickle(Rover, Rover.stopped_time_limit)
-            
+
+            # A path has been planned to a rock seen earlier (or back home), follow it
+            if Rover.mode == 'forward' and Rover.plan_heading is not None:
+                log.event('plan', INFO, goal=Rover.plan_goal, dist=Rover.plan_dist)
+                Rover.mode = 'plan'
+                Rover.plan_turn = None
+                return Rover
+
             # Make sure there is enough navigable terrain go move foward
             if len(Rover.nav_angles) >= Rover.stop_forward:
                 
@@ -298,6 +383,9 @@ def decision_step(Rover):
                 # scaled by how much longer than than 20 it is.
                 if wal_length >= 20:
                     Rover.max_vel = np.clip(wal_length/20, 0,3.0)
+                # perception is coarser when the loop is overloaded, don't go flat out
+                if Rover.quality_level >= QUALITY_HALF_RES:
+                    Rover.max_vel = min(Rover.max_vel, Rover.degraded_max_vel)
                     
                 # if going slower than max, speed up
                 if Rover.vel < Rover.max_vel:
@@ -327,7 +415,6 @@ def decision_step(Rover):
                 else:
                     wal_angle_mean = 0
                     p_n = 1.
-                print('Preference for Nav %i' % p_n)
                 # IF there are any pixels in front of us that look like a collision, set a preference
                 # for naviable pixel based navigation relative to the number of collidable pixels seen.
                 # else preference for nav pixel navigation to zero.
@@ -339,14 +426,21 @@ def decision_step(Rover):
                 
                 # Set steering by determinig weighted average of wall contour and navigable pixels means
                 # Include the previous Rover.Steer value in teh average to smooth response.
-                print('Preference for Nav %f' % p_n)
-                print('Wal angle Mean %f' % wal_angle_mean)
-                print('Nav angle Mean %f' % nav_angle_mean)
-                Rover.steer = (Rover.steer + np.clip(nav_angle_mean * p_n  + (wal_angle_mean) * (1 - p_n),-15,15))/2
+                log.event('steer', DEBUG, every=.5, p_n=p_n, wal_angle_mean=wal_angle_mean,
+                          nav_angle_mean=nav_angle_mean)
+                steer = nav_angle_mean * p_n  + (wal_angle_mean) * (1 - p_n)
+                # Pull toward the nearest unexplored frontier, but only if there is
+                # navigable terrain in that direction to drive on
+                if Rover.frontier_heading is not None and Rover.frontier_weight > 0:
+                    frontier = Rover.frontier_heading * np.pi/180
+                    if np.count_nonzero(np.abs(Rover.nav_angles - frontier) < 10 * np.pi/180) >= Rover.frontier_min_nav:
+                        steer = steer * (1 - Rover.frontier_weight) + \
+                                np.clip(Rover.frontier_heading, -15, 15) * Rover.frontier_weight
+                Rover.steer = (Rover.steer + np.clip(steer,-15,15))/2
 
                 # If we see any gold nuggets, go into sample mode now!
                 if Rover.tgt_angles.any():
-                    print('-------Decision: Sample-------')
+                    log.event('sample', INFO, state='detected', tgt_pix=Rover.tgt_angles.size)
                     Rover.mode = 'sample'
                     return Rover
                 
@@ -363,18 +457,16 @@ def decision_step(Rover):
                     Rover.steer = 0
                     Rover.mode = 'pickle'
                     Rover.stopped_time = None
-        print("=========================LEAVING==FORWARD===========================")   
         return Rover
 
                             
     # There were no nav angles present...go straight into a pickle
     else:
-        print("Else Pickle at End")
+        log.event('no_nav', INFO, every=1.)
         Rover.mode = 'pickle'
         
     # If in a state where want to pickup a rock send pickup command
     if Rover.near_sample and Rover.vel == 0 and not Rover.picking_up:
         Rover.send_pickup = True
-    print("Function Return, Mode: ", Rover.mode)
     return Rover
 
@@ -10,7 +10,7 @@ import socketio
 import eventlet
 import eventlet.wsgi
 from PIL import Image
-from flask import Flask
+from flask import Flask, jsonify
 from io import BytesIO, StringIO
 import json
 import pickle
@@ -20,83 +20,25 @@ import time
 # Import functions for perception and decision making
 from perception import perception_step
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from supporting_functions import update_rover
+from rover_state import RoverState, load_ground_truth
+from recorder import RunRecorder
+from output_images import InsetRenderer
+from frame_decoder import FrameDecoder
+from pipeline import ControlPipeline, Reply, idle_reply
+from quality import QualityController, QUALITY_NO_HUD
+from instrumentation import metrics
+from event_log import log, DEBUG, INFO, WARNING, QUIET
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
 
 # Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        self.stopped_time = None # To record the start of when we are stopped
-        self.stopped_angle = None # To record the initial angle of wehen we are stopped
-        self.bst_nav = 0 # To record the current best # navigable pixels for the bst_angle 
-        self.bst_angle = None # place to hold the best solution angle on 180 degree sweep        
-        self.tgt_angle = None # angle we are aiming for in pickle or azimuth
-        self.stopped_time_limit = 6 # max time we will sit stopped without going into pickle mode
-        self.pickle = False # Flag for being in pickle mode
-        self.img = None # Current camera image
-        self.stopped_pos = (0,0) # Position when we stopped
-        self.pos = None # Current position (x, y)
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.vel = None # Current velocity
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = None # Angles of navigable terrain pixels
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.wal_angles = None # Angles of masked contour pixels
-        self.wal_dists = None # Distances of masked contour pixels
-        self.tgt_angles = None # Angles of gold rock targets
-        self.tgt_dists = None # Dinstances of gold rock targets
-        self.col_angles = None # Average angle of objects in front of rover
-        self.col_dists = None # Average distances of objects in front of rover
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.mode = 'forward' # Current mode (can be forward, pickle or stop)
-        self.throttle_set = 0.2 # Throttle setting when accelerating
-        self.brake_set = 10 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.ca_zone = 6 # Width of pixel collision bar in front of rover to trigger steering change
-        self.ca_pix = None # Current status of collision pixels
-        self.stop_forward = 300 # Threshold to initiate stopping 
-        self.go_forward = 800 # Threshold to go forward again 
-        self.max_vel = 1.5 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float)
-        self.sample_detected = False
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_located = 0 # To store number of samples located on map
-        self.samples_collected = 0 # To count the number of samples collected
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-        self.picked_up = False
+ground_truth_3d = load_ground_truth('../calibration_images/map_bw.png')
+
 # Initialize our rover 
-Rover = RoverState()
+Rover = RoverState(ground_truth_3d)
 
 # Variables to track frames per second (FPS)
 # Intitialize frame counter
@@ -105,74 +47,132 @@ frame_counter = 0
 second_counter = time.time()
 fps = None
 
+# Run recorder when recording in the memory-mapped format (see recorder.py)
+recorder = None
+
+# Inset image renderer, replaced according to the command line options
+insets = InsetRenderer(every=1, background=False)
+
+# Camera frame decoder, replaced according to the command line options
+decoder = FrameDecoder()
+
+# Control step worker when running pipelined (see pipeline.py)
+pipeline = None
+
+# Adaptive quality under a frame budget (see quality.py), None runs at full quality
+quality = None
+
+
+# Define a function to run one frame of the control loop on a telemetry message:
+# update Rover, perceive, decide, render the insets and record the frame.
+# Returns the Reply to send back (see pipeline.py)
+def control_step(data):
+    global Rover
+    step_start = time.perf_counter()
+    # Initialize / update Rover with current telemetry
+    with metrics.timed('update_rover'):
+        Rover, image = update_rover(Rover, data, decoder)
+
+    if np.isfinite(Rover.vel):
+
+        # Execute the perception and decision steps to update the Rover's state
+        with metrics.timed('perception'):
+            Rover = perception_step(Rover)
+        mode = Rover.mode
+        with metrics.timed('decision'):
+            Rover = decision_step(Rover)
+        if Rover.mode != mode:
+            log.event('mode', INFO, was=mode, now=Rover.mode, yaw=Rover.yaw, pos=Rover.pos)
+
+        # Create output images to send to server (rendered every Nth frame,
+        # the last ones are reused in between), unless shed under load, then
+        # just a status line with the quality level
+        if Rover.quality_level < QUALITY_NO_HUD:
+            with metrics.timed('insets'):
+                out_image_string1, out_image_string2 = insets.update(Rover)
+        else:
+            out_image_string1, out_image_string2 = insets.shed(Rover, 1e3 * quality.frame_time)
+
+        # If in a state where want to pickup a rock send pickup command
+        pickup = Rover.send_pickup and not Rover.picking_up
+        if pickup:
+            # Reset Rover flags
+            Rover.send_pickup = False
+        reply = Reply(pickup, (Rover.throttle, Rover.brake, Rover.steer),
+                      out_image_string1, out_image_string2)
+
+    # In case of invalid telemetry, send null commands
+    else:
+
+        # Send zeros for throttle, brake and steer and empty images
+        reply = idle_reply
+
+    # If you want to save camera images from autonomous driving specify a path
+    # Example: $ python drive_rover.py image_folder_path
+    # Conditional to save image frame if folder was specified
+    if args.image_folder != '':
+        if recorder is not None:
+            # raw frame and telemetry into the memory-mapped recording
+            recorder.append(Rover)
+        else:
+            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
+            image_filename = os.path.join(args.image_folder, timestamp)
+            # the telemetry image already is a JPEG, write it as is
+            with open('{}.jpg'.format(image_filename), 'wb') as image_file:
+                image_file.write(image)
+
+    # Pick the quality level of the next frame from how long this one took
+    if quality is not None:
+        quality.update(Rover, time.perf_counter() - step_start)
+    return reply
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
 
     global frame_counter, second_counter, fps
+    frame_start = time.perf_counter()
     frame_counter+=1
     # Do a rough calculation of frames per second (FPS)
     if (time.time() - second_counter) > 1:
         fps = frame_counter
         frame_counter = 0
         second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+        log.event('fps', INFO, fps=fps)
 
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
+        if pipeline is not None:
+            # Hand the frame to the worker and answer with the freshest decision
+            reply, fresh = pipeline.submit(data)
+        else:
+            reply, fresh = control_step(data), True
 
-        if np.isfinite(Rover.vel):
+        # The action step!  Send commands to the rover!
 
-            # Execute the perception and decision steps to update the Rover's state
-            print("==========Enter Perception===========")
-            Rover = perception_step(Rover)
-            print("==========Leave Perception===========")
-            print("==========Enter Decision===========")
-            Rover = decision_step(Rover)
-            print("==========Leave Decision===========")
-
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
-
-            # The action step!  Send commands to the rover!
- 
-            # Don't send both of these, they both trigger the simulator
-            # to send back new telemetry so we must only send one
-            # back in respose to the current telemetry data.
-
-            # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                # Reset Rover flags
-                Rover.send_pickup = False
-            else:
-                # Send commands to the rover!
-                commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
-
-        # In case of invalid telemetry, send null commands
+        # Don't send both of these, they both trigger the simulator
+        # to send back new telemetry so we must only send one
+        # back in respose to the current telemetry data.
+        # A pickup is sent once, a repeated decision just resends the commands
+        if reply.pickup and fresh:
+            send_pickup()
         else:
+            # Send commands to the rover!
+            send_control(reply.commands, reply.image1, reply.image2)
 
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
-
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+        metrics.record('frame', time.perf_counter() - frame_start)
 
     else:
         sio.emit('manual', data={}, skip_sid=True)
 
+# Latency summary of every control loop stage over the recent frames
+# Example: $ curl localhost:4567/stats
+@app.route('/stats')
+def stats():
+    return jsonify(metrics.summary())
+
 @sio.on('connect')
 def connect(sid, environ):
-    print("connect ", sid)
+    log.event('connect', INFO, sid=sid)
     send_control((0, 0, 0), '', '')
     sample_data = {}
     sio.emit(
@@ -190,19 +190,21 @@ def send_control(commands, image_string1, image_string2):
         'inset_image2': image_string2,
         }
     # Send commands via socketIO server
-    sio.emit(
-        "data",
-        data,
-        skip_sid=True)
+    with metrics.timed('emit'):
+        sio.emit(
+            "data",
+            data,
+            skip_sid=True)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command 
 def send_pickup():
-    print("Picking up")
+    log.event('pickup', INFO, state='sent', pos=Rover.pos)
     pickup = {}
-    sio.emit(
-        "pickup",
-        pickup,
-        skip_sid=True)
+    with metrics.timed('emit'):
+        sio.emit(
+            "pickup",
+            pickup,
+            skip_sid=True)
     eventlet.sleep(0)
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
@@ -213,7 +215,135 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--format',
+        type=str,
+        choices=['mmap', 'jpg'],
+        default='mmap',
+        help='Recording format, memory-mapped frames + telemetry (mmap) or one JPEG per frame (jpg).'
+    )
+    parser.add_argument(
+        '--hud_every',
+        type=int,
+        default=5,
+        help='Render and encode the inset images every Nth frame.'
+    )
+    parser.add_argument(
+        '--hud_sync',
+        action='store_true',
+        help='Render the inset images in the telemetry handler instead of a background thread.'
+    )
+    parser.add_argument(
+        '--stats_file',
+        type=str,
+        default='',
+        help='Periodically dump the stage latency summary to this .csv or .json file.'
+    )
+    parser.add_argument(
+        '--stats_every',
+        type=float,
+        default=5.,
+        help='Seconds between stage latency dumps.'
+    )
+    parser.add_argument(
+        '--pipelined',
+        action='store_true',
+        help='Run the control step on a worker thread and always reply with the latest decision.'
+    )
+    parser.add_argument(
+        '--map',
+        type=str,
+        choices=['logodds', 'counts'],
+        default='logodds',
+        help='World map fusion, log-odds occupancy or per class evidence counts.'
+    )
+    parser.add_argument(
+        '--world',
+        type=int,
+        nargs=2,
+        metavar=('ROWS', 'COLS'),
+        default=None,
+        help='Map a world of this many cells with a sparse tiled worldmap instead of the dense 200 x 200 one.'
+    )
+    parser.add_argument(
+        '--explore',
+        type=float,
+        default=0.3,
+        help='Weight of the heading to the nearest unexplored frontier in the forward steering, 0 to only follow the wall.'
+    )
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        help='Plan paths to rocks seen earlier and back to the start (not with --world).'
+    )
+    parser.add_argument(
+        '--no_skip',
+        action='store_true',
+        help='Run perception on every frame, even ones that look the same as the last (rover stopped).'
+    )
+    parser.add_argument(
+        '--budget',
+        type=float,
+        default=0.,
+        help='Per-frame latency budget in ms, lowers the quality level while running over it (0 disables).'
+    )
+    parser.add_argument(
+        '--decode_thread',
+        action='store_true',
+        help='Decode the camera image on a worker thread while the telemetry is parsed.'
+    )
+    parser.add_argument(
+        '--decoder',
+        type=str,
+        choices=['pil', 'cv2'],
+        default='pil',
+        help='JPEG decoder for the camera image.'
+    )
+    parser.add_argument(
+        '--log_level',
+        type=str,
+        choices=['debug', 'info', 'warning', 'quiet'],
+        default='info',
+        help='Event log level, quiet skips all logging work.'
+    )
+    parser.add_argument(
+        '--log_format',
+        type=str,
+        choices=['text', 'json'],
+        default='text',
+        help='Event log record format.'
+    )
+    parser.add_argument(
+        '--log_file',
+        type=str,
+        default='',
+        help='Write the event log to this file instead of the console.'
+    )
     args = parser.parse_args()
+    log.level = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'quiet': QUIET}[args.log_level]
+    log.fmt = args.log_format
+    if args.log_file != '':
+        log.stream = open(args.log_file, 'a')
+    if args.world is not None or args.map != 'logodds' or args.plan:
+        Rover = RoverState(ground_truth_3d, tuple(args.world) if args.world else None, args.map, args.plan)
+    Rover.frontier_weight = args.explore
+    if args.explore <= 0:
+        Rover.frontiers = None
+    if args.no_skip:
+        Rover.frame_change = None
+    else:
+        metrics.add_counters('frame_change', Rover.frame_change.stats)
+    insets = InsetRenderer(every=args.hud_every, background=not args.hud_sync)
+    decoder = FrameDecoder(prefetch=args.decode_thread, backend=args.decoder)
+    if args.budget > 0:
+        quality = QualityController(budget=args.budget / 1e3)
+        metrics.add_counters('quality', lambda: {'level': quality.level,
+                                                 'frame_ms': 1e3 * (quality.frame_time or 0.)})
+    if args.pipelined:
+        pipeline = ControlPipeline(control_step)
+        metrics.add_counters('pipeline', pipeline.stats)
+    if args.stats_file != '':
+        metrics.start_dump(args.stats_file, args.stats_every)
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
@@ -223,6 +353,8 @@ if __name__ == '__main__':
         else:
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
+        if args.format == 'mmap':
+            recorder = RunRecorder(args.image_folder)
         print("Recording this run ...")
     else:
         print("NOT recording this run ...")
@@ -231,4 +363,9 @@ if __name__ == '__main__':
     app = socketio.Middleware(sio, app)
 
     # deploy as an eventlet WSGI server
-    eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    try:
+        eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        log.flush()
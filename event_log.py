@@ -0,0 +1,118 @@
+# Structured event log for the control loop
+#
+# Replaces the per-frame print() calls. An event is a key (mode, pickup,
+# stall, ...), a level and a few fields. Calls on the hot path only check the
+# level and the rate limit of the key and queue the raw fields; formatting and
+# the actual console / file I/O happen on a background writer thread. In quiet
+# mode an event call returns right after the level check.
+#
+# Usage:   log.event('mode', INFO, was='forward', now='pickle')
+#          log.event('telemetry', DEBUG, every=1., speed=Rover.vel)
+import contextlib
+import json
+import queue
+import sys
+import threading
+import time
+
+# Levels, events below the log level are dropped without any work
+DEBUG = 10
+INFO = 20
+WARNING = 30
+QUIET = 100
+
+level_names = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', QUIET: 'QUIET'}
+
+# Event log with a queue-backed background writer
+# level:        minimum level written
+# fmt:          'text' (t LEVEL key field=value ...) or 'json' (one object per line)
+# stream:       file to write to, the current sys.stdout if None
+# queue_size:   events queued for the writer, events are dropped (and counted)
+#               rather than blocking the control loop when it is full
+class EventLog():
+    def __init__(self, level=INFO, fmt='text', stream=None, queue_size=4096):
+        self.level = level
+        self.fmt = fmt
+        self.stream = stream
+        self.dropped = 0 # events dropped because the queue was full
+        self._last = {} # key -> time the key was last written
+        self._suppressed = {} # key -> events held back by the rate limit since then
+        self._queue = queue.Queue(queue_size)
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    # Log an event
+    # key:       event name, also the rate limit key
+    # level:     event level
+    # every:     minimum seconds between two events of this key, the number of
+    #            events held back is reported with the next one written
+    # fields:    event fields, formatted by the writer thread
+    def event(self, key, level=INFO, every=None, **fields):
+        if level < self.level:
+            return
+        now = time.time()
+        if every is not None:
+            last = self._last.get(key)
+            if last is not None and now - last < every:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return
+            suppressed = self._suppressed.pop(key, 0)
+            if suppressed:
+                fields['suppressed'] = suppressed
+        self._last[key] = now
+        if self._writer is None:
+            self._start()
+        try:
+            self._queue.put_nowait((now, level, key, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name='event-log')
+                self._writer.daemon = True
+                self._writer.start()
+
+    def format(self, record):
+        now, level, key, fields = record
+        if self.fmt == 'json':
+            return json.dumps(dict(fields, t=round(now, 3), level=level_names.get(level, level), event=key),
+                              default=str)
+        items = ' '.join('{}={}'.format(name, round(value, 3) if isinstance(value, float) else value)
+                         for name, value in fields.items())
+        return '{:.3f} {} {} {}'.format(now, level_names.get(level, level), key, items)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                stream = self.stream if self.stream is not None else sys.stdout
+                stream.write(self.format(record) + '\n')
+                if self._queue.empty():
+                    stream.flush()
+            except Exception:
+                # a broken console must never take the writer down
+                pass
+            finally:
+                self._queue.task_done()
+
+    # Wait until every queued event has been written
+    def flush(self):
+        if self._writer is not None:
+            self._queue.join()
+
+    # Context manager dropping every event inside the block (e.g. offline replays)
+    @contextlib.contextmanager
+    def quiet(self):
+        level, self.level = self.level, QUIET
+        try:
+            yield
+        finally:
+            self.level = level
+
+# Event log shared by the control loop modules
+log = EventLog()
@@ -0,0 +1,98 @@
+# Frontier based exploration
+#
+# Following the right wall and the mean of the navigable pixels re-drives
+# ground the rover has already mapped, which is where the mapped percentage
+# plateaus. A frontier is a map cell known to be navigable with at least one
+# unknown neighbour: driving towards the frontiers is driving towards unmapped
+# ground. FrontierPlanner keeps the set of frontier cells up to date from just
+# the cells perception_step changed in the worldmap (and their neighbours),
+# and picks the heading towards the nearest good frontier for decision_step
+# to blend into its steering.
+import numpy as np
+
+from world_map import cell_values
+
+# 8-connected neighbour offsets (row, col)
+NEIGHBOURS = np.array([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)])
+
+# Incrementally maintained frontier cells of a worldmap
+# shape:        (rows, cols) of the worldmap
+# min_dist:     frontiers closer than this (map cells) are where the rover is
+#               already looking, they are not worth steering to
+# max_dist:     frontiers further than this are ignored
+# turn_cost:    cost in map cells of turning 180 degrees towards a frontier,
+#               so a frontier ahead wins over a slightly closer one behind
+# keep:         a frontier stays the target while another one is not at least
+#               this many cells cheaper, so the heading doesn't dither
+class FrontierPlanner():
+    def __init__(self, shape=(200, 200), min_dist=3., max_dist=60., turn_cost=10., keep=3.):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.min_dist = min_dist
+        self.max_dist = max_dist
+        self.turn_cost = turn_cost
+        self.keep = keep
+        self.frontiers = set() # flat cells (y * cols + x)
+        self.target = None     # flat cell of the current target frontier
+        self._cells = None     # frontiers as an array, rebuilt after changes
+
+    # Navigable and known flags of flat cells: navigable is any navigable
+    # evidence (what map_statistics counts as mapped), known is any evidence at
+    # all. Works on the counts maps and on the log-odds display map.
+    @staticmethod
+    def _classify(worldmap, cells):
+        nav = cell_values(worldmap, cells * 3 + 2) > 0
+        return nav, nav | (cell_values(worldmap, cells * 3) > 0)
+
+    # Re-evaluate the cells around the flat worldmap indices (cell * 3 +
+    # channel) a map update changed, as returned by project_to_world and
+    # OccupancyGrid.fuse
+    def update(self, worldmap, changed):
+        if not len(changed):
+            return
+        rows, cols = self.shape
+        y, x = np.divmod(np.unique(np.asarray(changed) // 3), cols)
+        # a changed cell can also make or unmake its neighbours' frontiers
+        y = np.concatenate((y, (y[:, None] + NEIGHBOURS[:, 0]).ravel()))
+        x = np.concatenate((x, (x[:, None] + NEIGHBOURS[:, 1]).ravel()))
+        inside = (y >= 0) & (y < rows) & (x >= 0) & (x < cols)
+        cells = np.unique(y[inside] * cols + x[inside])
+        y, x = np.divmod(cells, cols)
+        # classify the cells and all of their neighbours in one read, cells
+        # beyond the edge of the map count as known (nothing to explore there)
+        ny = y[:, None] + NEIGHBOURS[:, 0]
+        nx = x[:, None] + NEIGHBOURS[:, 1]
+        outside = (ny < 0) | (ny >= rows) | (nx < 0) | (nx >= cols)
+        neighbours = np.clip(ny, 0, rows - 1) * cols + np.clip(nx, 0, cols - 1)
+        nav, _ = self._classify(worldmap, cells)
+        _, known = self._classify(worldmap, neighbours.ravel())
+        unknown = ~known.reshape(neighbours.shape) & ~outside
+        frontier = nav & unknown.any(axis=1)
+        self.frontiers.difference_update(cells[~frontier].tolist())
+        self.frontiers.update(cells[frontier].tolist())
+        self._cells = None
+
+    # Heading to the nearest good frontier from the rover pose, in degrees
+    # relative to the yaw (positive to the left, like the steering angle), or
+    # None if there is no frontier in range
+    def heading(self, xpos, ypos, yaw):
+        if self._cells is None:
+            self._cells = np.fromiter(self.frontiers, dtype=np.intp, count=len(self.frontiers))
+        if not self._cells.size:
+            self.target = None
+            return None
+        y, x = np.divmod(self._cells, self.shape[1])
+        dx, dy = x + .5 - xpos, y + .5 - ypos
+        dist = np.hypot(dx, dy)
+        bearing = (np.degrees(np.arctan2(dy, dx)) - yaw + 180) % 360 - 180
+        cost = dist + self.turn_cost * np.abs(bearing) / 180
+        cost[(dist < self.min_dist) | (dist > self.max_dist)] = np.inf
+        best = np.argmin(cost)
+        if not np.isfinite(cost[best]):
+            self.target = None
+            return None
+        if self.target is not None and self.target != self._cells[best]:
+            current = np.flatnonzero(self._cells == self.target)
+            if current.size and cost[current[0]] < cost[best] + self.keep:
+                best = current[0]
+        self.target = int(self._cells[best])
+        return float(bearing[best])
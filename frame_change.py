@@ -0,0 +1,73 @@
+# Frame change detection for skipping perception on repeated frames
+#
+# While the rover is stopped (braking in pickle mode before turning, waiting
+# on a pickup, creeping up to a sample) the camera keeps sending near
+# identical frames, and perception_step warped, thresholded, traced and
+# mapped every one of them at full cost, adding the same evidence to the map
+# again. FrameChangeDetector compares each frame against the last one
+# perception_step fully processed: a downsampled thumbnail of the image (one
+# cv2.resize of the camera frame) and the pose. When neither has moved beyond
+# its tolerance the frame is skipped and the previous results stay on Rover.
+import math
+
+import cv2
+import numpy as np
+
+# Difference between two angles in degrees, wrapped to [0, 180]
+def angle_delta(a, b):
+    return abs((a - b + 180.) % 360. - 180.)
+
+# thumb:        (width, height) of the image thumbnails compared
+# pix_tol:      change of a thumbnail pixel (any channel, 0-255) that counts
+#               as a change of that pixel
+# max_pix:      changed thumbnail pixels allowed in an unchanged frame
+# pos_tol:      position change (meters) allowed in an unchanged frame
+# yaw_tol:      yaw change (degrees) allowed in an unchanged frame
+# att_tol:      pitch and roll change (degrees) allowed in an unchanged frame
+# max_skip:     frames skipped in a row before one is processed regardless
+class FrameChangeDetector():
+    def __init__(self, thumb=(40, 20), pix_tol=10, max_pix=2, pos_tol=0.05, yaw_tol=0.5,
+                 att_tol=0.25, max_skip=25):
+        self.thumb = thumb
+        self.pix_tol = pix_tol
+        self.max_pix = max_pix
+        self.pos_tol = pos_tol
+        self.yaw_tol = yaw_tol
+        self.att_tol = att_tol
+        self.max_skip = max_skip
+        self.reference = None # (thumbnail, pos, yaw, pitch, roll, step) of the last processed frame
+        self.current = None   # same for the frame being looked at
+        self.skipped = 0      # frames skipped since the last processed one
+        self.total_skipped = 0
+        self.total_frames = 0
+
+    # True if the frame in Rover looks the same as the last processed one,
+    # step is the perception resolution step (a change forces processing)
+    def unchanged(self, Rover, step=1):
+        self.total_frames += 1
+        thumb = cv2.resize(Rover.img, self.thumb, interpolation=cv2.INTER_AREA)
+        self.current = (thumb, Rover.pos, Rover.yaw, Rover.pitch, Rover.roll, step)
+        ref = self.reference
+        if ref is None or self.skipped >= self.max_skip or step != ref[5]:
+            return False
+        if math.hypot(Rover.pos[0] - ref[1][0], Rover.pos[1] - ref[1][1]) > self.pos_tol or \
+           angle_delta(Rover.yaw, ref[2]) > self.yaw_tol or \
+           angle_delta(Rover.pitch, ref[3]) > self.att_tol or \
+           angle_delta(Rover.roll, ref[4]) > self.att_tol:
+            return False
+        changed = cv2.absdiff(thumb, ref[0]).max(axis=2) > self.pix_tol
+        return np.count_nonzero(changed) <= self.max_pix
+
+    # The frame looked at last was skipped
+    def skip(self):
+        self.skipped += 1
+        self.total_skipped += 1
+
+    # The frame looked at last was fully processed, it is the new reference
+    def processed(self):
+        self.reference = self.current
+        self.skipped = 0
+
+    # Counters for the instrumentation dumps
+    def stats(self):
+        return {'skipped': self.total_skipped, 'frames': self.total_frames}
@@ -0,0 +1,105 @@
+# Camera frame decoding for update_rover
+#
+# The telemetry image is a base64 JPEG. Instead of wrapping a new read-only
+# array around a PIL image every frame, the decoded pixels are written into one
+# of a few preallocated frame buffers that are reused round robin. Optionally
+# the decode runs on a worker thread, started as soon as the message arrives,
+# while the rest of the telemetry is parsed.
+#
+# Two decoders are available. cv2 decodes to BGR and the RGB conversion writes
+# straight into the frame buffer; PIL decodes to RGB which is then copied into
+# it. Both use libjpeg-turbo and give identical frames, but PIL's build was
+# faster on our machines (about 0.5 vs 0.8 ms per frame), so it is the default.
+import base64
+import threading
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Decodes telemetry images into reusable RGB uint8 buffers
+# buffers:      number of frame buffers cycled through. A decoded frame stays
+#               valid until buffers - 1 more frames have been decoded, so keep
+#               this above the number of frames in flight at once
+# prefetch:     decode on a worker thread between submit() and result()
+# backend:      'pil' or 'cv2'
+class FrameDecoder():
+    def __init__(self, buffers=2, prefetch=False, backend='pil'):
+        self.n_buffers = max(1, int(buffers))
+        self.prefetch = prefetch
+        self.backend = backend
+        self.buffers = []
+        self.index = 0 # buffer the next frame is decoded into
+        self.jpeg = None # raw JPEG bytes of the last frame, e.g. for saving
+        self._pending = None
+        self._frame = None
+        self._error = None
+        self._wake = threading.Condition()
+        if prefetch:
+            self._worker = threading.Thread(target=self._run, name='frame-decoder')
+            self._worker.daemon = True
+            self._worker.start()
+
+    # Next buffer for a frame of the given shape, reallocated only if the
+    # camera resolution changes
+    def _buffer(self, shape):
+        if len(self.buffers) < self.n_buffers:
+            self.buffers.append(np.empty(shape, dtype=np.uint8))
+        buff = self.buffers[self.index]
+        if buff.shape != shape:
+            buff = self.buffers[self.index] = np.empty(shape, dtype=np.uint8)
+        self.index = (self.index + 1) % self.n_buffers
+        return buff
+
+    # Decode a base64 JPEG into the next buffer, returns the RGB frame
+    def decode(self, img_string):
+        self.jpeg = base64.b64decode(img_string)
+        if self.backend == 'cv2':
+            bgr = cv2.imdecode(np.frombuffer(self.jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if bgr is None:
+                raise ValueError('telemetry image could not be decoded')
+            return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=self._buffer(bgr.shape))
+        image = Image.open(BytesIO(self.jpeg))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        rgb = np.asarray(image)
+        frame = self._buffer(rgb.shape)
+        np.copyto(frame, rgb)
+        return frame
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while self._pending is None:
+                    self._wake.wait()
+                img_string = self._pending
+            try:
+                frame, error = self.decode(img_string), None
+            except Exception as e:
+                frame, error = None, e
+            with self._wake:
+                self._frame, self._error = frame, error
+                # a newer submit() while decoding is picked up on the next pass
+                if self._pending is img_string:
+                    self._pending = None
+                self._wake.notify_all()
+
+    # Start decoding a frame, without prefetch it is decoded by result()
+    def submit(self, img_string):
+        with self._wake:
+            self._pending = img_string
+            self._frame = None
+            self._wake.notify_all()
+
+    # Frame of the last submit()
+    def result(self):
+        if not self.prefetch:
+            img_string, self._pending = self._pending, None
+            return self.decode(img_string)
+        with self._wake:
+            while self._pending is not None:
+                self._wake.wait()
+            if self._error is not None:
+                raise self._error
+            return self._frame
@@ -0,0 +1,302 @@
+# Headless stand-in for the Unity simulator
+#
+# drive_rover.py can only be run end to end against the Unity simulator, which
+# needs a GPU and runs in real time. HeadlessSim drives a rover with simple
+# kinematics over the ground truth map, and renders its camera frames by
+# warping the map into the top-down view perception_step expects and then
+# back through the camera perspective. SimClient connects it to drive_rover
+# like the simulator does: it answers every 'data' and 'pickup' event with a
+# 'telemetry' message, stepping the simulation by a fixed time step, so a run
+# is repeatable and goes as fast as drive_rover can answer instead of in real
+# time. Each message carries the simulation time ('sim_time'), which
+# update_rover uses instead of the wall clock.
+#
+# Example: $ python drive_rover.py &
+#          $ python headless_sim.py --frames 5000 --seed 3
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from rover_state import load_ground_truth
+from supporting_functions import make_telemetry
+
+# Same calibration boxes perception_step uses: camera pixels -> top-down pixels,
+# 10 top-down pixels per meter with the rover at the bottom center
+source = np.float32([[13,140], [302,140], [200,96], [118,96]])
+destination = np.float32([[155,155],[165,155],[165,145],[155,145]])
+PIX_PER_M = 10.
+
+SAND = (225, 205, 185)
+ROCK = (200, 160, 20)
+WALL = (40, 30, 20)
+SKY = (120, 150, 200)
+
+# Rover simulation over a ground truth map
+# ground_truth:   (rows, cols) map, nonzero is navigable, one cell per meter
+#                 (channel 1 of load_ground_truth)
+# start:          (x, y, yaw) start pose, None picks a navigable cell
+# rocks:          number of sample rocks to place on navigable cells
+# seed:           seeds the start and rock placement
+# dt:             simulated seconds per step
+# upsample:       map pixels per meter of the rendered world image
+class HeadlessSim():
+    def __init__(self, ground_truth, start=None, rocks=6, seed=0, dt=0.04, upsample=4,
+                 frame_shape=(160, 320)):
+        self.navigable = np.asarray(ground_truth) > 0
+        self.dt = dt
+        self.upsample = upsample
+        self.frame_shape = frame_shape
+        rng = np.random.RandomState(seed)
+        free_y, free_x = self.navigable.nonzero()
+        if start is None:
+            pick = rng.randint(len(free_x))
+            start = (free_x[pick] + .5, free_y[pick] + .5, rng.uniform(0, 360))
+        self.x, self.y, self.yaw = float(start[0]), float(start[1]), float(start[2]) % 360
+        picks = rng.choice(len(free_x), rocks, replace=False)
+        self.rocks = [(free_x[i] + .5, free_y[i] + .5) for i in picks]
+        self.vel = 0.
+        self.throttle = 0.
+        self.brake = 0.
+        self.steer = 0.
+        self.time = 0.
+        self.pickup_done = None # simulation time the pickup under way finishes
+        self.collisions = 0
+        self.distance = 0.
+        self._world = self._render_world()
+        self._sky = self._sky_mask()
+        self._camera_to_top = cv2.getPerspectiveTransform(source, destination)
+
+    # Color image of the world, upsample pixels per meter
+    def _render_world(self):
+        k = self.upsample
+        world = np.empty(self.navigable.shape + (3,), dtype=np.uint8)
+        world[:] = WALL
+        world[self.navigable] = SAND
+        world = cv2.resize(world, None, fx=k, fy=k, interpolation=cv2.INTER_NEAREST)
+        for x, y in self.rocks:
+            cv2.circle(world, (int(x * k), int(y * k)), max(1, k // 3), ROCK, -1)
+        return world
+
+    # Camera pixels on or above the horizon, they don't map onto the ground in
+    # front of the camera (the homogeneous coordinate changes sign there)
+    def _sky_mask(self):
+        M = cv2.getPerspectiveTransform(source, destination)
+        rows, cols = self.frame_shape
+        v, u = np.mgrid[0:rows, 0:cols]
+        w = M[2, 0] * u + M[2, 1] * v + M[2, 2]
+        return w * (M[2, 0] * cols / 2. + M[2, 1] * (rows - 1) + M[2, 2]) <= 0
+
+    # Apply the drive commands, advance the simulation by dt
+    def command(self, throttle, brake, steer):
+        self.throttle, self.brake, self.steer = float(throttle), float(brake), float(steer)
+
+    def step(self):
+        dt = self.dt
+        self.time += dt
+        if self.picking_up:
+            if self.time >= self.pickup_done:
+                self._collect()
+            return
+        # skid steering: turns on the spot, steer is about half the yaw rate
+        self.yaw = (self.yaw + 2. * self.steer * dt) % 360
+        accel = 5. * self.throttle - 0.5 * self.vel
+        self.vel += accel * dt
+        if self.brake > 0:
+            slow = min(abs(self.vel), 2. * self.brake * dt)
+            self.vel -= np.sign(self.vel) * slow
+        yaw = np.radians(self.yaw)
+        x = self.x + self.vel * np.cos(yaw) * dt
+        y = self.y + self.vel * np.sin(yaw) * dt
+        row, col = int(y), int(x)
+        inside = 0 <= row < self.navigable.shape[0] and 0 <= col < self.navigable.shape[1]
+        if inside and self.navigable[row, col]:
+            self.distance += np.hypot(x - self.x, y - self.y)
+            self.x, self.y = x, y
+        elif self.vel != 0:
+            self.collisions += 1
+            self.vel = 0.
+
+    @property
+    def picking_up(self):
+        return self.pickup_done is not None
+
+    def _nearest_rock(self):
+        if not self.rocks:
+            return None, np.inf
+        dists = [np.hypot(x - self.x, y - self.y) for x, y in self.rocks]
+        i = int(np.argmin(dists))
+        return i, dists[i]
+
+    @property
+    def near_sample(self):
+        return self._nearest_rock()[1] < 1.
+
+    # 'pickup' command: starts a pickup if stopped next to a rock
+    def pickup(self, duration=2.):
+        if self.near_sample and abs(self.vel) < .2 and not self.picking_up:
+            self.vel = 0.
+            self.pickup_done = self.time + duration
+
+    def _collect(self):
+        i, dist = self._nearest_rock()
+        if i is not None:
+            self.rocks.pop(i)
+            self._world = self._render_world()
+        self.pickup_done = None
+
+    # Camera frame from the current pose: the world image warped into the
+    # top-down view (an affine map), then through the camera perspective
+    def render(self):
+        rows, cols = self.frame_shape
+        k = self.upsample / PIX_PER_M
+        s, c = np.sin(np.radians(self.yaw)), np.cos(np.radians(self.yaw))
+        # top-down pixel (u, v) is rover-centric (rows - v, cols / 2 - u) pixels,
+        # rotated by the yaw and offset by the position in the world image
+        top_to_world = np.float32([
+            [k * s, -k * c, self.upsample * self.x + k * (rows * c - cols / 2. * s)],
+            [-k * c, -k * s, self.upsample * self.y + k * (rows * s + cols / 2. * c)]])
+        top = cv2.warpAffine(self._world, top_to_world, (cols, rows),
+                             flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=WALL)
+        frame = cv2.warpPerspective(top, self._camera_to_top, (cols, rows),
+                                    flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                    borderMode=cv2.BORDER_CONSTANT, borderValue=WALL)
+        frame[self._sky] = SKY
+        return frame
+
+    # Telemetry message of the current state (see make_telemetry)
+    def telemetry(self):
+        samples = (tuple(int(x) for x, y in self.rocks), tuple(int(y) for x, y in self.rocks))
+        data = make_telemetry(self.render(), (self.x, self.y), self.yaw, 0., 0., self.vel,
+                              self.throttle, self.steer, self.near_sample, self.picking_up,
+                              samples)
+        data['sim_time'] = str(self.time)
+        return data
+
+# Connects a HeadlessSim to drive_rover's socket.io server in place of the
+# simulator: every 'data' (drive commands) or 'pickup' event is answered with
+# the telemetry of the next step
+# frames:     steps to run before disconnecting
+# realtime:   pace the steps to the simulated time instead of running flat out
+class SimClient():
+    def __init__(self, sim, frames=3000, realtime=False):
+        import socketio
+        self.sim = sim
+        self.frames = frames
+        self.realtime = realtime
+        self.sent = 0
+        self.pickups = 0
+        self.started = None
+        self.finished = None
+        self.sio = socketio.Client()
+        self.sio.on('data', self._on_data)
+        self.sio.on('pickup', self._on_pickup)
+        self.sio.on('get_samples', self._on_get_samples)
+        self.sio.on('manual', self._on_manual)
+
+    def _send(self):
+        if self.sent >= self.frames:
+            if self.finished is None:
+                self.finished = time.time()
+                self.sio.disconnect()
+            return
+        if self.started is None:
+            self.started = time.time()
+        self.sim.step()
+        if self.realtime:
+            ahead = self.sim.time - (time.time() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+        self.sio.emit('telemetry', self.sim.telemetry())
+        self.sent += 1
+
+    def _on_data(self, data):
+        self.sim.command(data.get('throttle', 0) or 0, data.get('brake', 0) or 0,
+                         data.get('steering_angle', 0) or 0)
+        self._send()
+
+    def _on_pickup(self, data):
+        self.pickups += 1
+        self.sim.pickup()
+        self._send()
+
+    # The simulator answers get_samples with nothing drive_rover uses
+    def _on_get_samples(self, data):
+        pass
+
+    # drive_rover asks for manual mode after empty telemetry, keep driving
+    def _on_manual(self, data):
+        self._send()
+
+    def run(self, url='http://localhost:4567'):
+        self.sio.connect(url)
+        self.sio.wait()
+        return self.summary()
+
+    def summary(self):
+        wall = (self.finished or time.time()) - (self.started or time.time())
+        return {'frames': self.sent, 'sim_s': self.sim.time, 'wall_s': wall,
+                'speedup': self.sim.time / wall if wall > 0 else np.inf,
+                'distance_m': self.sim.distance, 'collisions': self.sim.collisions,
+                'pickups': self.pickups, 'rocks_left': len(self.sim.rocks)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless simulator stand-in for drive_rover.py')
+    parser.add_argument(
+        '--url',
+        type=str,
+        default='http://localhost:4567',
+        help='drive_rover socket.io server.'
+    )
+    parser.add_argument(
+        '--ground_truth',
+        type=str,
+        default='../calibration_images/map_bw.png',
+        help='Ground truth map to drive on (nonzero is navigable).'
+    )
+    parser.add_argument(
+        '--frames',
+        type=int,
+        default=3000,
+        help='Telemetry frames to send.'
+    )
+    parser.add_argument(
+        '--fps',
+        type=float,
+        default=25.,
+        help='Simulated frames per second (the time step).'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed for the start pose and rock placement.'
+    )
+    parser.add_argument(
+        '--rocks',
+        type=int,
+        default=6,
+        help='Sample rocks to place.'
+    )
+    parser.add_argument(
+        '--start',
+        type=float,
+        nargs=3,
+        default=None,
+        metavar=('X', 'Y', 'YAW'),
+        help='Start pose, default a random navigable cell.'
+    )
+    parser.add_argument(
+        '--realtime',
+        action='store_true',
+        help='Pace the simulation to real time.'
+    )
+    args = parser.parse_args()
+
+    ground_truth = load_ground_truth(args.ground_truth)[:, :, 1]
+    sim = HeadlessSim(ground_truth, args.start, args.rocks, args.seed, 1. / args.fps)
+    summary = SimClient(sim, args.frames, args.realtime).run(args.url)
+    print('{frames} frames, {sim_s:.1f} s simulated in {wall_s:.1f} s ({speedup:.1f}x real time)'.format(**summary))
+    print('Drove {distance_m:.1f} m, {collisions} collisions, {pickups} pickups, {rocks_left} rocks left'.format(**summary))
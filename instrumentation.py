@@ -0,0 +1,132 @@
+# Hot path instrumentation for the control loop
+#
+# Each stage of a telemetry frame (decode, the perception sub-steps, decision,
+# output images, emit) records its wall time into a fixed size ring buffer, so
+# memory use is bounded however long the run. Summaries of the recent frames
+# are served by drive_rover.py at /stats and can be dumped to a CSV or JSON
+# file periodically, to see where the frame budget goes on a live run without
+# attaching a profiler.
+#
+# Usage:   with metrics.timed('decision'):
+#              Rover = decision_step(Rover)
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Wall time ring buffer of one stage
+# capacity:     number of most recent samples kept
+class StageTimes():
+    def __init__(self, capacity=1024):
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.count = 0 # samples recorded so far, the ring holds the last capacity
+
+    def add(self, dt):
+        self.times[self.count % len(self.times)] = dt
+        self.count += 1
+
+    # Copy of the samples currently in the ring (oldest first)
+    def recent(self):
+        if self.count < len(self.times):
+            return self.times[:self.count].copy()
+        start = self.count % len(self.times)
+        return np.concatenate((self.times[start:], self.times[:start]))
+
+    # Latency summary in ms of the samples in the ring
+    def summary(self):
+        times = self.recent()
+        if not times.size:
+            return {'count': self.count}
+        p50, p95, p99 = np.percentile(times, (50, 95, 99))
+        return {'count': self.count,
+                'last_ms': float(1e3 * self.times[(self.count - 1) % len(self.times)]),
+                'mean_ms': float(1e3 * np.mean(times)),
+                'p50_ms': float(1e3 * p50),
+                'p95_ms': float(1e3 * p95),
+                'p99_ms': float(1e3 * p99),
+                'max_ms': float(1e3 * np.max(times))}
+
+# Stage timers of the control loop. Stages are created the first time they
+# are timed, so any code on the hot path can add its own.
+# capacity:     samples kept per stage
+# enabled:      when False timed() is a no-op
+class Instrumentation():
+    def __init__(self, capacity=1024, enabled=True):
+        self.capacity = capacity
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = {} # name -> function returning a dict of counters
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._dumper = None
+
+    def stage(self, name):
+        times = self.stages.get(name)
+        if times is None:
+            with self._lock:
+                times = self.stages.setdefault(name, StageTimes(self.capacity))
+        return times
+
+    def record(self, name, dt):
+        if self.enabled:
+            self.stage(name).add(dt)
+
+    # Include the counters returned by fn() (e.g. ControlPipeline.stats) in
+    # the summary under name
+    def add_counters(self, name, fn):
+        self.counters[name] = fn
+
+    # Context manager timing the block it wraps as stage name
+    @contextlib.contextmanager
+    def timed(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage(name).add(time.perf_counter() - start)
+
+    # Summary of every stage, in the order the stages were first timed
+    def summary(self):
+        summary = {'uptime_s': round(time.time() - self.started, 1),
+                   'window': self.capacity,
+                   'stages': dict((name, times.summary()) for name, times in list(self.stages.items()))}
+        for name, fn in self.counters.items():
+            summary[name] = fn()
+        return summary
+
+    # Write the current summary to path, as CSV (one row per stage, without the
+    # counters) if the extension is .csv, JSON otherwise. Written to a temporary file and
+    # renamed so readers never see a partial file.
+    def dump(self, path):
+        summary = self.summary()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            if path.endswith('.csv'):
+                fields = ['stage', 'count', 'last_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                for name, row in summary['stages'].items():
+                    writer.writerow(dict(row, stage=name))
+            else:
+                json.dump(summary, f, indent=2)
+        os.replace(tmp_path, path)
+
+    # Dump the summary to path every interval seconds on a background thread
+    def start_dump(self, path, interval=5.):
+        def run():
+            while True:
+                time.sleep(interval)
+                self.dump(path)
+        self._dumper = threading.Thread(target=run, name='stats-dump')
+        self._dumper.daemon = True
+        self._dumper.start()
+
+# Instrumentation shared by the control loop modules
+metrics = Instrumentation()
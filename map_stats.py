@@ -0,0 +1,97 @@
+import numpy as np
+
+from world_map import TiledWorldMap, cell_values, set_cell_values, map_blocks
+
+# Incremental version of map_statistics (supporting_functions). Instead of
+# rescanning the whole worldmap every frame, the mapped / fidelity counts and
+# the located samples are updated from just the worldmap cells that changed,
+# which project_to_world returns.
+# ground_truth:   3 channel ground truth map (see load_ground_truth)
+# rocks:          RockIndex of the rock detections, if there is one the located
+#                 samples are looked up in it instead of tracked here
+# tiled:          keep what has been seen in lazily allocated tiles (see
+#                 world_map.py) instead of dense arrays, for large worlds
+class MapStatsTracker():
+    def __init__(self, ground_truth, rocks=None, tiled=False):
+        rows, cols = ground_truth.shape[0], ground_truth.shape[1]
+        self.shape = (rows, cols)
+        self.rocks = rocks
+        self.tiled = tiled
+        self.samples_pos = None
+        self.ground_truth = ground_truth
+        self.tot_map_pix = int(np.count_nonzero(ground_truth[:,:,1]))
+        self.reset()
+
+    # Define a method to forget everything seen so far (empty worldmap)
+    def reset(self):
+        # cells shown as navigable (channel 0) and cells with rock detections (channel 1)
+        if self.tiled:
+            self.seen = TiledWorldMap(self.shape, channels=2, dtype=np.uint8)
+        else:
+            self.seen = np.zeros(self.shape + (2,), dtype=np.uint8)
+        self.tot_nav_pix = 0
+        self.good_nav_pix = 0
+        self.located = [] # indices into Rover.samples_pos of the located samples
+
+    # Define a method to fold in the worldmap cells that changed
+    # worldmap:   (rows, cols, 3) worldmap (or TiledWorldMap) after the update
+    # cells:      flat worldmap indices (y * cols + x) * 3 + channel that changed
+    # samples_pos: known sample positions (xs, ys), or None
+    def update(self, worldmap, cells, samples_pos=None):
+        channel = cells % 3
+        pix = cells // 3
+
+        # Navigable cells can be gained (or lost) only where the map changed
+        nav = pix[channel == 2]
+        if nav.size:
+            state = cell_values(worldmap, nav * 3 + 2) > 0
+            delta = state.astype(np.int64) - cell_values(self.seen, nav * 2)
+            nav_y, nav_x = np.divmod(nav, self.shape[1])
+            self.tot_nav_pix += int(delta.sum())
+            self.good_nav_pix += int(delta[self.ground_truth[nav_y, nav_x, 1] > 0].sum())
+            set_cell_values(self.seen, nav * 2, state.astype(np.uint8))
+
+        # Only new rock detections can locate a sample (perception_step feeds
+        # them to the RockIndex, if there is one)
+        self.samples_pos = samples_pos
+        if self.rocks is not None:
+            return
+        rock = pix[channel == 1]
+        rock = rock[cell_values(self.seen, rock * 2 + 1) == 0]
+        rock = rock[cell_values(worldmap, rock * 3 + 1) > 0]
+        if rock.size:
+            set_cell_values(self.seen, rock * 2 + 1, np.ones(rock.size, dtype=np.uint8))
+            if samples_pos is not None:
+                rock_y, rock_x = np.divmod(rock, self.shape[1])
+                for idx in range(len(samples_pos[0])):
+                    if idx in self.located:
+                        continue
+                    rock_sample_dists = np.sqrt((samples_pos[0][idx] - rock_x)**2 + \
+                                                (samples_pos[1][idx] - rock_y)**2)
+                    # rocks detected within 3 meters of a known sample locate it
+                    if np.min(rock_sample_dists) < 3:
+                        self.located.append(idx)
+
+    # Define a method to rescan a whole worldmap, e.g. after it was replaced
+    # (only the allocated tiles of a TiledWorldMap)
+    def rebuild(self, worldmap, samples_pos=None):
+        self.reset()
+        cols = self.shape[1]
+        cells = []
+        for row0, col0, block in map_blocks(worldmap):
+            y, x, channel = np.nonzero(block)
+            cells.append(((y + row0) * cols + x + col0) * 3 + channel)
+        if cells:
+            self.update(worldmap, np.concatenate(cells), samples_pos)
+
+    # Same numbers as map_statistics: percent mapped, fidelity and the located
+    # sample indices
+    def stats(self):
+        perc_mapped = round(100.*self.good_nav_pix/self.tot_map_pix, 1) if self.tot_map_pix else 0
+        if self.tot_nav_pix > 0:
+            fidelity = round(100.*self.good_nav_pix/self.tot_nav_pix, 1)
+        else:
+            fidelity = 0
+        if self.rocks is not None:
+            return perc_mapped, fidelity, self.rocks.located(self.samples_pos)
+        return perc_mapped, fidelity, list(self.located)
@@ -0,0 +1,150 @@
+# Log-odds occupancy fusion for the world map
+#
+# Instead of counting how often each cell was classified obstacle or navigable
+# and cleaning the counts up for display every frame, every cell keeps one
+# fixed-point log-odds value: positive is navigable, negative is obstacle. Each
+# frame's observations are weighted by how far in front of the rover they are
+# (far warped pixels are stretched and unreliable) and by how level the rover
+# is (roll / pitch distort the warp), summed per cell with one integer scatter
+# and clamped, so a single frame can only move a cell so far. The display map
+# (Rover.worldmap) is updated from the log-odds at just the changed cells, so
+# the cleanup is built in and nothing has to be normalized over the full map.
+import numpy as np
+
+# Weight of an observation by its rover-centric distance in warped pixels, in
+# 1/16ths: full weight up close, fading to 1/8 at the far edge of the warp
+DIST_WEIGHTS = np.int32(np.round(np.interp(np.arange(256), (0, 40, 160, 255), (16, 16, 2, 2))))
+
+# Define a function to weight a frame by the rover attitude, in 1/16ths: full
+# weight within tolerance (roll, pitch) degrees of level, fading to nothing at
+# three times the tolerance
+def attitude_weight(roll, pitch, tolerance=(1.5, 1)):
+    weight = 16
+    for angle, tol in ((roll, tolerance[0]), (pitch, tolerance[1])):
+        dev = min(angle % 360, 360 - angle % 360)
+        if dev > tol:
+            weight = min(weight, int(16 * max(0., 1 - (dev - tol) / (2 * tol))))
+    return weight
+
+# Per warped image geometry constants of OccupancyGrid.fuse: the distance
+# weight of every pixel and the rover-centric center of every block
+# tables:     PolarTables of the warped image
+# block:      block side in pixels
+class BlockPlan():
+    def __init__(self, tables, block):
+        rows, cols = tables.shape
+        rows, cols = rows - rows % block, cols - cols % block
+        self.shape = (rows, cols)
+        dist = tables.dist.reshape(tables.shape)[:rows, :cols]
+        self.dist_weights = DIST_WEIGHTS[np.minimum(np.int_(dist), len(DIST_WEIGHTS) - 1)]
+        def centers(values):
+            values = values.reshape(tables.shape)[:rows, :cols]
+            return values.reshape(rows // block, block, cols // block, block).mean(axis=(1, 3)).ravel()
+        self.x = centers(tables.x)
+        self.y = centers(tables.y)
+
+# Block plans keyed by warped image geometry
+block_plans = {}
+
+def get_block_plan(tables, block):
+    key = (id(tables), block)
+    plan = block_plans.get(key)
+    if plan is None:
+        plan = BlockPlan(tables, block)
+        block_plans[key] = plan
+    return plan
+
+# Fixed-point log-odds occupancy grid
+# shape:      (rows, cols) of the world
+# nav_hit:    log-odds added by a full weight navigable pixel
+# obs_hit:    log-odds subtracted by a full weight non-navigable pixel
+# max_step:   largest change of one cell in one frame
+# limit:      log-odds clamp, how much evidence a cell can store
+# display_full: log-odds shown at full intensity on the display map
+class OccupancyGrid():
+    def __init__(self, shape=(200, 200), nav_hit=8, obs_hit=4, max_step=64, limit=1024,
+                 display_full=512):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.nav_hit = nav_hit
+        self.obs_hit = obs_hit
+        self.max_step = max_step
+        self.limit = limit
+        self.display_full = display_full
+        self.logodds = np.zeros(self.shape, dtype=np.int16)
+        self.rock = np.zeros(self.shape, dtype=np.uint16) # rock detections per cell
+        # obstacle (0), rock (1) and navigable (2) display intensities, this is
+        # the array used as Rover.worldmap
+        self.display = np.zeros(self.shape + (3,), dtype=np.uint8)
+
+    # Flat world cell (y * cols + x) of rover-centric pixels, the same rotation,
+    # translation and clipping as pix_to_world
+    def _cells(self, xpix, ypix, xpos, ypos, yaw, scale):
+        yaw_rad = yaw * np.pi / 180
+        xpix_tran = (xpix * np.cos(yaw_rad) - ypix * np.sin(yaw_rad)) / scale + xpos
+        ypix_tran = (xpix * np.sin(yaw_rad) + ypix * np.cos(yaw_rad)) / scale + ypos
+        x_world = np.clip(np.int_(xpix_tran), 0, self.shape[1] - 1)
+        y_world = np.clip(np.int_(ypix_tran), 0, self.shape[0] - 1)
+        return y_world * self.shape[1] + x_world
+
+    # Fuse one frame of observations
+    # nav_img:       warped image mask of the navigable pixels
+    # seen_img:      warped image mask of the pixels the camera sees, the seen
+    #                pixels that are not navigable are obstacle evidence
+    # rock_xy:       rover-centric (xpix, ypix) of the rock pixels
+    # tables:        PolarTables of the warped image (rover-centric x, y, dist)
+    # xpos, ypos, yaw, scale:    as for project_to_world
+    # weight:        attitude weight of the frame in 1/16ths
+    # block:         the evidence is summed over block x block pixel squares
+    #                and projected from their centers, much finer than a map
+    #                cell and a fraction of the points to rotate and scatter
+    # Returns the flat display map indices (cell * 3 + channel) that changed
+    def fuse(self, nav_img, seen_img, rock_xy, tables, xpos, ypos, yaw, scale, weight=16, block=4):
+        changed = []
+        if weight > 0:
+            plan = get_block_plan(tables, block)
+            rows, cols = plan.shape
+            # per pixel evidence in 1/16ths: class hit x distance weight
+            nav = nav_img[:rows, :cols] != 0
+            evidence = np.where(nav, self.nav_hit, np.where(seen_img[:rows, :cols], -self.obs_hit, 0))
+            evidence *= plan.dist_weights
+            evidence = evidence.reshape(rows // block, block, cols // block, block).sum(axis=(1, 3)).ravel()
+            hit = np.flatnonzero(evidence)
+            if hit.size:
+                cells = self._cells(plan.x[hit], plan.y[hit], xpos, ypos, yaw, scale)
+                # sum per cell (in 1/256ths with the attitude weight) over the
+                # span of the touched cells
+                first = cells.min()
+                sums = np.bincount(cells - first, weights=evidence[hit] * weight)
+                touched = sums.nonzero()[0]
+                delta = np.clip(np.int_(np.round(sums[touched] / 256)), -self.max_step, self.max_step)
+                touched = touched + first
+                flat = self.logodds.reshape(-1)
+                flat[touched] = np.clip(flat[touched] + delta, -self.limit, self.limit)
+                self._refresh(touched)
+                changed.append(touched * 3)
+                changed.append(touched * 3 + 2)
+        if len(rock_xy[0]):
+            cells = np.unique(self._cells(rock_xy[0], rock_xy[1], xpos, ypos, yaw, scale))
+            flat = self.rock.reshape(-1)
+            flat[cells] = np.minimum(flat[cells] + 1, np.iinfo(self.rock.dtype).max)
+            self.display.reshape(-1, 3)[cells, 1] = 255
+            changed.append(cells * 3 + 1)
+        if not changed:
+            return np.zeros(0, dtype=np.intp)
+        return np.concatenate(changed)
+
+    # Recompute the display intensities of flat cells from their log-odds
+    def _refresh(self, cells):
+        lo = self.logodds.reshape(-1)[cells].astype(np.int32)
+        shade = np.clip(64 + np.abs(lo) * 191 // self.display_full, 64, 255).astype(np.uint8)
+        display = self.display.reshape(-1, 3)
+        display[cells, 0] = np.where(lo < 0, shade, 0)
+        display[cells, 2] = np.where(lo > 0, shade, 0)
+
+    # Add the evidence of another grid of the same world (log-odds add up),
+    # e.g. to merge maps fused from separate parts of a run
+    def absorb(self, other):
+        self.logodds[:] = np.clip(self.logodds.astype(np.int32) + other.logodds, -self.limit, self.limit)
+        self.rock[:] = np.minimum(self.rock.astype(np.int64) + other.rock, np.iinfo(self.rock.dtype).max)
+        self._refresh(np.arange(self.logodds.size))
+        self.display[:, :, 1] = np.where(self.rock > 0, 255, 0)
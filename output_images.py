@@ -0,0 +1,76 @@
+# Output image (inset) rendering off the control loop
+#
+# The HUD and map insets are cosmetic, so instead of drawing and JPEG encoding
+# both on every telemetry frame they are rendered every Nth frame, by default
+# on a background thread. In between, the last encoded strings are sent again.
+import copy
+import threading
+
+from supporting_functions import create_output_images, create_status_image
+from instrumentation import metrics
+
+# Renders the inset images for send_control
+# every:        render every Nth frame (1 renders every frame)
+# background:   render on a worker thread instead of in the telemetry handler
+class InsetRenderer():
+    def __init__(self, every=5, background=True):
+        self.every = max(1, int(every))
+        self.background = background
+        self.frame = 0
+        self.images = ('', '') # last encoded (map, vision) image strings
+        self.rendered = 0 # number of renders completed
+        self.skipped = 0 # renders skipped because the worker was still busy
+        self._pending = None
+        self._status = (None, '') # (quality level, encoded status inset) while shed
+        self._wake = threading.Condition()
+        self._worker = None
+        if background:
+            self._worker = threading.Thread(target=self._run, name='inset-renderer')
+            self._worker.daemon = True
+            self._worker.start()
+
+    # Take a copy of just the parts of Rover the renderer reads that perception
+    # updates in place (the worldmap); everything else is replaced each frame
+    @staticmethod
+    def snapshot(Rover):
+        snap = copy.copy(Rover)
+        snap.worldmap = Rover.worldmap.copy()
+        return snap
+
+    def _render(self, Rover):
+        with metrics.timed('output_images'):
+            self.images = create_output_images(Rover)
+        self.rendered += 1
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while self._pending is None:
+                    self._wake.wait()
+                Rover, self._pending = self._pending, None
+            self._render(Rover)
+
+    # Call once per telemetry frame, returns the (map, vision) image strings
+    # to send with this frame's commands
+    def update(self, Rover):
+        due = self.frame % self.every == 0
+        self.frame += 1
+        if due:
+            if not self.background:
+                self._render(Rover)
+            else:
+                with self._wake:
+                    # latest frame wins if the worker hasn't picked up the last one
+                    if self._pending is not None:
+                        self.skipped += 1
+                    self._pending = self.snapshot(Rover)
+                    self._wake.notify()
+        return self.images
+
+    # Call instead of update while the insets are shed (see quality.py),
+    # returns a text-only status inset showing the quality level in place of
+    # the map, encoded again only when the level changes
+    def shed(self, Rover, frame_ms=None):
+        if self._status[0] != Rover.quality_level:
+            self._status = (Rover.quality_level, create_status_image(Rover, frame_ms))
+        return self._status[1], ''
@@ -0,0 +1,323 @@
+# Incremental grid path planning over the worldmap
+#
+# The rover only reaches a rock if it happens to see it while following the
+# wall, and it has no way back to where it started. RoutePlanner picks a goal
+# (a rock seen on the map but not picked up yet, or the start once every rock
+# is collected) and plans a path to it over the worldmap cells with D* Lite
+# (Koenig & Likhachev). D* Lite searches backwards from the goal and keeps its
+# g / rhs values between frames: when the rover moves or map cells change
+# only the part of the search those changes affect is repaired, instead of
+# replanning the whole map every frame. Each frame is also given a budget of
+# search work, a search that runs out picks up where it left off on the next
+# frame. A goal the rover gets no closer to for a while, or whose path costs
+# far more than the straight line to it (a rock seen on top of a wall, behind
+# rocks or out in the unmapped), is given up on and another one chosen.
+import heapq
+import numpy as np
+
+from world_map import cell_values
+from event_log import log, INFO
+
+INF = float('inf')
+SQRT2 = 2 ** .5
+# Decimals keys are rounded to: the same path cost summed in a different
+# order can differ in the last bits, and ties must compare equal for the heap
+# order and the end of the search to be right
+KEY_DECIMALS = 6
+
+# D* Lite on an 8-connected grid of cell costs
+# shape:          (rows, cols) of the worldmap
+# unknown_cost:   cost of crossing a cell nothing is known about, navigable
+#                 cells cost 1
+# obstacle_cost:  cost of crossing a cell seen as obstacle, high but finite so
+#                 a misclassified cell (or one the rover is standing on) can't
+#                 cut the rover off
+class DStarLite():
+    def __init__(self, shape=(200, 200), unknown_cost=3., obstacle_cost=50.):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.unknown_cost = unknown_cost
+        self.obstacle_cost = obstacle_cost
+        # Cells are kept in a grid padded with a blocked border so neighbours
+        # never need bounds checks, node n is padded cell (y + 1) * width + x + 1
+        self.width = self.shape[1] + 2
+        size = (self.shape[0] + 2) * self.width
+        self.cost = [unknown_cost] * size
+        for n in range(size):
+            y, x = divmod(n, self.width)
+            if y in (0, self.shape[0] + 1) or x in (0, self.width - 1):
+                self.cost[n] = INF
+        w = self.width
+        self.moves = ((-w - 1, SQRT2), (-w, 1.), (-w + 1, SQRT2), (-1, 1.),
+                      (1, 1.), (w - 1, SQRT2), (w, 1.), (w + 1, SQRT2))
+        self.start = None
+        self.goal = None
+        self.popped = 0 # priority queue pops of the last plan()
+
+    # Padded node of a map cell (x, y)
+    def node(self, x, y):
+        x = min(max(int(x), 0), self.shape[1] - 1)
+        y = min(max(int(y), 0), self.shape[0] - 1)
+        return (y + 1) * self.width + x + 1
+
+    # Map cell (x, y) of a padded node
+    def cell(self, n):
+        y, x = divmod(n, self.width)
+        return x - 1, y - 1
+
+    # Octile distance, admissible since no cell costs less than 1
+    def _h(self, a, b):
+        ay, ax = divmod(a, self.width)
+        by, bx = divmod(b, self.width)
+        dx, dy = abs(ax - bx), abs(ay - by)
+        return max(dx, dy) + (SQRT2 - 1) * min(dx, dy)
+
+    def _key(self, n):
+        m = min(self.g[n], self.rhs[n])
+        y, x = divmod(n, self.width)
+        dx, dy = abs(x - self._start_x), abs(y - self._start_y)
+        return (round(m + max(dx, dy) + (SQRT2 - 1) * min(dx, dy) + self.km, KEY_DECIMALS),
+                round(m, KEY_DECIMALS))
+
+    def _update_vertex(self, n):
+        if n != self.goal:
+            best = INF
+            cost_n = self.cost[n]
+            if cost_n < INF:
+                g, cost = self.g, self.cost
+                for offset, length in self.moves:
+                    s = n + offset
+                    c = g[s] + length * (cost_n + cost[s]) / 2
+                    if c < best:
+                        best = c
+            self.rhs[n] = best
+        if self.g[n] != self.rhs[n]:
+            heapq.heappush(self.heap, (self._key(n), n))
+
+    # Start a new search from start to goal (padded nodes)
+    def reset(self, start, goal):
+        size = len(self.cost)
+        self.g = [INF] * size
+        self.rhs = [INF] * size
+        self.km = 0.
+        self.heap = []
+        self.last = start
+        self.move(start)
+        self.goal = goal
+        self.rhs[goal] = 0.
+        heapq.heappush(self.heap, (self._key(goal), goal))
+
+    # Move the start of the search, the search is repaired on the next plan().
+    # The heuristic is relative to the start, so km grows by how far it moved:
+    # keys computed from now on stay comparable with those already in the heap.
+    def move(self, start):
+        self.km += self._h(self.last, start)
+        self.last = start
+        self.start = start
+        self._start_y, self._start_x = divmod(start, self.width)
+
+    # Change cell costs, costs: {node: new cost}
+    def set_costs(self, costs):
+        changed = [n for n, c in costs.items() if self.cost[n] != c]
+        if not changed:
+            return
+        for n in changed:
+            self.cost[n] = costs[n]
+        if self.goal is None:
+            return
+        for n in changed:
+            self._update_vertex(n)
+            for offset, _ in self.moves:
+                if self.cost[n + offset] < INF:
+                    self._update_vertex(n + offset)
+
+    # Run (or resume) the search for at most max_pops priority queue pops
+    # (node expansions, and refreshes of keys that went stale when the start
+    # moved), returns True once the start's cost to the goal is final
+    def plan(self, max_pops=300):
+        self.popped = 0
+        heap, g, rhs = self.heap, self.g, self.rhs
+        start = self.start
+        while heap:
+            k_old, n = heap[0]
+            if k_old >= self._key(start) and rhs[start] == g[start]:
+                return True
+            if self.popped >= max_pops:
+                return False
+            heapq.heappop(heap)
+            self.popped += 1
+            if g[n] == rhs[n]:
+                continue # stale entry of a node that is consistent again
+            k_new = self._key(n)
+            if k_old < k_new:
+                heapq.heappush(heap, (k_new, n))
+                continue
+            if g[n] > rhs[n]:
+                g[n] = rhs[n]
+            else:
+                g[n] = INF
+                self._update_vertex(n)
+            for offset, _ in self.moves:
+                s = n + offset
+                if self.cost[s] < INF:
+                    self._update_vertex(s)
+        return True
+
+    # Cost from the start to the goal, INF if there is no path
+    def distance(self):
+        return self.g[self.start]
+
+    # Up to steps nodes of the planned path from the start
+    def path(self, steps):
+        nodes = []
+        n = self.start
+        for _ in range(steps):
+            if n == self.goal or self.g[n] == INF:
+                break
+            best, best_c = None, INF
+            for offset, length in self.moves:
+                s = n + offset
+                c = self.g[s] + length * (self.cost[n] + self.cost[s]) / 2
+                if c < best_c:
+                    best, best_c = s, c
+            if best is None:
+                break
+            nodes.append(best)
+            n = best
+        return nodes
+
+# Chooses where to go and keeps a D* Lite path to it up to date
+# shape:          (rows, cols) of the worldmap
+# unknown_cost, obstacle_cost: see DStarLite
+# max_pops:       search work per frame, see DStarLite.plan
+# lookahead:      path cells ahead of the rover to steer toward
+# arrive:         distance (map cells) at which a goal is reached
+# rock_radius:    rock candidates within this distance of where a sample was
+#                 picked up are done
+# min_confidence: RockIndex confidence a rock candidate needs to be a goal
+# give_up:        seconds the rover may go without getting progress map cells
+#                 closer to the goal before it is given up on
+# progress:       map cells closer to the goal that count as progress
+# max_detour:     a goal is given up on once its planned path costs more than
+#                 max_detour times a straight line of unknown cells to it (plus
+#                 one obstacle cell, the rover or the rock may be standing on one)
+class RoutePlanner():
+    def __init__(self, shape=(200, 200), unknown_cost=3., obstacle_cost=50., max_pops=300,
+                 lookahead=4, arrive=1.5, rock_radius=3., min_confidence=0.4, give_up=30.,
+                 progress=2., max_detour=2.):
+        self.grid = DStarLite(shape, unknown_cost, obstacle_cost)
+        self.max_pops = max_pops
+        self.lookahead = lookahead
+        self.arrive = arrive
+        self.rock_radius = rock_radius
+        self.min_confidence = min_confidence
+        self.give_up = give_up
+        self.progress = progress
+        self.max_detour = max_detour
+        self.collected = 0
+        self.home = None     # (x, y) the rover started from
+        self.goal = None     # ('rock' or 'home', (x, y))
+        self.rock = None     # RockCandidate of a rock goal
+        self.closest = None  # (distance to the goal, time) when last closer by progress
+        self.home_after = 0. # time before which going home is not tried again
+        self.abandoned = 0   # goals given up on
+
+    # Update the cell costs from the flat worldmap indices (cell * 3 +
+    # channel) a map update changed. Navigable evidence makes a cell cheap,
+    # obstacle evidence without any navigable evidence makes it expensive.
+    def update_map(self, worldmap, changed):
+        if not len(changed):
+            return
+        cells = np.unique(np.asarray(changed) // 3)
+        nav = cell_values(worldmap, cells * 3 + 2) > 0
+        obs = cell_values(worldmap, cells * 3) > 0
+        cost = np.where(nav, 1., np.where(obs, self.grid.obstacle_cost, self.grid.unknown_cost))
+        y, x = np.divmod(cells, self.grid.shape[1])
+        nodes = (y + 1) * self.grid.width + x + 1
+        self.grid.set_costs(dict(zip(nodes.tolist(), cost.tolist())))
+
+    # The goal to head for: the start once every sample is collected, else
+    # the nearest rock candidate in Rover.rocks (see rock_index.py) that isn't
+    # done. A rock stays the goal, where it was when it was chosen, until it
+    # is done: switching goals throws the search away.
+    def _choose(self, Rover, xpos, ypos):
+        if Rover.samples_to_find and Rover.samples_collected >= Rover.samples_to_find:
+            if Rover.total_time < self.home_after:
+                return None
+            return ('home', self.home)
+        if self.rock is not None and not self.rock.done:
+            return self.goal
+        self.rock = None
+        if Rover.rocks is not None:
+            self.rock = Rover.rocks.nearest(xpos, ypos, self.min_confidence)
+        if self.rock is None:
+            return None
+        return ('rock', (self.rock.x, self.rock.y))
+
+    # Give up on the current goal: a rock candidate is marked done, going home
+    # is tried again after give_up seconds (exploring in the meantime)
+    def abandon(self, Rover, reason):
+        if self.goal is None:
+            return
+        log.event('plan', INFO, goal=self.goal[0], given_up=reason, pos=Rover.pos)
+        if self.rock is not None:
+            self.rock.done = True
+        if self.goal[0] == 'home':
+            self.home_after = Rover.total_time + self.give_up
+        self.goal = self.rock = self.closest = None
+        self.abandoned += 1
+        Rover.plan_goal, Rover.plan_heading, Rover.plan_dist = None, None, None
+
+    # Per frame update: fold in the map changes (changed may be None), pick
+    # the goal, repair the path and set Rover.plan_goal, Rover.plan_heading
+    # (degrees relative to the yaw, None without a path) and Rover.plan_dist
+    def update(self, Rover, changed=None):
+        xpos, ypos = Rover.pos
+        if self.home is None:
+            self.home = (xpos, ypos)
+        if changed is not None:
+            self.update_map(Rover.worldmap, changed)
+        # a rock was picked up here
+        if Rover.samples_collected > self.collected:
+            self.collected = Rover.samples_collected
+            if Rover.rocks is not None:
+                Rover.rocks.mark_done(xpos, ypos, self.rock_radius)
+        goal = self._choose(Rover, xpos, ypos)
+        Rover.plan_goal, Rover.plan_heading, Rover.plan_dist = None, None, None
+        if goal is None:
+            self.goal = None
+            return
+        dist = np.hypot(goal[1][0] - xpos, goal[1][1] - ypos)
+        if dist < self.arrive and goal[0] == 'rock':
+            # sample mode would have taken over if the rock were in sight
+            self.rock.done = True
+            self.goal = self.rock = None
+            return
+        start = self.grid.node(xpos, ypos)
+        if goal != self.goal:
+            self.goal = goal
+            self.closest = (dist, Rover.total_time)
+            self.grid.reset(start, self.grid.node(*goal[1]))
+        else:
+            self.grid.move(start)
+        Rover.plan_goal, Rover.plan_dist = goal[0], dist
+        if dist < self.arrive:
+            Rover.plan_heading = 0.
+            return
+        # No closer for too long
+        if dist <= self.closest[0] - self.progress:
+            self.closest = (dist, Rover.total_time)
+        elif Rover.total_time - self.closest[1] > self.give_up:
+            self.abandon(Rover, 'no progress')
+            return self.update(Rover)
+        if not self.grid.plan(self.max_pops):
+            return
+        # The finished search says the goal can't be reached, or only the long way
+        if self.grid.distance() > self.max_detour * self.grid.unknown_cost * dist + self.grid.obstacle_cost:
+            self.abandon(Rover, 'path cost')
+            return self.update(Rover)
+        path = self.grid.path(self.lookahead)
+        if not path:
+            return
+        x, y = self.grid.cell(path[-1])
+        Rover.plan_heading = float((np.degrees(np.arctan2(y + .5 - ypos, x + .5 - xpos)) - Rover.yaw + 180)
+                                   % 360 - 180)
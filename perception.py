@@ -1,7 +1,13 @@
+import time
 import numpy as np
 import numpy.ma as ma
 import cv2
 
+from instrumentation import metrics
+from quality import QUALITY_SPARSE_MAP, QUALITY_HALF_RES
+from world_map import TiledWorldMap
+from occupancy import attitude_weight
+
 
 
 def get_contours(img, rgb_thresh=(170, 170, 170)):
@@ -41,7 +47,8 @@ def get_contours(img, rgb_thresh=(170, 170, 170)):
     # find the contours, imcont is modified, contours is a list of coordiantes of our contour.
     # the CHAIN_APPROX_NONE ensures we get all points without compression/ extrapolation.
     # hierarchy returns nested contour heirarchies, which we aren't using
-    imcont, contours, hierarchy = cv2.findContours(imcont,cv2.RETR_TREE,cv2.CHAIN_APPROX_NONE)
+    # ([-2] picks the contours out of both the OpenCV 3 and the OpenCV 4 return)
+    contours = cv2.findContours(imcont,cv2.RETR_TREE,cv2.CHAIN_APPROX_NONE)[-2]
     return color_select, imbin, contours
 
 def color_thresh(img, rgb_thresh=(160, 160, 160), tgt=False, tol=(40,40,40)):
@@ -54,10 +61,11 @@ def color_thresh(img, rgb_thresh=(160, 160, 160), tgt=False, tol=(40,40,40)):
     color_select = np.zeros_like(img[:,:,0])
     
     # if tgt == True we are looking for samples so look for +/- from rgb_thresh
+    # (in int16, a uint8 difference wraps around below rgb_thresh)
     if tgt:
-        bool_array = (abs(img[:,:,0] - rgb_thresh[0]) < tol[0]) \
-                   & (abs(img[:,:,1] - rgb_thresh[1]) < tol[1]) \
-                   & (abs(img[:,:,2] - rgb_thresh[2]) < tol[2]) 
+        bool_array = (abs(img[:,:,0].astype(np.int16) - rgb_thresh[0]) < tol[0]) \
+                   & (abs(img[:,:,1].astype(np.int16) - rgb_thresh[1]) < tol[1]) \
+                   & (abs(img[:,:,2].astype(np.int16) - rgb_thresh[2]) < tol[2]) 
     
     # tgt is false, we are looking for nav terrain/obstacles
     else:    
@@ -73,6 +81,135 @@ def color_thresh(img, rgb_thresh=(160, 160, 160), tgt=False, tol=(40,40,40)):
     return color_select
 
 
+# Bits of the label image returned by ColorLUT.classify, one per mask that
+# perception_step uses. A pixel can carry several labels at once.
+LABEL_NAV = 1   # above all three nav thresholds, mapped as navigable terrain
+LABEL_OBS = 2   # above all three obs thresholds, see color_thresh
+LABEL_TGT = 4   # within tolerance of the gold rock color, see color_thresh(tgt=True)
+LABEL_SAND = 8  # above 2 of the 3 nav thresholds, the sand vote from get_contours
+LABEL_COL = 16  # inverted pixel above all three obs thresholds (collision roi)
+
+# Precompiled color classifier replacing the separate color_thresh / get_contours
+# threshold passes. Every per-channel threshold used by perception_step splits
+# 0-255 into a handful of bins, so each channel is first quantized to its bin
+# (one cv2.LUT pass over the image) and the 3D (r, g, b) bin index is looked up
+# in a small table of label bits. This is exact, not an approximation of the
+# thresholds, and produces a single uint8 label image per frame.
+# nav_threshold:     rgb threshold for navigable terrain (and the sand vote)
+# obs_threshold:     rgb threshold for obstacles / the collision roi
+# tgt_threshold:     gold rock color
+# tgt_tol:           +/- tolerance around tgt_threshold
+class ColorLUT():
+    def __init__(self, nav_threshold, obs_threshold, tgt_threshold, tgt_tol=(40,40,40)):
+        values = np.arange(256)
+        bins = []
+        signatures = []
+        for c in range(3):
+            nav = values > nav_threshold[c]
+            obs = values > obs_threshold[c]
+            # signed difference, the same test as color_thresh
+            tgt = np.abs(values - int(tgt_threshold[c])) < tgt_tol[c]
+            col = (255 - values) > obs_threshold[c]
+            sig = nav*1 + obs*2 + tgt*4 + col*8
+            uniq, channel_bins = np.unique(sig, return_inverse=True)
+            signatures.append(uniq)
+            bins.append(channel_bins)
+        
+        nr, ng, nb = [len(sig) for sig in signatures]
+        if nr * ng * nb > 256:
+            raise ValueError('Too many color bins for a uint8 lookup table')
+        # Pre-multiply the bin numbers by their stride so the 3D index is just
+        # the sum of the three quantized channels
+        self.axis_lut = np.zeros((1, 256, 3), dtype=np.uint8)
+        self.axis_lut[0,:,0] = bins[0] * ng * nb
+        self.axis_lut[0,:,1] = bins[1] * nb
+        self.axis_lut[0,:,2] = bins[2]
+        
+        # Combine the per-channel signatures of every (r, g, b) bin into label bits
+        sr, sg, sb = np.meshgrid(signatures[0], signatures[1], signatures[2], indexing='ij')
+        sr, sg, sb = sr.ravel(), sg.ravel(), sb.ravel()
+        every = sr & sg & sb
+        votes = (sr & 1) + (sg & 1) + (sb & 1)
+        labels = np.zeros(256, dtype=np.uint8)
+        labels[:sr.size] = (LABEL_NAV * ((every & 1) > 0)) \
+                         | (LABEL_OBS * ((every & 2) > 0)) \
+                         | (LABEL_TGT * ((every & 4) > 0)) \
+                         | (LABEL_SAND * (votes > 1)) \
+                         | (LABEL_COL * ((every & 8) > 0))
+        self.label_lut = labels
+    
+    # Label every pixel of an rgb uint8 image in one pass, masks are then just
+    # label_img & LABEL_xxx
+    def classify(self, img):
+        codes = cv2.LUT(img, self.axis_lut)
+        index = codes[:,:,0] + codes[:,:,1]
+        index += codes[:,:,2]
+        return cv2.LUT(index, self.label_lut)
+
+# Color lookup tables keyed by the thresholds they were built for
+color_luts = {}
+
+def get_color_lut(nav_threshold, obs_threshold, tgt_threshold, tgt_tol=(40,40,40)):
+    key = (tuple(nav_threshold), tuple(obs_threshold), tuple(tgt_threshold), tuple(tgt_tol))
+    lut = color_luts.get(key)
+    if lut is None:
+        lut = ColorLUT(nav_threshold, obs_threshold, tgt_threshold, tgt_tol)
+        color_luts[key] = lut
+    return lut
+
+# Binary image of the pixels brighter than the average of rgb_thresh in grayscale,
+# this is the image get_contours traces. Grayscale mixes the channels so it can't
+# come from the per-channel color lookup table.
+def wall_binary(img, rgb_thresh=(170, 170, 170)):
+    imgray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    (thresh, imbin) = cv2.threshold(imgray, np.average(rgb_thresh).astype(int), 255, cv2.THRESH_BINARY)
+    return imbin
+
+# Rover is a right wall follower, it only steers on the wall boundary pixels
+# inside this band of the warped image: x > 160 and 90 < y < 150
+WALL_BAND = (160, 90, 150)
+
+# Wall boundary finder: the sand pixels of imbin inside WALL_BAND that touch a
+# non-sand 4-neighbour, i.e. the sand/wall transition. These are the pixels
+# findContours traces around the sand there, but found with a vectorized
+# neighbour test over just the band instead of tracing every contour in the frame.
+# Unlike contour_wall, which keeps only the largest contour, it takes the
+# boundaries of every sand blob in the band (e.g. around a boulder too).
+# imbin:     binary wall image (see wall_binary)
+# band:      (x_min, y_min, y_max), pixels with x > x_min and y_min < y < y_max
+# Returns xpos, ypos of the wall boundary pixels (row-major order)
+def wall_boundary(imbin, band=WALL_BAND):
+    rows, cols = imbin.shape[0], imbin.shape[1]
+    top, bottom, left = band[1] + 1, band[2], band[0] + 1
+    # window over the band plus a one pixel ring of neighbours, zero outside the image
+    win = np.zeros((bottom - top + 2, cols - left + 2), dtype=bool)
+    r0, r1, c0 = max(top - 1, 0), min(bottom + 1, rows), max(left - 1, 0)
+    win[r0 - top + 1:r1 - top + 1, c0 - left + 1:cols - left + 1] = imbin[r0:r1, c0:cols] > 0
+    sand = win[1:-1, 1:-1]
+    interior = win[:-2, 1:-1] & win[2:, 1:-1] & win[1:-1, :-2] & win[1:-1, 2:]
+    ypos, xpos = (sand & ~interior).nonzero()
+    return xpos + left, ypos + top
+
+# Original wall finder kept as a fallback to wall_boundary: trace every contour in
+# imbin, take the largest and mask it down to the wall band.
+# Returns contour, xpos, ypos, or (None, None, None) if there are no contours
+def contour_wall(imbin, band=WALL_BAND):
+    # find the contours, CHAIN_APPROX_NONE ensures we get all points without compression.
+    # findContours modifies its source so give it a copy
+    # ([-2] picks the contours out of both the OpenCV 3 and the OpenCV 4 return)
+    contours = cv2.findContours(np.copy(imbin), cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[-2]
+    # get the biggest contour (assume that is the one that is navigable, smaller ones are likley obstables / anomolies)
+    try:
+        contour = max(contours, key = cv2.contourArea)
+    except ValueError:
+        #no controus returned... happens occasionally
+        return None, None, None
+    # mask out parts of the contour that aren't on the right wall:
+    nav_roi = contour[contour[:,:,0] > band[0]] #started at 160
+    nav_roi = nav_roi[nav_roi[:,1] > band[1]] # started at 100
+    nav_roi = nav_roi[nav_roi[:,1] < band[2]] # started at 140 
+    return contour, nav_roi[:,0], nav_roi[:,1]
+
 def rover_coords(binary_img):
     # Identify nonzero pixels
     ypos, xpos = binary_img.nonzero()
@@ -98,6 +235,53 @@ def to_polar_coords(x_pixel, y_pixel):
     angles = np.arctan2(y_pixel, x_pixel)
     return dist, angles
 
+# Rover-centric lookup tables for every pixel of an image of a given shape. The
+# warped image never changes size, so the x, y, distance and angle of each pixel
+# (same values as rover_coords_ + to_polar_coords) are built once and a mask is
+# converted by gathering its nonzero pixels out of the tables.
+# shape:      (rows, cols) of the binary images that will be gathered
+# offset:     same column offset as rover_coords_
+# step:       full resolution pixels per image pixel, so a reduced resolution
+#             image gets the same rover-centric coordinates as the full one
+class PolarTables():
+    def __init__(self, shape, offset=0, step=1):
+        rows, cols = shape[0], shape[1]
+        self.shape = (rows, cols)
+        ypos, xpos = np.mgrid[0:rows, 0:cols] * step
+        x_pixel = -(ypos - rows * step).astype(np.float64)
+        y_pixel = -(xpos - cols * step/2 + offset).astype(np.float64)
+        dist, angles = to_polar_coords(x_pixel, y_pixel)
+        self.x = x_pixel.ravel()
+        self.y = y_pixel.ravel()
+        self.dist = dist.ravel()
+        self.angles = angles.ravel()
+    
+    # x, y, dist, angles of the nonzero pixels of binary_img (in nonzero() order)
+    def gather(self, binary_img):
+        idx = np.flatnonzero(binary_img)
+        return self.x[idx], self.y[idx], self.dist[idx], self.angles[idx]
+    
+    # x, y only, for masks that are only mapped and never steered on
+    def gather_xy(self, binary_img):
+        idx = np.flatnonzero(binary_img)
+        return self.x[idx], self.y[idx]
+    
+    # x, y, dist, angles of a list of pixel positions (e.g. contour points)
+    def gather_points(self, xpos, ypos):
+        idx = ypos * self.shape[1] + xpos
+        return self.x[idx], self.y[idx], self.dist[idx], self.angles[idx]
+
+# Polar tables keyed by image shape, offset and step, shared by every perception_step
+polar_tables = {}
+
+def get_polar_tables(shape, offset=0, step=1):
+    key = (tuple(shape[:2]), offset, step)
+    tables = polar_tables.get(key)
+    if tables is None:
+        tables = PolarTables(shape, offset, step)
+        polar_tables[key] = tables
+    return tables
+
 # Define a function to map rover space pixels to world space
 def rotate_pix(xpix, ypix, yaw):
     # Convert yaw to radians
@@ -117,28 +301,187 @@ def translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale):
 
 
 # Define a function to apply rotation and translation (and clipping)
-# Once you define the two functions above this function should work
-# TODO: Modify to account for non-square worlds, i.e. world_size[0,1]
+# world_size:     side of a square world, or (rows, cols) of any world
 def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
+    rows, cols = (world_size, world_size) if np.isscalar(world_size) else world_size[:2]
     # Apply rotation
     xpix_rot, ypix_rot = rotate_pix(xpix, ypix, yaw)
     # Apply translation
     xpix_tran, ypix_tran = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
     # Perform rotation, translation and clipping all at once
-    x_pix_world = np.clip(np.int_(xpix_tran), 0, world_size - 1)
-    y_pix_world = np.clip(np.int_(ypix_tran), 0, world_size - 1)
+    x_pix_world = np.clip(np.int_(xpix_tran), 0, cols - 1)
+    y_pix_world = np.clip(np.int_(ypix_tran), 0, rows - 1)
     # Return the result
     return x_pix_world, y_pix_world
 
+# Fused projection of several rover-centric pixel sets into the world map.
+# All sets are rotated, translated and clipped in one batch and the hits are
+# accumulated as evidence counts with a single bincount scatter, instead of
+# overwriting cells with 255 one set at a time.
+# worldmap:       (rows, cols, channels) integer evidence grid or TiledWorldMap,
+#                 updated in place
+# pixel_sets:     sequence of (channel, xpix, ypix) rover-centric pixel sets
+# xpos, ypos:     rover world position
+# yaw:            rover yaw in degrees
+# scale:          rover-centric pixels per world map cell
+# Returns the flat worldmap indices (y * cols + x) * channels + channel that
+# received hits this call.
+def project_to_world(worldmap, pixel_sets, xpos, ypos, yaw, scale):
+    rows, cols, channels = worldmap.shape
+    xpix = np.concatenate([pix_set[1] for pix_set in pixel_sets])
+    ypix = np.concatenate([pix_set[2] for pix_set in pixel_sets])
+    channel = np.repeat([pix_set[0] for pix_set in pixel_sets],
+                        [len(pix_set[1]) for pix_set in pixel_sets])
+    if xpix.size == 0:
+        return np.zeros(0, dtype=np.intp)
+    # Apply rotation and translation to every set at once
+    xpix_rot, ypix_rot = rotate_pix(xpix, ypix, yaw)
+    xpix_tran, ypix_tran = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
+    # Clip each axis to its own extent so non-square worlds work too
+    x_world = np.clip(np.int_(xpix_tran), 0, cols - 1)
+    y_world = np.clip(np.int_(ypix_tran), 0, rows - 1)
+    
+    # Count the hits per cell over just the bounding box of the cells that were
+    # touched, so the cost follows the visible area and not the world size
+    x0, y0 = x_world.min(), y_world.min()
+    box_cols = x_world.max() - x0 + 1
+    counts = np.bincount(((y_world - y0) * box_cols + (x_world - x0)) * channels + channel)
+    hit = counts.nonzero()[0]
+    box_pix, hit_channel = np.divmod(hit, channels)
+    box_y, box_x = np.divmod(box_pix, box_cols)
+    cells = ((box_y + y0) * cols + (box_x + x0)) * channels + hit_channel
+    # Accumulate, saturating at the top of the worldmap dtype
+    if isinstance(worldmap, TiledWorldMap):
+        worldmap.add(cells, counts[hit])
+        return cells
+    flat_map = worldmap.reshape(-1)
+    flat_map[cells] = np.minimum(flat_map[cells] + counts[hit], np.iinfo(worldmap.dtype).max)
+    return cells
+
+# Precomputed perspective warp for one camera geometry. The homography and the
+# cv2.remap lookup maps only depend on the source / destination points and the
+# image size, so they are built once and reused for every telemetry frame.
+# src, dst:      four point calibration boxes (same as cv2.getPerspectiveTransform)
+# shape:         (rows, cols) of the camera image, output is the same size
+# roi:           optional (y0, y1, x0, x1) output window, when given only that
+#                window is warped and returned (e.g. only what downstream reads)
+class WarpPlan():
+    def __init__(self, src, dst, shape, roi=None, scale=1):
+        in_rows, in_cols = shape[0], shape[1]
+        # the output is scale times the input size, with dst scaled to match
+        rows, cols = int(in_rows * scale), int(in_cols * scale)
+        self.shape = (rows, cols)
+        self.M = cv2.getPerspectiveTransform(src, np.float32(dst * scale))
+        # For every output pixel find the source pixel it samples from, this is
+        # the same inverse mapping cv2.warpPerspective does internally each call
+        Minv = np.linalg.inv(self.M)
+        ygrid, xgrid = np.mgrid[0:rows, 0:cols].astype(np.float64)
+        w = Minv[2,0]*xgrid + Minv[2,1]*ygrid + Minv[2,2]
+        w[w == 0] = np.inf
+        mapx = (Minv[0,0]*xgrid + Minv[0,1]*ygrid + Minv[0,2]) / w
+        mapy = (Minv[1,0]*xgrid + Minv[1,1]*ygrid + Minv[1,2]) / w
+        
+        # Output pixels that sample from outside the camera image are always
+        # black, so only the bounding box of the pixels that can see the image
+        # needs to be remapped each frame. Bilinear sampling reaches one pixel
+        # past the border so keep that margin.
+        valid = (mapx > -1) & (mapx < in_cols) & (mapy > -1) & (mapy < in_rows)
+        if roi is None:
+            roi = (0, rows, 0, cols)
+        self.roi = roi
+        y0, y1, x0, x1 = roi
+        # warped pixels the camera actually sees (everything else is black fill)
+        self.footprint = valid[y0:y1, x0:x1] & (mapx[y0:y1, x0:x1] >= 0) & (mapy[y0:y1, x0:x1] >= 0) & \
+                         (mapx[y0:y1, x0:x1] <= in_cols - 1) & (mapy[y0:y1, x0:x1] <= in_rows - 1)
+        valid_rows = valid[y0:y1, x0:x1].any(axis=1).nonzero()[0]
+        valid_cols = valid[y0:y1, x0:x1].any(axis=0).nonzero()[0]
+        if valid_rows.size:
+            self.box = (valid_rows[0], valid_rows[-1] + 1, valid_cols[0], valid_cols[-1] + 1)
+            by0, by1, bx0, bx1 = self.box
+            # fixed point maps are what warpPerspective uses and remap fastest
+            self.map1, self.map2 = cv2.convertMaps(
+                mapx[y0:y1, x0:x1][by0:by1, bx0:bx1].astype(np.float32),
+                mapy[y0:y1, x0:x1][by0:by1, bx0:bx1].astype(np.float32),
+                cv2.CV_16SC2)
+        else:
+            self.box = None
+    
+    # Warp img with the precomputed maps, returns the (roi sized) warped image
+    def warp(self, img):
+        y0, y1, x0, x1 = self.roi
+        warped = np.zeros((y1 - y0, x1 - x0) + img.shape[2:], dtype=img.dtype)
+        if self.box is not None:
+            by0, by1, bx0, bx1 = self.box
+            warped[by0:by1, bx0:bx1] = cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR,
+                                                 borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return warped
+
+# Warp plans keyed by camera geometry (src, dst, image size, roi and scale)
+warp_plans = {}
+
+def get_warp_plan(src, dst, shape, roi=None, scale=1):
+    src = np.float32(src)
+    dst = np.float32(dst)
+    key = (src.tobytes(), dst.tobytes(), tuple(shape[:2]), roi, scale)
+    plan = warp_plans.get(key)
+    if plan is None:
+        plan = WarpPlan(src, dst, shape, roi, scale)
+        warp_plans[key] = plan
+    return plan
+
 # Define a function to perform a perspective transform
-def perspect_transform(img, src, dst):
-           
-    M = cv2.getPerspectiveTransform(src, dst)
-    warped = cv2.warpPerspective(img, M, (img.shape[1], img.shape[0]))# keep same size as input image
+# roi:      optional (y0, y1, x0, x1) output window to warp, see WarpPlan
+# scale:    output size relative to the input (0.5 warps at half resolution)
+def perspect_transform(img, src, dst, roi=None, scale=1):
+    # getPerspectiveTransform and the remap lookup maps are only computed the
+    # first time a given geometry is seen, see get_warp_plan
+    plan = get_warp_plan(src, dst, img.shape, roi, scale)
+    warped = plan.warp(img) # keep same size as input image
     
     return warped
 
 
+# Memo of perception stage results for parameter sweeps (see sweep.py), which
+# run many configurations over the same recorded frames. A stage result is
+# keyed by the frame and just the parameters that stage depends on, so e.g. a
+# frame is warped once for every configuration and labelled once per set of
+# color thresholds. Only the current frame's results are kept. Cached arrays
+# are shared between configurations and must not be written to.
+class StageCache():
+    def __init__(self):
+        self.frame = None
+        self.results = {} # (stage, frame, params) -> (result, seconds it took)
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0. # seconds of stage work skipped by hits, since last reset
+
+    # Move on to another frame, dropping the results of the previous one
+    def start_frame(self, frame):
+        if frame != self.frame:
+            self.frame = frame
+            self.results = {}
+
+    # Result of stage for the current frame and params, computed by compute()
+    # on a miss
+    def get(self, stage, params, compute):
+        key = (stage, self.frame, params)
+        entry = self.results.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.saved += entry[1]
+            return entry[0]
+        self.misses += 1
+        start = time.perf_counter()
+        result = compute()
+        self.results[key] = (result, time.perf_counter() - start)
+        return result
+
+# Run a perception stage through the cache, if there is one
+def cached_stage(cache, stage, params, compute):
+    if cache is None:
+        return compute()
+    return cache.get(stage, params, compute)
+
 # Apply the above functions in succession and update the Rover state accordingly
 def perception_step(Rover):
     # Perform perception steps to update Rover()
@@ -148,49 +491,84 @@ def perception_step(Rover):
     source = np.float32([[13,140], [302,140], [200,96], [118,96]])  #four pixel coords from source image
     destination = np.float32([[155,155],[165,155],[165,145],[155,145]]) #four pixel coords from dest image
     
+    # Stage timings go to the instrumentation ring buffers (see instrumentation.py)
+    t_start = time.perf_counter()
+
+    # Under load (see quality.py) perception runs on a half resolution warp, where
+    # each pixel stands for step x step full resolution pixels
+    step = 2 if Rover.quality_level >= QUALITY_HALF_RES else 1
+
+    # A rock being picked up is gone once the pickup is over. The rover is
+    # stopped while picking up, so this goes before the unchanged frame check
+    if Rover.rock_tracker is not None and Rover.picking_up:
+        Rover.rock_tracker.reset()
+        Rover.rock_target = None
+
+    # A frame that looks the same as the last processed one (the rover is
+    # stopped) keeps the previous results and adds nothing to the map, see
+    # frame_change.py. The path search still gets its frame of work, it is
+    # spread over frames and a pickup changes the goal.
+    detector = Rover.frame_change
+    if detector is not None and detector.unchanged(Rover, step):
+        detector.skip()
+        t_skip = time.perf_counter()
+        metrics.record('perception.skip', t_skip - t_start)
+        if Rover.route is not None:
+            Rover.route.update(Rover)
+            metrics.record('perception.plan', time.perf_counter() - t_skip)
+        return Rover
+
+    # Stage results can be shared with other configurations run over the same
+    # frame (see StageCache), None when driving
+    cache = Rover.stage_cache
+
     # 2) Apply perspective transform
-    warped = perspect_transform(Rover.img, source, destination)
-    
-    # change [:,:] to mask out portions of warped image if desired
-    roi = np.copy(warped[:, :])  #120, 60:220 worked good for fidelity but mapped slowly so stopped using.
+    warped = cached_stage(cache, 'warp', (step,),
+                          lambda: perspect_transform(Rover.img, source, destination, scale=1./step))
+    t_warp = time.perf_counter()
+    metrics.record('perception.warp', t_warp - t_start)
     
     # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
     #GOLD ROCK ~ rgb = 189,144,19 --> 213,183,25 --> 255,219,54
     #OBSTACLES ~ rgb = 13,0,0
-    nav_threshold = (190, 180, 160)
-    tgt_threshold = (185, 140, 15)
-    obs_threshold = (100, 100, 100)
-    tgt_img = color_thresh(warped, tgt_threshold, tgt=True) # used for finding colored rocks
-    obs_img = color_thresh(warped, obs_threshold) # used for finding obstacles
-    threshedroi = color_thresh(roi, nav_threshold)   # color threshed roi for mapping.
+    # (thresholds are tuned on Rover, see RoverState)
+    nav_threshold = Rover.nav_threshold
+    tgt_threshold = Rover.tgt_threshold
+    obs_threshold = Rover.obs_threshold
+    # Label every warped pixel once, each mask below is a cheap bit test on the labels
+    labels = cached_stage(cache, 'labels', (step, nav_threshold, obs_threshold, tgt_threshold),
+                          lambda: get_color_lut(nav_threshold, obs_threshold, tgt_threshold).classify(warped))
+    tgt_img = labels & LABEL_TGT # used for finding colored rocks
+    obs_img = labels & LABEL_OBS # used for finding obstacles
+    # change [:,:] to mask out portions of warped image if desired
+    threshedroi = labels[:, :] & LABEL_NAV   # color threshed roi for mapping. 120, 60:220 worked good for fidelity but mapped slowly so stopped using.
     
     # Below determines the array used for detecting and trying to prevent collisions
-    # it masks off only the section right in front of the rover.
-    coll_roi = np.copy(warped[130:150, 150:170])
-    coll_roi = cv2.bitwise_not(coll_roi)
-    coll_roi = color_thresh(coll_roi,obs_threshold)
-    
-
-    
+    # it masks off only the section right in front of the rover (obstacles in the inverted image).
+    coll_roi = labels[130//step:150//step, 150//step:170//step] & LABEL_COL
+    t_classify = time.perf_counter()
+    metrics.record('perception.classify', t_classify - t_warp)
 
     # 3.5) Retrieve the contours for determining navigation
-    cont_source = np.copy(warped)
-    nav_img, imbin, contours= get_contours(cont_source, nav_threshold)
-    # get the biggest contour (assume that is the one that is navigable, smaller ones are likley obstables / anomolies)
+    # warped is a fresh image every frame, so the HUD can draw straight onto it
+    # (unless it is shared through the stage cache)
+    cont_source = warped if cache is None else warped.copy()
+    nav_img = labels & LABEL_SAND
+    # Find the wall boundary pixels (w stands for wall here), either with the band
+    # scan or with the original full frame contour trace
+    band = tuple(edge // step for edge in Rover.wall_band)
+    def find_wall():
+        imbin = wall_binary(warped, nav_threshold)
+        if Rover.wall_method == 'contour':
+            return (imbin,) + contour_wall(imbin, band)
+        return (imbin, None) + wall_boundary(imbin, band)
+    imbin, contour, xpos_w, ypos_w = cached_stage(cache, 'wall', (step, nav_threshold, band, Rover.wall_method),
+                                                  find_wall)
     # if no contours present, then return and hope we can pick one up next scan. Pickle logic will kick in eventually
-    try:
-        contour = max(contours, key = cv2.contourArea)
-    except:
-        #no controus returned... happens occasionally
+    if Rover.wall_method == 'contour' and contour is None:
         return Rover
-    
-    # Rover is a right wall follower, so mask out parts of the contour
-    # that aren't on the right wall:
-    nav_roi = contour[contour[:,:,0] > 160] #started at 160
-    nav_roi = nav_roi[nav_roi[:,1] > 90] # started at 100
-    nav_roi = nav_roi[nav_roi[:,1] < 150] # started at 140 
-    xpos_w, ypos_w = nav_roi[:,0], nav_roi[:,1] #Separate out into x & y pixels (w stands for wall here)
-    imbin_inv = np.invert(imbin)
+    t_wall = time.perf_counter()
+    metrics.record('perception.wall', t_wall - t_classify)
     
     # 4) Update Rover.vision_image (this will be displayed on left side of screen)
     #This step taken care of further down after adding some more HUD info to the image
@@ -200,79 +578,103 @@ def perception_step(Rover):
 
      
     # 5) Convert map image pixel values to rover-centric coords
-    
-    xpix_rvr_nav, ypix_rvr_nav = rover_coords(nav_img)
-    
-    xpix_rvr_tgt, ypix_rvr_tgt = rover_coords(tgt_img) #for rock targets
-    xpix_rvr_obs, ypix_rvr_obs = rover_coords(obs_img) #for obstacles
-    xpix_rvr_msk, ypix_rvr_msk = rover_coords(threshedroi) #for mappinig
-    xpix_rvr_wal, ypix_rvr_wal = rover_coords_(xpos_w, ypos_w, imbin, -3)   #for navigation (contour roi points in rover coordinates)
-    xpix_rvr_col, ypix_rvr_col = rover_coords(coll_roi)                          # -10 kept rover too far from wall
+    # Every pixel's rover-centric position and polar coords are precomputed (see
+    # PolarTables) so each mask is just a gather of its nonzero pixels.
+    tables = get_polar_tables(warped.shape, step=step)
+    xpix_rvr_nav, ypix_rvr_nav, nav_dists, nav_angles = tables.gather(nav_img)
+    
+    xpix_rvr_tgt, ypix_rvr_tgt, tgt_dists, tgt_angles = tables.gather(tgt_img) #for rock targets
+    xpix_rvr_obs, ypix_rvr_obs = tables.gather_xy(obs_img) #for obstacles
+    xpix_rvr_msk, ypix_rvr_msk = tables.gather_xy(threshedroi) #for mappinig
+    #for navigation (contour roi points in rover coordinates), -10 kept rover too far from wall
+    xpix_rvr_wal, ypix_rvr_wal, wal_dists, wal_angles = get_polar_tables(imbin.shape, -3, step).gather_points(xpos_w, ypos_w)
+    xpix_rvr_col, ypix_rvr_col, col_dists, col_angles = get_polar_tables(coll_roi.shape, step=step).gather(coll_roi)
+    if step > 1:
+        # decision_step thresholds are full resolution pixel counts, so count
+        # each area pixel step x step times (means are unchanged). The wall is
+        # a line, its pixels are only used for means.
+        nav_dists, nav_angles = np.repeat(nav_dists, step*step), np.repeat(nav_angles, step*step)
+        tgt_dists, tgt_angles = np.repeat(tgt_dists, step*step), np.repeat(tgt_angles, step*step)
+        col_dists, col_angles = np.repeat(col_dists, step*step), np.repeat(col_angles, step*step)
+    t_gather = time.perf_counter()
+    metrics.record('perception.gather', t_gather - t_wall)
 
     
     # 6) Convert rover-centric pixel values to world coordinates)
     xpos, ypos = Rover.pos
     yaw = Rover.yaw
-    world_size = Rover.worldmap.shape[0]
     scale = 100
-    #xpix_wrld_nav, ypix_wrld_nav = pix_to_world(xpix_rvr_nav, ypix_rvr_nav, xpos, ypos, yaw, world_size, scale)
-    xpix_wrld_tgt, ypix_wrld_tgt = pix_to_world(xpix_rvr_tgt, ypix_rvr_tgt, xpos, ypos, yaw, world_size, scale)
-    xpix_wrld_obs, ypix_wrld_obs = pix_to_world(xpix_rvr_obs, ypix_rvr_obs, xpos, ypos, yaw, world_size, scale)
-    xpix_wrld_msk, ypix_wrld_msk = pix_to_world(xpix_rvr_msk, ypix_rvr_msk, xpos, ypos, yaw, world_size, scale)
+
+    # Track the nearest rock for sample mode (see rock_detector.py)
+    if Rover.rock_tracker is not None:
+        Rover.rock_target = Rover.rock_tracker.update(tgt_img, xpos, ypos, yaw, step)
     
     # 7) Update Rover worldmap (to be displayed on right side of screen)
-        # Example: Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] += 1
-        #          Rover.worldmap[rock_y_world, rock_x_world, 1] += 1
-        #          Rover.worldmap[navigable_y_world, navigable_x_world, 2] += 1
-    
+    # When running at reduced quality the map is only updated every
+    # Rover.map_every frames
+    tolerance = Rover.map_tolerance
+    Rover.perception_count += 1
+    map_frame = Rover.quality_level < QUALITY_SPARSE_MAP or Rover.perception_count % Rover.map_every == 0
+    cells = None
+    if Rover.occupancy is not None:
+        # Log-odds fusion (see occupancy.py): navigable pixels are evidence for
+        # navigable cells and every other pixel the camera sees for obstacle
+        # cells, weighted by distance and by how level the rover is
+        weight = attitude_weight(Rover.roll, Rover.pitch, tolerance)
+        if map_frame and weight > 0:
+            seen = get_warp_plan(source, destination, Rover.img.shape, None, 1./step).footprint
+            cells = Rover.occupancy.fuse(threshedroi, seen, (xpix_rvr_tgt, ypix_rvr_tgt), tables,
+                                         xpos, ypos, yaw, scale, weight, block=4//step)
+            if Rover.map_stats is not None:
+                Rover.map_stats.update(Rover.worldmap, cells, Rover.samples_pos)
+    # Obstacles, rocks and navigable terrain are projected together and each
+    # cell counts how many times it was seen in that class (channels 0, 1, 2)
     # Only if roll and pitch are within tolerance (roll, pitch)
-    tolerance = (1.5,1)
-    if ((Rover.roll < tolerance[0]) or \
+    elif map_frame and ((Rover.roll < tolerance[0]) or \
        (Rover.roll > (360.0 - tolerance[0]))) and \
        ((Rover.pitch < tolerance[1]) or \
        (Rover.pitch > (360.0 - tolerance[1]))):
         
-        Rover.worldmap[ypix_wrld_obs.astype(int), xpix_wrld_obs.astype(int), 0] = 255
-        Rover.worldmap[ypix_wrld_tgt.astype(int), xpix_wrld_tgt.astype(int), 1] = 255
-        Rover.worldmap[ypix_wrld_msk.astype(int), xpix_wrld_msk.astype(int), 2] = 255
+        cells = project_to_world(Rover.worldmap,
+                                 ((0, xpix_rvr_obs, ypix_rvr_obs),
+                                  (1, xpix_rvr_tgt, ypix_rvr_tgt),
+                                  (2, xpix_rvr_msk, ypix_rvr_msk)),
+                                 xpos, ypos, yaw, scale)
+        # Keep the map statistics up to date from just the cells that changed
+        if Rover.map_stats is not None:
+            Rover.map_stats.update(Rover.worldmap, cells, Rover.samples_pos)
+    # Cluster this frame's rock detections into rock candidates (see rock_index.py)
+    if Rover.rocks is not None and cells is not None:
+        Rover.rocks.add(cells[cells % 3 == 1] // 3, (xpos, ypos, yaw), Rover.total_time)
+    # Keep the exploration frontiers up to date from the cells that changed and
+    # point decision_step at the nearest one (see exploration.py)
+    if Rover.frontiers is not None:
+        if cells is not None:
+            Rover.frontiers.update(Rover.worldmap, cells)
+        Rover.frontier_heading = Rover.frontiers.heading(xpos, ypos, yaw)
+    t_map = time.perf_counter()
+    metrics.record('perception.map', t_map - t_gather)
+    # Repair the path to the current goal (a rock or the start) for the plan
+    # mode of decision_step (see path_planner.py)
+    if Rover.route is not None:
+        Rover.route.update(Rover, cells)
+        metrics.record('perception.plan', time.perf_counter() - t_map)
 
     # 8) Convert rover-centric pixel positions to polar coordinates
     # Update Rover pixel distances and angles
-    Rover.wal_dists, Rover.wal_angles = to_polar_coords(xpix_rvr_wal, ypix_rvr_wal)
-    Rover.nav_dists, Rover.nav_angles = to_polar_coords(xpix_rvr_nav, ypix_rvr_nav)
-    Rover.tgt_dists, Rover.tgt_angles = to_polar_coords(xpix_rvr_tgt, ypix_rvr_tgt)
-    Rover.col_dists, Rover.col_angles = to_polar_coords(xpix_rvr_col, ypix_rvr_col)
-    
-    # update an image to include our navigation data on HUD
-    # Draw the entire contour on imgwcontour
-    imgwcontour = cv2.drawContours(cont_source, contour,-1, (255,0,0), 1)
-    
-    # highlight the wall pixels we are navigating to 
-    #(should match up exactly with a portion of the contour drawn above)
-    imgwcontour[ypos_w,xpos_w, 1:2] = 255
-    
-    # (Show the current nav angle to the wall pixels
-    cv2.putText(imgwcontour,"NavAngle To Wall: " + str(np.mean(Rover.wal_angles * 180/np.pi))[:4], (0, 20), 
-                  cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
-    
-    # Show the average distances to the masked wall pixels. [:4] limits the string to 3 significant digits
-    cv2.putText(imgwcontour,"NavPixels: " + str(len(Rover.nav_dists)), (0, 40), 
-                  cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
-    
-
-    cv2.putText(imgwcontour,"Mode: " + Rover.mode, (0, 60), 
-                cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
-    cv2.putText(imgwcontour,"Pickle: " + str(Rover.pickle), (0, 80), 
-                cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
-    cv2.putText(imgwcontour,"col_pix: " + str(Rover.col_angles.size), (0, 100), 
-                cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
-    cv2.putText(imgwcontour,"near_sample: " + str(Rover.near_sample), (0, 120), 
-                cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
-    if tgt_img.any():
-        cv2.putText(imgwcontour,"SAMPLE DETECTED", (0, 140),
-                cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
-    #imgwcontour[obs_nav_xpix.astype(int), obs_nav_ypix.astype(int), 0:2] = 255
-    Rover.vision_image = imgwcontour
-    
+    # (already gathered from the polar tables in step 5)
+    Rover.wal_dists, Rover.wal_angles = wal_dists, wal_angles
+    Rover.nav_dists, Rover.nav_angles = nav_dists, nav_angles
+    Rover.tgt_dists, Rover.tgt_angles = tgt_dists, tgt_angles
+    Rover.col_dists, Rover.col_angles = col_dists, col_angles
+    
+    # Keep what the HUD needs, it is drawn later by draw_hud (supporting_functions)
+    # only on the frames where the output images are actually rendered.
+    # warped is a fresh image every frame so nothing here needs copying.
+    Rover.hud_source = cont_source
+    Rover.hud_contour = contour
+    Rover.hud_wall = (xpos_w, ypos_w)
+    if detector is not None:
+        detector.processed()
     
     return Rover
\ No newline at end of file
@@ -0,0 +1,91 @@
+# Pipelined control loop
+#
+# In the default mode the telemetry handler decodes, runs perception and
+# decision and renders the insets before it replies, all inside the eventlet
+# greenthread, so the CPU work stalls the socket loop and replies go out late.
+# In pipelined mode the handler only drops the message into a one-slot mailbox
+# and immediately replies with the freshest decision available. A worker
+# thread runs the control step on the latest message; messages that arrive
+# while it is busy replace the waiting one (latest frame wins) and are counted
+# as dropped.
+import threading
+from collections import namedtuple
+
+from event_log import log, WARNING
+from instrumentation import metrics
+
+# What to send back for a telemetry frame: a pickup command, or the drive
+# commands (throttle, brake, steer) with the two inset image strings
+Reply = namedtuple('Reply', ['pickup', 'commands', 'image1', 'image2'])
+
+# Reply before the first frame has been processed (or for invalid telemetry)
+idle_reply = Reply(False, (0, 0, 0), '', '')
+
+# Runs a control step on a worker thread with a latest-frame-wins mailbox
+# step:     function of a telemetry message returning a Reply, only ever
+#           called from the worker thread
+class ControlPipeline():
+    def __init__(self, step):
+        self.step = step
+        self.received = 0  # telemetry messages submitted
+        self.processed = 0 # control steps completed
+        self.dropped = 0   # messages replaced in the mailbox before being processed
+        self.reused = 0    # replies that repeated an already sent decision
+        self.errors = 0    # control steps that raised
+        self._reply = idle_reply
+        self._reply_id = 0 # id of the latest reply, and of the last one sent
+        self._sent_id = 0
+        self._pending = None
+        self._busy = False
+        self._wake = threading.Condition()
+        self._worker = threading.Thread(target=self._run, name='control-pipeline')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while self._pending is None:
+                    self._wake.wait()
+                data, self._pending = self._pending, None
+                self._busy = True
+            try:
+                with metrics.timed('pipeline.step'):
+                    reply = self.step(data)
+            except Exception as e:
+                # keep the last good decision, the next frame gets a new try
+                log.event('pipeline_error', WARNING, every=1., error=repr(e))
+                reply = None
+            with self._wake:
+                self._busy = False
+                if reply is None:
+                    self.errors += 1
+                else:
+                    self._reply = reply
+                    self._reply_id += 1
+                    self.processed += 1
+
+    # Hand a telemetry message to the worker, returns the reply to send now
+    # and whether it is a new decision (a pickup is only sent once)
+    def submit(self, data):
+        with self._wake:
+            self.received += 1
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = data
+            self._wake.notify()
+            fresh = self._reply_id != self._sent_id
+            if not fresh:
+                self.reused += 1
+            self._sent_id = self._reply_id
+            return self._reply, fresh
+
+    # Frames waiting in the mailbox plus the one being processed
+    @property
+    def queue_depth(self):
+        return int(self._pending is not None) + int(self._busy)
+
+    def stats(self):
+        return {'received': self.received, 'processed': self.processed,
+                'dropped': self.dropped, 'reused': self.reused, 'errors': self.errors,
+                'queue_depth': self.queue_depth}
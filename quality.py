@@ -0,0 +1,68 @@
+# Adaptive quality under a per-frame latency budget
+#
+# When the control step keeps running over budget the loop steps down through
+# the quality levels below, each one keeping the savings of the ones before it,
+# and steps back up once there is headroom again. The cheapest losses come
+# first: the inset images are only cosmetic and the map can fill in a little
+# later, while the half resolution warp coarsens what decision_step steers on.
+import numpy as np
+
+from event_log import log, INFO
+
+QUALITY_FULL = 0       # everything every frame
+QUALITY_NO_HUD = 1     # inset images (HUD and map display) not rendered or sent
+QUALITY_SPARSE_MAP = 2 # worldmap updated only every Rover.map_every frames
+QUALITY_HALF_RES = 3   # perception on a half resolution warp
+
+quality_names = {QUALITY_FULL: 'full', QUALITY_NO_HUD: 'no hud',
+                 QUALITY_SPARSE_MAP: 'sparse map', QUALITY_HALF_RES: 'half res'}
+
+# Chooses Rover.quality_level from the measured control step times
+# budget:       per-frame latency budget in seconds
+# headroom:     step back up only while the smoothed time is below
+#               headroom * budget
+# patience:     consecutive smoothed frames over budget before stepping down
+# recover:      consecutive frames with headroom before stepping back up
+# smoothing:    weight of the newest frame in the smoothed frame time
+# max_level:    lowest quality allowed
+class QualityController():
+    def __init__(self, budget=0.04, headroom=0.6, patience=5, recover=50, smoothing=0.2,
+                 max_level=QUALITY_HALF_RES):
+        self.budget = budget
+        self.headroom = headroom
+        self.patience = patience
+        self.recover = recover
+        self.smoothing = smoothing
+        self.max_level = max_level
+        self.level = QUALITY_FULL
+        self.frame_time = None # smoothed control step time
+        self.over = 0
+        self.under = 0
+
+    # Fold in the time dt the last control step took and set Rover.quality_level
+    def update(self, Rover, dt):
+        if self.frame_time is None or not np.isfinite(self.frame_time):
+            self.frame_time = dt
+        else:
+            self.frame_time += self.smoothing * (dt - self.frame_time)
+        level = self.level
+        if self.frame_time > self.budget:
+            self.over += 1
+            self.under = 0
+            if self.over >= self.patience and self.level < self.max_level:
+                self.level += 1
+                self.over = 0
+        elif self.frame_time < self.headroom * self.budget:
+            self.under += 1
+            self.over = 0
+            if self.under >= self.recover and self.level > QUALITY_FULL:
+                self.level -= 1
+                self.under = 0
+        else:
+            self.over = 0
+            self.under = 0
+        if self.level != level:
+            log.event('quality', INFO, was=quality_names[level], now=quality_names[self.level],
+                      frame_ms=1e3 * self.frame_time)
+        Rover.quality_level = self.level
+        return self.level
@@ -0,0 +1,178 @@
+# Append-only run recording: raw camera frames in a preallocated memory-mapped
+# uint8 array and the telemetry of each frame in a structured array next to it.
+#
+# A recording folder holds one or more segments, frames_000.npy and
+# telemetry_000.npy, frames_001.npy ... Both are plain .npy files so they can
+# also be opened with np.load(path, mmap_mode='r'). A telemetry row is marked
+# valid only after its frame has been written, so a reader never sees a
+# partially written frame, even while the run is still being recorded.
+import glob
+import os
+
+import numpy as np
+
+# Telemetry stored for each recorded frame. throttle, brake and steer are the
+# commands sent back to the rover for that frame.
+telemetry_dtype = np.dtype([('valid', np.uint8), ('time', np.float64),
+                            ('vel', np.float32), ('x', np.float32), ('y', np.float32),
+                            ('yaw', np.float32), ('pitch', np.float32), ('roll', np.float32),
+                            ('throttle', np.float32), ('brake', np.float32), ('steer', np.float32),
+                            ('near_sample', np.uint8), ('picking_up', np.uint8),
+                            ('samples_collected', np.int16)])
+
+# Define a function to build the file names of a recording segment
+def segment_paths(folder, segment):
+    return (os.path.join(folder, 'frames_{:03d}.npy'.format(segment)),
+            os.path.join(folder, 'telemetry_{:03d}.npy'.format(segment)))
+
+# Define a function to shrink a preallocated .npy file to its first count rows:
+# the header is rewritten in place (a smaller shape never needs more room) and
+# the file is truncated, so a short run doesn't leave a full size sparse file
+# behind that turns into real bytes when it is copied
+def shrink_npy(path, count):
+    with open(path, 'r+b') as npy:
+        version = np.lib.format.read_magic(npy)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npy)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npy)
+        data_start = npy.tell()
+        header_start = 8 + (2 if version == (1, 0) else 4)
+        header = "{'descr': %r, 'fortran_order': %r, 'shape': %r, }" % (
+                 np.lib.format.dtype_to_descr(dtype), fortran_order, (count,) + tuple(shape[1:]))
+        npy.seek(header_start)
+        npy.write((header.ljust(data_start - header_start - 1) + '\n').encode('latin1'))
+        npy.truncate(data_start + count * int(np.prod(shape[1:])) * dtype.itemsize)
+
+# Writes a run to a recording folder
+# folder:        recording folder, created if needed
+# capacity:      frames per segment. The files are preallocated (sparse on
+#                most filesystems) and a new segment is started when one fills
+# frame_shape:   shape of the camera frames
+# The known sample positions (Rover.samples_pos) go to samples_pos.npy, for the
+# located statistics of a replay
+class RunRecorder():
+    def __init__(self, folder, capacity=30000, frame_shape=(160, 320, 3)):
+        self.folder = folder
+        self.capacity = capacity
+        self.frame_shape = tuple(frame_shape)
+        self.segment = -1
+        self.count = 0 # frames written to the current segment
+        self.frames = None
+        self.telemetry = None
+        self.samples_saved = False
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self._next_segment()
+
+    def _next_segment(self):
+        self.close_segment()
+        self.segment += 1
+        frames_path, telemetry_path = segment_paths(self.folder, self.segment)
+        self.frames = np.lib.format.open_memmap(frames_path, mode='w+', dtype=np.uint8,
+                                                shape=(self.capacity,) + self.frame_shape)
+        self.telemetry = np.lib.format.open_memmap(telemetry_path, mode='w+', dtype=telemetry_dtype,
+                                                   shape=(self.capacity,))
+        self.count = 0
+
+    # Append the current camera image and telemetry of Rover
+    def append(self, Rover):
+        if self.count == self.capacity:
+            self._next_segment()
+        if not self.samples_saved and Rover.samples_pos is not None:
+            np.save(os.path.join(self.folder, 'samples_pos.npy'),
+                    np.array(Rover.samples_pos, dtype=np.float64).reshape(2, -1))
+            self.samples_saved = True
+        self.frames[self.count] = Rover.img
+        row = self.telemetry[self.count]
+        row['time'] = Rover.total_time
+        row['vel'] = Rover.vel
+        row['x'], row['y'] = Rover.pos[0], Rover.pos[1]
+        row['yaw'], row['pitch'], row['roll'] = Rover.yaw, Rover.pitch, Rover.roll
+        row['throttle'], row['brake'], row['steer'] = Rover.throttle, Rover.brake, Rover.steer
+        row['near_sample'] = Rover.near_sample
+        row['picking_up'] = Rover.picking_up
+        row['samples_collected'] = Rover.samples_collected
+        # mark the row valid last so readers only see complete frames
+        self.telemetry['valid'][self.count] = 1
+        self.count += 1
+
+    def flush(self):
+        if self.frames is not None:
+            self.frames.flush()
+            self.telemetry.flush()
+
+    # Unmap the current segment and shrink its files to the frames written
+    def close_segment(self):
+        if self.frames is None:
+            return
+        self.flush()
+        self.frames = None
+        self.telemetry = None
+        if self.count < self.capacity:
+            frames_path, telemetry_path = segment_paths(self.folder, self.segment)
+            shrink_npy(frames_path, self.count)
+            shrink_npy(telemetry_path, self.count)
+
+    def close(self):
+        self.close_segment()
+
+# Reads a recording folder. frames(segment) and telemetry(segment) are read-only
+# memory-mapped views of the valid part of a segment (no copies), and a
+# recording can be indexed as one sequence of (frame, telemetry) pairs.
+# samples_pos is the (xs, ys) of the known samples, None if not recorded.
+class RunReader():
+    def __init__(self, folder):
+        self.folder = folder
+        n_segments = len(glob.glob(os.path.join(folder, 'telemetry_*.npy')))
+        self._frames = []
+        self._telemetry = []
+        for segment in range(n_segments):
+            frames_path, telemetry_path = segment_paths(folder, segment)
+            self._frames.append(np.load(frames_path, mmap_mode='r'))
+            self._telemetry.append(np.load(telemetry_path, mmap_mode='r'))
+        self.samples_pos = None
+        samples_path = os.path.join(folder, 'samples_pos.npy')
+        if os.path.exists(samples_path):
+            samples = np.load(samples_path)
+            self.samples_pos = (samples[0], samples[1])
+        self.refresh()
+
+    # Recount the valid frames (e.g. while the run is still being recorded)
+    def refresh(self):
+        self.counts = []
+        for telemetry in self._telemetry:
+            valid = telemetry['valid']
+            # rows are written in order, so the valid ones are a prefix
+            self.counts.append(int(np.argmin(valid)) if not valid.all() else len(valid))
+        self.starts = np.cumsum([0] + self.counts)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    @property
+    def n_segments(self):
+        return len(self._frames)
+
+    def frames(self, segment=0):
+        return self._frames[segment][:self.counts[segment]]
+
+    def telemetry(self, segment=0):
+        return self._telemetry[segment][:self.counts[segment]]
+
+    # (frame, telemetry row) of frame i of the whole recording
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('frame index out of range')
+        segment = int(np.searchsorted(self.starts, i, side='right')) - 1
+        offset = i - self.starts[segment]
+        return self._frames[segment][offset], self._telemetry[segment][offset]
+
+    # Telemetry of the whole recording as one array (copied if there are
+    # several segments)
+    def all_telemetry(self):
+        if self.n_segments == 1:
+            return self.telemetry(0)
+        return np.concatenate([self.telemetry(s) for s in range(self.n_segments)])
@@ -0,0 +1,266 @@
+# Offline replay of a recorded run through the real perception and decision steps
+#
+# A recorded run is either a folder recorded by drive_rover.py in the
+# memory-mapped format (see recorder.py), or a folder with the simulator's
+# training mode log (robot_log.csv, ';' separated, one row per camera frame in
+# IMG/), so runs can be evaluated without the simulator, and much faster than
+# real time.
+#
+# Example: $ python replay.py ../recordings/run1 --workers 4
+import argparse
+import contextlib
+import csv
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+import matplotlib.image as mpimg
+
+from perception import perception_step
+from decision import decision_step
+from supporting_functions import convert_to_float, map_statistics
+from rover_state import RoverState, load_ground_truth
+from recorder import RunReader
+from event_log import log
+from occupancy import OccupancyGrid
+
+# Fields of the per-frame replay output
+frame_dtype = np.dtype([('frame', np.int32), ('mode', 'U8'),
+                        ('throttle', np.float32), ('brake', np.float32), ('steer', np.float32),
+                        ('nav_pix', np.int32), ('nav_angle', np.float32),
+                        ('wal_angle', np.float32), ('tgt_pix', np.int32)])
+
+# Define a function to load the telemetry of a recorded run
+# run_folder:    memory-mapped recording folder, or folder holding robot_log.csv.
+#                Image paths in the log are taken relative to it if they don't
+#                exist as given
+# fps:           recording rate, used to rebuild the elapsed time of each frame
+#                of a robot_log.csv run
+# Returns a dict of per-frame arrays, and the known sample positions
+# ('samples_pos', None if the recording doesn't have them)
+def load_run(run_folder, fps=25.):
+    if os.path.exists(os.path.join(run_folder, 'telemetry_000.npy')):
+        reader = RunReader(run_folder)
+        telemetry = reader.all_telemetry()
+        run = {'recording': run_folder, 'n_frames': len(telemetry), 'time': np.array(telemetry['time']),
+               'samples_pos': reader.samples_pos}
+        for field in ('vel', 'x', 'y', 'yaw', 'pitch', 'roll', 'throttle', 'steer'):
+            run[field] = np.array(telemetry[field], dtype=np.float64)
+        return run
+
+    log_path = os.path.join(run_folder, 'robot_log.csv')
+    with open(log_path) as log_file:
+        rows = list(csv.DictReader(log_file, delimiter=';'))
+    paths = []
+    for row in rows:
+        path = row['Path']
+        if not os.path.exists(path):
+            path = os.path.join(run_folder, 'IMG', os.path.basename(path.replace('\\', '/')))
+        paths.append(path)
+    run = {'paths': paths, 'n_frames': len(rows), 'time': np.arange(len(rows)) / fps, 'samples_pos': None}
+    for field, column in (('vel', 'Speed'), ('x', 'X_Position'), ('y', 'Y_Position'),
+                          ('yaw', 'Yaw'), ('pitch', 'Pitch'), ('roll', 'Roll'),
+                          ('throttle', 'Throttle'), ('steer', 'SteerAngle')):
+        run[field] = np.array([convert_to_float(row[column]) for row in rows])
+    return run
+
+# Readers of memory-mapped recordings opened by this process, so the frames are
+# mapped once per worker instead of being pickled to it
+readers = {}
+
+# Define a function to get camera frame i of a run
+def run_frame(run, i):
+    if 'recording' in run:
+        reader = readers.get(run['recording'])
+        if reader is None or i >= len(reader):
+            reader = RunReader(run['recording'])
+            readers[run['recording']] = reader
+        return reader[i][0]
+    return mpimg.imread(run['paths'][i])
+
+# Define a function to split a run into contiguous batches of frame indices
+def make_batches(n_frames, batch_size=None):
+    if not batch_size:
+        batch_size = n_frames
+    return [(start, min(start + batch_size, n_frames)) for start in range(0, n_frames, batch_size)]
+
+# Define a function to load frame i of a run into Rover: the camera image and
+# the recorded pose, attitude and speed, with the time counted from frame start
+# img:           camera frame if it was already read, else it is read here
+def set_frame(Rover, run, i, start=0, img=None):
+    Rover.img = run_frame(run, i) if img is None else img
+    Rover.total_time = run['time'][i] - run['time'][start]
+    Rover.vel = run['vel'][i]
+    Rover.pos = (run['x'][i], run['y'][i])
+    Rover.yaw = run['yaw'][i]
+    Rover.pitch = run['pitch'][i]
+    Rover.roll = run['roll'][i]
+
+# Define a function to make the fresh RoverState a batch is replayed on
+# map_method:    see RoverState
+def batch_rover(run, start, world_shape=(200, 200), map_method='logodds'):
+    Rover = RoverState(map_method=map_method)
+    if Rover.occupancy is not None:
+        Rover.occupancy = OccupancyGrid(world_shape)
+        Rover.worldmap = Rover.occupancy.display
+    else:
+        Rover.worldmap = np.zeros(world_shape + (3,), dtype=np.uint16)
+    Rover.start_time = run['time'][start]
+    return Rover
+
+# Define a function to replay one batch of frames on a fresh RoverState. Pose,
+# attitude and speed come from the recording (the decision outputs are not fed
+# back), and the perception / decision state carries over within the batch only.
+# map_method:    see RoverState
+# Returns the batch map (OccupancyGrid, or worldmap counts) and the per-frame outputs
+def replay_batch(run, start, stop, world_shape=(200, 200), quiet=True, map_method='logodds'):
+    Rover = batch_rover(run, start, world_shape, map_method)
+    outputs = np.zeros(stop - start, dtype=frame_dtype)
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull if quiet else sys.stdout), \
+         (log.quiet() if quiet else contextlib.ExitStack()):
+        for i in range(start, stop):
+            set_frame(Rover, run, i, start)
+            Rover = perception_step(Rover)
+            Rover = decision_step(Rover)
+            out = outputs[i - start]
+            out['frame'] = i
+            out['mode'] = Rover.mode
+            out['throttle'], out['brake'], out['steer'] = Rover.throttle, Rover.brake, Rover.steer
+            if Rover.nav_angles is not None:
+                out['nav_pix'] = Rover.nav_angles.size
+                out['nav_angle'] = np.mean(Rover.nav_angles) * 180 / np.pi if Rover.nav_angles.size else np.nan
+                out['wal_angle'] = np.mean(Rover.wal_angles) * 180 / np.pi if Rover.wal_angles.size else np.nan
+                out['tgt_pix'] = Rover.tgt_angles.size
+    if Rover.occupancy is not None:
+        return Rover.occupancy, outputs
+    return Rover.worldmap, outputs
+
+# Unpack the arguments for replay_batch when called through Pool.map
+def _replay_batch(args):
+    return replay_batch(*args)
+
+# Define a function to replay a whole run across a process pool
+# run:            loaded run (see load_run)
+# ground_truth:   3 channel ground truth map (see load_ground_truth), needed for stats
+# samples_pos:    optional (xs, ys) of the known samples, for the located count
+# workers:        number of processes, 1 replays in this process
+# batch_size:     frames per batch, None replays the run as one batch which
+#                 reproduces a live run exactly (no parallelism)
+# Returns the merged worldmap, the per-frame outputs and the map statistics
+def replay_run(run, ground_truth=None, samples_pos=None, workers=1, batch_size=None,
+               world_shape=(200, 200), map_method='logodds'):
+    jobs = [(run, start, stop, world_shape, True, map_method)
+            for start, stop in make_batches(run['n_frames'], batch_size)]
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers) as pool:
+            results = pool.map(_replay_batch, jobs)
+    else:
+        results = [_replay_batch(job) for job in jobs]
+
+    worldmap = merge_maps([batch_map for batch_map, outputs in results], world_shape, map_method)
+    outputs = np.concatenate([outputs for batch_map, outputs in results])
+    return worldmap, outputs, run_stats(worldmap, ground_truth, samples_pos, map_method)
+
+# Define a function to merge the maps of the batches of a run into one worldmap
+def merge_maps(batch_maps, world_shape=(200, 200), map_method='logodds'):
+    # Log-odds and evidence counts from each batch simply add up
+    if map_method == 'logodds':
+        grid = OccupancyGrid(world_shape)
+        for batch_grid in batch_maps:
+            grid.absorb(batch_grid)
+        return grid.display
+    worldmap = np.zeros(world_shape + (3,), dtype=np.uint32)
+    for batch_map in batch_maps:
+        worldmap += batch_map
+    return np.minimum(worldmap, np.iinfo(np.uint16).max).astype(np.uint16)
+
+# Define a function to get the map statistics of a merged worldmap, None
+# without a ground truth. The located count is only there when the sample
+# positions are known.
+def run_stats(worldmap, ground_truth=None, samples_pos=None, map_method='logodds'):
+    if ground_truth is None:
+        return None
+    Rover = RoverState(ground_truth, map_method=map_method)
+    Rover.worldmap = worldmap
+    Rover.samples_pos = samples_pos
+    perc_mapped, fidelity, located = map_statistics(Rover)
+    stats = {'mapped': perc_mapped, 'fidelity': fidelity}
+    if samples_pos is not None:
+        stats['located'] = len(located)
+    return stats
+
+# Define a function to load known sample positions saved by a recording
+# path:          samples_pos.npy, or a recording folder holding one
+def load_samples(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, 'samples_pos.npy')
+    samples = np.load(path)
+    return (samples[0], samples[1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline replay of a recorded run')
+    parser.add_argument(
+        'run_folder',
+        type=str,
+        help='Recorded run folder (memory-mapped recording, or robot_log.csv and IMG/).'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of worker processes.'
+    )
+    parser.add_argument(
+        '--batch',
+        type=int,
+        default=1000,
+        help='Frames per batch, 0 replays the run sequentially in one batch.'
+    )
+    parser.add_argument(
+        '--fps',
+        type=float,
+        default=25.,
+        help='Recording frame rate.'
+    )
+    parser.add_argument(
+        '--ground_truth',
+        type=str,
+        default='../calibration_images/map_bw.png',
+        help='Ground truth map for the mapped / fidelity stats.'
+    )
+    parser.add_argument(
+        '--samples',
+        type=str,
+        default='',
+        help='Sample positions for the located count (samples_pos.npy, or a recording holding one), default the run\'s own.'
+    )
+    parser.add_argument(
+        '--map',
+        type=str,
+        choices=['logodds', 'counts'],
+        default='logodds',
+        help='World map fusion, log-odds occupancy or per class evidence counts.'
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='',
+        help='Optional .npz file to save the worldmap and per-frame outputs to.'
+    )
+    args = parser.parse_args()
+
+    run = load_run(args.run_folder, args.fps)
+    ground_truth = load_ground_truth(args.ground_truth) if os.path.exists(args.ground_truth) else None
+    samples_pos = load_samples(args.samples) if args.samples else run['samples_pos']
+    worldmap, outputs, stats = replay_run(run, ground_truth, samples_pos, workers=args.workers,
+                                          batch_size=args.batch or None, map_method=args.map)
+    print('Replayed {} frames'.format(len(outputs)))
+    if stats is not None:
+        located = ''
+        if 'located' in stats:
+            located = '  Rocks located: {}'.format(stats['located'])
+        print('Mapped: {}%  Fidelity: {}%{}'.format(stats['mapped'], stats['fidelity'], located))
+    if args.output:
+        np.savez_compressed(args.output, worldmap=worldmap, frames=outputs)
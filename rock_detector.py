@@ -0,0 +1,112 @@
+# Tracked rock target for sample mode
+#
+# Sample mode steered on the mean angle of every rock colored pixel of the
+# frame: all of them were gathered and averaged each frame, specks of
+# misclassified pixels pulled the mean around, and the rover lost its target
+# on every frame the rock dropped out of the threshold (it is small, and
+# often half hidden). RockTracker finds the rock blobs of the frame with
+# cv2.connectedComponentsWithStats, and follows one rock's position in world
+# coordinates with a small constant position Kalman filter. The rover's own
+# motion is taken out by the world frame, so the filter only averages the
+# measurement noise, and on frames without a detection the rock is still where
+# it was last estimated. The result is one compact target, (angle, distance,
+# confidence), that stays put between detections.
+import math
+
+import cv2
+
+# Rover-centric image pixels per meter, the perspective transform calibration
+# maps a 1 meter grid square to 10 x 10 pixels
+PIX_PER_M = 10.
+
+# min_area:       full resolution pixels a blob needs to count as a rock
+# gate:           distance (meters) from the track a detection can be matched at
+# noise:          measurement standard deviation (meters) at 1 meter, it grows
+#                 with the distance to the rock
+# drift:          process noise (meters) added to the estimate each frame
+# hit_gain:       confidence gained on a detection, as a share of what is missing
+# miss_decay:     confidence kept on a frame without a detection
+# max_missed:     frames without a detection before the track is dropped
+class RockTracker():
+    def __init__(self, min_area=4, gate=1.5, noise=0.1, drift=0.02, hit_gain=0.3,
+                 miss_decay=0.9, max_missed=20):
+        self.min_area = min_area
+        self.gate = gate
+        self.noise = noise
+        self.drift = drift
+        self.hit_gain = hit_gain
+        self.miss_decay = miss_decay
+        self.max_missed = max_missed
+        self.reset()
+
+    # Forget the rock being tracked
+    def reset(self):
+        self.x = None        # estimated rock position (world meters)
+        self.y = None
+        self.var = None      # variance of the estimate (square meters)
+        self.confidence = 0.
+        self.missed = 0      # frames since the last detection
+
+    # Rock blobs of a binary rock mask as rover-centric (x, y) meters, ordered
+    # nearest first
+    # tgt_img:    uint8 rock mask of the warped image (nonzero is rock)
+    # step:       full resolution pixels per mask pixel
+    def blobs(self, tgt_img, step=1):
+        rows, cols = tgt_img.shape[0], tgt_img.shape[1]
+        # Rocks cover a tiny part of the frame, label just the box around them
+        x0, y0, w, h = cv2.boundingRect(tgt_img)
+        if not w:
+            return []
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(
+            tgt_img[y0:y0 + h, x0:x0 + w], connectivity=8)
+        found = []
+        for blob in range(1, count):
+            if stats[blob, cv2.CC_STAT_AREA] * step * step < self.min_area:
+                continue
+            cx, cy = centroids[blob][0] + x0, centroids[blob][1] + y0
+            # same rover-centric frame as PolarTables
+            x = (rows - cy) * step / PIX_PER_M
+            y = (cols / 2. - cx) * step / PIX_PER_M
+            found.append((x, y))
+        found.sort(key=lambda xy: xy[0] ** 2 + xy[1] ** 2)
+        return found
+
+    # Per frame update from the frame's rock mask and the rover pose
+    # Returns (angle, distance, confidence) of the tracked rock, angle in
+    # degrees relative to the yaw and distance in meters, or None
+    def update(self, tgt_img, xpos, ypos, yaw, step=1):
+        yaw_rad = yaw * math.pi / 180
+        c, s = math.cos(yaw_rad), math.sin(yaw_rad)
+        if self.x is not None:
+            self.var += self.drift ** 2
+        # Match the nearest blob within the gate (the nearest blob at all when
+        # nothing is tracked yet)
+        match = None
+        blobs = self.blobs(tgt_img, step)
+        for bx, by in blobs:
+            wx, wy = xpos + bx * c - by * s, ypos + bx * s + by * c
+            if self.x is None or math.hypot(wx - self.x, wy - self.y) < self.gate:
+                match = (wx, wy, math.hypot(bx, by))
+                break
+        if match is not None:
+            wx, wy, dist = match
+            r = (self.noise * max(dist, 1.)) ** 2
+            if self.x is None:
+                self.x, self.y, self.var = wx, wy, r
+            else:
+                gain = self.var / (self.var + r)
+                self.x += gain * (wx - self.x)
+                self.y += gain * (wy - self.y)
+                self.var *= 1 - gain
+            self.confidence += self.hit_gain * (1 - self.confidence)
+            self.missed = 0
+        elif self.x is not None:
+            self.confidence *= self.miss_decay
+            self.missed += 1
+            if self.missed > self.max_missed:
+                self.reset()
+        if self.x is None:
+            return None
+        dx, dy = self.x - xpos, self.y - ypos
+        angle = (math.atan2(dy, dx) * 180 / math.pi - yaw + 180) % 360 - 180
+        return (angle, math.hypot(dx, dy), self.confidence)
@@ -0,0 +1,144 @@
+# Spatial index of rock detections
+#
+# Rock detections used to be nothing but nonzero cells in worldmap channel 1:
+# the located statistics compared every known sample with every rock cell on
+# every frame, and nothing knew how many distinct rocks had been seen. The
+# RockIndex clusters the rock cells perception_step detects each frame into
+# rock candidates as they come in, each with a confidence (how many
+# detections back it) and the time and rover pose it was last seen from.
+# Candidates are kept in a spatial hash of square buckets (every bucket their
+# cells can be in), so adding a frame's detections and the queries below only
+# look at a few buckets: O(new detections) per frame instead of O(samples x
+# rock cells).
+import math
+
+# A rock candidate: a cluster of rock detections
+class RockCandidate():
+    def __init__(self, x, y, time, pose):
+        self.x = x             # detection weighted centroid (map cells)
+        self.y = y
+        self.hits = 0          # detections (cell, frame) merged into it
+        self.cells = set()     # flat map cells with detections
+        self.first_seen = time
+        self.last_seen = time
+        self.pose = pose       # (x, y, yaw) of the rover when last seen
+        self.done = False      # collected, or given up on
+        self.radius = 0.       # bound on how far its cells are from the centroid
+        self.cover = None      # (bx0, by0, bx1, by1) buckets it is kept in
+
+    def add(self, x, y, cell, time, pose):
+        self.hits += 1
+        dx, dy = (x - self.x) / self.hits, (y - self.y) / self.hits
+        self.x += dx
+        self.y += dy
+        # the cells it had are at most as much further away as the centroid moved
+        self.radius = max(self.radius + math.hypot(dx, dy), math.hypot(x - self.x, y - self.y))
+        self.cells.add(cell)
+        self.last_seen = time
+        self.pose = pose
+
+# Rock candidates in a spatial hash
+# cols:          columns of the worldmap (to split flat cells)
+# merge_radius:  detections within this distance (map cells) of a candidate's
+#                centroid belong to it, also the bucket side
+# confirm_hits:  detections for full confidence
+class RockIndex():
+    def __init__(self, cols=200, merge_radius=2., confirm_hits=5):
+        self.cols = cols
+        self.merge_radius = merge_radius
+        self.confirm_hits = confirm_hits
+        self.candidates = []
+        self.buckets = {} # (bucket x, bucket y) -> candidates with cells there
+
+    def _bucket(self, x, y):
+        return (int(x // self.merge_radius), int(y // self.merge_radius))
+
+    # Keep a candidate in every bucket within its radius of its centroid,
+    # moving it only when that box of buckets changes
+    def _place(self, candidate):
+        r = candidate.radius
+        cover = self._bucket(candidate.x - r, candidate.y - r) + self._bucket(candidate.x + r, candidate.y + r)
+        if cover == candidate.cover:
+            return
+        if candidate.cover is not None:
+            bx0, by0, bx1, by1 = candidate.cover
+            for bx in range(bx0, bx1 + 1):
+                for by in range(by0, by1 + 1):
+                    self.buckets[(bx, by)].remove(candidate)
+        bx0, by0, bx1, by1 = cover
+        for bx in range(bx0, bx1 + 1):
+            for by in range(by0, by1 + 1):
+                self.buckets.setdefault((bx, by), []).append(candidate)
+        candidate.cover = cover
+
+    # Candidates in the buckets within radius of (x, y), each once
+    def _near(self, x, y, radius):
+        reach = int(math.ceil(radius / self.merge_radius))
+        bx, by = self._bucket(x, y)
+        seen = set()
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                for candidate in self.buckets.get((bx + dx, by + dy), ()):
+                    if id(candidate) not in seen:
+                        seen.add(id(candidate))
+                        yield candidate
+
+    def confidence(self, candidate):
+        return min(1., candidate.hits / float(self.confirm_hits))
+
+    # Fold in one frame of rock detections
+    # cells:    flat map cells (y * cols + x) with a rock detection this frame
+    # pose:     (x, y, yaw) of the rover
+    # time:     Rover.total_time
+    def add(self, cells, pose, time):
+        for cell in cells:
+            cell = int(cell)
+            y, x = divmod(cell, self.cols)
+            x, y = x + .5, y + .5
+            best, best_dist = None, self.merge_radius
+            for candidate in self._near(x, y, self.merge_radius):
+                dist = math.hypot(candidate.x - x, candidate.y - y)
+                if dist <= best_dist:
+                    best, best_dist = candidate, dist
+            if best is None:
+                best = RockCandidate(x, y, time, pose)
+                self.candidates.append(best)
+            best.add(x, y, cell, time, pose)
+            # the centroid and radius may have moved it into other buckets
+            self._place(best)
+
+    # Indices into samples_pos of the samples with a rock detection within
+    # radius map cells, the located test of map_statistics
+    def located(self, samples_pos, radius=3.):
+        located = []
+        if samples_pos is None:
+            return located
+        for idx in range(len(samples_pos[0])):
+            x, y = samples_pos[0][idx], samples_pos[1][idx]
+            for candidate in self._near(x, y, radius + 1):
+                if math.hypot(candidate.x - x, candidate.y - y) >= radius + candidate.radius + 1:
+                    continue
+                if any(math.hypot(cell % self.cols - x, cell // self.cols - y) < radius
+                       for cell in candidate.cells):
+                    located.append(idx)
+                    break
+        return located
+
+    # Nearest candidate to (x, y) that isn't done and has at least min_confidence,
+    # None if there is none
+    def nearest(self, x, y, min_confidence=0.):
+        best, best_dist = None, float('inf')
+        for candidate in self.candidates:
+            if candidate.done or self.confidence(candidate) < min_confidence:
+                continue
+            dist = math.hypot(candidate.x - x, candidate.y - y)
+            if dist < best_dist:
+                best, best_dist = candidate, dist
+        return best
+
+    # Mark the candidates within radius of (x, y) done, e.g. where a sample
+    # was just picked up
+    def mark_done(self, x, y, radius):
+        for candidate in self._near(x, y, radius):
+            if math.hypot(candidate.x - x, candidate.y - y) < radius:
+                candidate.done = True
@@ -0,0 +1,144 @@
+import numpy as np
+import matplotlib.image as mpimg
+
+from map_stats import MapStatsTracker
+from world_map import TiledWorldMap
+from occupancy import OccupancyGrid
+from exploration import FrontierPlanner
+from path_planner import RoutePlanner
+from rock_index import RockIndex
+from perception import WALL_BAND
+from frame_change import FrameChangeDetector
+from rock_detector import RockTracker
+
+# Define a function to read in the ground truth map and create 3-channel green
+# version for overplotting
+# NOTE: images are read in by default with the origin (0, 0) in the upper left
+# and y-axis increasing downward.
+def load_ground_truth(path='../calibration_images/map_bw.png'):
+    ground_truth = mpimg.imread(path)
+    # This next line creates arrays of zeros in the red and blue channels
+    # and puts the map into the green channel.  This is why the underlying 
+    # map output looks green in the display image
+    return np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
+
+# Define RoverState() class to retain rover state parameters
+# ground_truth:   3 channel ground truth map (see load_ground_truth)
+# world_shape:    (rows, cols) of a world to map with a sparse TiledWorldMap,
+#                 None keeps the dense 200 x 200 worldmap
+# map_method:     'logodds' fuses observations into an OccupancyGrid, 'counts'
+#                 keeps per class evidence counts (always used for tiled maps)
+# plan:           plan paths to rocks seen earlier and back to the start (see
+#                 path_planner.py), off by default
+class RoverState():
+    def __init__(self, ground_truth=None, world_shape=None, map_method='logodds', plan=False):
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.stopped_time = None # To record the start of when we are stopped
+        self.stopped_angle = None # To record the initial angle of wehen we are stopped
+        self.bst_nav = 0 # To record the current best # navigable pixels for the bst_angle 
+        self.bst_angle = None # place to hold the best solution angle on 180 degree sweep        
+        self.tgt_angle = None # angle we are aiming for in pickle or azimuth
+        self.stopped_time_limit = 6 # max time we will sit stopped without going into pickle mode
+        self.pickle = False # Flag for being in pickle mode
+        self.img = None # Current camera image
+        self.stopped_pos = (0,0) # Position when we stopped
+        self.pos = None # Current position (x, y)
+        self.yaw = None # Current yaw angle
+        self.pitch = None # Current pitch angle
+        self.roll = None # Current roll angle
+        self.vel = None # Current velocity
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav_angles = None # Angles of navigable terrain pixels
+        self.nav_dists = None # Distances of navigable terrain pixels
+        self.wal_angles = None # Angles of masked contour pixels
+        self.wal_dists = None # Distances of masked contour pixels
+        self.tgt_angles = None # Angles of gold rock targets
+        self.tgt_dists = None # Dinstances of gold rock targets
+        self.rock_tracker = RockTracker() # Tracks the nearest rock in view (see rock_detector.py)
+        self.rock_target = None # (angle (degrees), distance (meters), confidence) of the tracked rock
+        self.col_angles = None # Average angle of objects in front of rover
+        self.col_dists = None # Average distances of objects in front of rover
+        self.ground_truth = ground_truth # Ground truth worldmap (see load_ground_truth)
+        self.mode = 'forward' # Current mode (can be forward, pickle, azimuth, sample or plan)
+        self.throttle_set = 0.2 # Throttle setting when accelerating
+        self.brake_set = 10 # Brake setting when braking
+        # The stop_forward and go_forward fields below represent total count
+        # of navigable terrain pixels.  This is a very crude form of knowing
+        # when you can keep going and when you should stop.  Feel free to
+        # get creative in adding new fields or modifying these!
+        self.ca_zone = 6 # Width of pixel collision bar in front of rover to trigger steering change
+        self.ca_pix = None # Current status of collision pixels
+        self.wall_method = 'band' # Wall boundary finder, 'band' scan or 'contour' (full frame findContours)
+        self.wall_band = WALL_BAND # (x_min, y_min, y_max) of the warped image the wall is followed in
+        # Perception color thresholds (RGB) and the map roll / pitch tolerance
+        self.nav_threshold = (190, 180, 160) # Navigable terrain, also the wall image
+        self.tgt_threshold = (185, 140, 15) # Gold rock color
+        self.obs_threshold = (100, 100, 100) # Obstacles and the collision roi
+        self.map_tolerance = (1.5, 1) # Max roll and pitch (degrees) for mapping a frame
+        self.stage_cache = None # StageCache shared with other configurations (see sweep.py)
+        self.frame_change = FrameChangeDetector() # Skips perception on repeated frames, None processes every frame
+        self.stop_forward = 300 # Threshold to initiate stopping 
+        self.go_forward = 800 # Threshold to go forward again 
+        self.max_vel = 1.5 # Maximum velocity (meters/second)
+        self.quality_level = 0 # Perception / output quality level under load (see quality.py)
+        self.map_every = 3 # Update the worldmap every Nth frame at the sparse map quality level
+        self.degraded_max_vel = 2.0 # Top speed while perceiving at half resolution
+        self.perception_count = 0 # Frames processed by perception_step
+        # Image output from perception step
+        # Update this image to display your intermediate analysis steps
+        # on screen in autonomous mode
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
+        self.hud_source = None # Warped image the HUD is drawn on (see draw_hud)
+        self.hud_contour = None # Contour to draw on the HUD, if any
+        self.hud_wall = None # (xpos, ypos) of the wall pixels being followed
+        # Worldmap
+        # Obstacle (0), rock sample (1) and navigable terrain (2) channels: the
+        # display map of the log-odds occupancy grid, or evidence counts of how
+        # many times each cell was seen as each class (in lazily allocated
+        # tiles for large worlds)
+        self.occupancy = None
+        if world_shape is not None:
+            self.worldmap = TiledWorldMap(world_shape)
+        elif map_method == 'logodds':
+            self.occupancy = OccupancyGrid((200, 200))
+            self.worldmap = self.occupancy.display
+        else:
+            self.worldmap = np.zeros((200, 200, 3), dtype=np.uint16)
+        self.map_window = (200, 200) # (rows, cols) of a tiled worldmap shown on the map display, around the rover
+        # Frontier exploration (see exploration.py), None to only follow the wall
+        self.frontiers = FrontierPlanner(self.worldmap.shape[:2])
+        self.frontier_heading = None # Heading to the nearest frontier relative to yaw (degrees)
+        self.frontier_weight = 0.3 # Share of the forward steering taken from the frontier heading
+        self.frontier_min_nav = 200 # Navigable pixels needed within 10 degrees of the frontier heading
+        # Rock candidates clustered from the rock detections (see rock_index.py)
+        self.rocks = RockIndex(self.worldmap.shape[1])
+        # Path planning to rocks seen on the map and back to the start (see
+        # path_planner.py), only when asked for and not for tiled worlds: the
+        # planner keeps per cell search state for the whole world
+        self.route = RoutePlanner(self.worldmap.shape[:2]) if plan and world_shape is None else None
+        self.plan_goal = None # 'rock' or 'home' while there is a goal to plan to
+        self.plan_heading = None # Heading to the next path waypoint relative to yaw (degrees)
+        self.plan_dist = None # Straight line distance to the goal (map cells)
+        self.plan_max_vel = 1.0 # Top speed while following a planned path
+        self.plan_turn = None # Direction (1 left, -1 right) of a turn in place toward the path, None when driving
+        self.plan_turn_time = None # To record when the turn in place started
+        self.plan_turn_enter = 45 # Waypoint heading (degrees) beyond which the rover stops and turns in place
+        self.plan_turn_exit = 15 # Waypoint heading (degrees) within which a turn in place ends
+        self.plan_turn_limit = 10 # Max time turning in place before the goal is given up on
+        # Mapped / fidelity / located statistics, updated incrementally by perception_step
+        # (only when the ground truth covers the same world)
+        self.map_stats = None
+        if ground_truth is not None and ground_truth.shape[:2] == self.worldmap.shape[:2]:
+            self.map_stats = MapStatsTracker(ground_truth, self.rocks, tiled=world_shape is not None)
+        self.sample_detected = False
+        self.samples_pos = None # To store the actual sample positions
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.samples_located = 0 # To store number of samples located on map
+        self.samples_collected = 0 # To count the number of samples collected
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+        self.picked_up = False
@@ -5,6 +5,15 @@ from io import BytesIO, StringIO
 import base64
 import time
 
+from instrumentation import metrics
+from event_log import log, DEBUG
+from frame_decoder import FrameDecoder
+from quality import quality_names
+from world_map import TiledWorldMap, map_blocks
+
+# Decoder used by update_rover when none is given
+frame_decoder = FrameDecoder()
+
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
       if ',' in string_to_convert:
@@ -13,10 +22,42 @@ def convert_to_float(string_to_convert):
             float_value = np.float(string_to_convert)
       return float_value
 
-def update_rover(Rover, data):
+# Define a function to build a telemetry message the way the simulator sends
+# it (the inverse of update_rover), e.g. for benchmarks and offline testing
+# img:           RGB camera frame
+# samples_pos:   (xs, ys) of the samples still in the world
+def make_telemetry(img, pos=(0., 0.), yaw=0., pitch=0., roll=0., vel=0., throttle=0.,
+                   steer=0., near_sample=0, picking_up=0, samples_pos=((), ())):
+      ok, buff = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+      return {"speed": str(vel), "position": "{};{}".format(pos[0], pos[1]),
+              "yaw": str(yaw), "pitch": str(pitch), "roll": str(roll),
+              "throttle": str(throttle), "steering_angle": str(steer),
+              "near_sample": str(int(near_sample)), "picking_up": str(int(picking_up)),
+              "sample_count": str(len(samples_pos[0])),
+              "samples_x": ";".join(str(x) for x in samples_pos[0]),
+              "samples_y": ";".join(str(y) for y in samples_pos[1]),
+              "image": base64.b64encode(buff.tobytes()).decode("utf-8")}
+
+# Define a function to update Rover from a telemetry message
+# decoder:    FrameDecoder for the camera image (frame_decoder if None). The
+#             frame is decoded into one of its reusable buffers, with prefetch
+#             it decodes on a worker thread while the other fields are parsed
+# Returns the updated Rover and the raw JPEG bytes of the camera image
+def update_rover(Rover, data, decoder=None):
+      if decoder is None:
+            decoder = frame_decoder
+      # Start decoding the camera image first so a prefetching decoder can
+      # work on it while the rest of the telemetry is parsed
+      decoder.submit(data["image"])
+      # Elapsed time is simulation time when the sender provides it (see
+      # headless_sim.py), wall clock time otherwise
+      if "sim_time" in data:
+            now = convert_to_float(data["sim_time"])
+      else:
+            now = time.time()
       # Initialize start time and sample positions
       if Rover.start_time == None:
-            Rover.start_time = time.time()
+            Rover.start_time = now
             Rover.total_time = 0
             samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
             samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
@@ -24,11 +65,9 @@ def update_rover(Rover, data):
             Rover.samples_to_find = np.int(data["sample_count"])
       # Or just update elapsed time
       else:
-            tot_time = time.time() - Rover.start_time
+            tot_time = now - Rover.start_time
             if np.isfinite(tot_time):
                   Rover.total_time = tot_time
-      # Print out the fields in the telemetry data dictionary
-      print(data.keys())
       # The current speed of the rover in m/s
       Rover.vel = convert_to_float(data["speed"])
       # The current position of the rover
@@ -50,73 +89,60 @@ def update_rover(Rover, data):
       # Update number of rocks collected
       Rover.samples_collected = Rover.samples_to_find - np.int(data["sample_count"])
 
-      print('speed =',Rover.vel, 'position =', Rover.pos, 'throttle =', 
-      Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
-      'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
-      'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
-      'samples collected:', Rover.samples_collected)
+      log.event('telemetry', DEBUG, every=1., speed=Rover.vel, position=Rover.pos,
+                throttle=Rover.throttle, steer_angle=Rover.steer, near_sample=Rover.near_sample,
+                picking_up=Rover.picking_up, sending_pickup=Rover.send_pickup,
+                total_time=Rover.total_time, samples_remaining=data["sample_count"],
+                samples_collected=Rover.samples_collected)
       # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
-
-      # Return updated Rover and separate image for optional saving
-      return Rover, image
+      with metrics.timed('decode'):
+            Rover.img = decoder.result()
 
-# Define a function to create display output given worldmap results
-def create_output_images(Rover):
-
-      # Create a scaled map for plotting and clean up obs/nav pixels a bit
-      if np.max(Rover.worldmap[:,:,2]) > 0:
-            nav_pix = Rover.worldmap[:,:,2] > 0
-            navigable = Rover.worldmap[:,:,2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
-      else: 
-            navigable = Rover.worldmap[:,:,2]
-      if np.max(Rover.worldmap[:,:,0]) > 0:
-            obs_pix = Rover.worldmap[:,:,0] > 0
-            obstacle = Rover.worldmap[:,:,0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
-      else:
-            obstacle = Rover.worldmap[:,:,0]
-
-      likely_nav = navigable >= obstacle
-      obstacle[likely_nav] = 0
-      plotmap = np.zeros_like(Rover.worldmap)
-      plotmap[:, :, 0] = obstacle
-      plotmap[:, :, 2] = navigable
-      plotmap = plotmap.clip(0, 255)
-      # Overlay obstacle and navigable terrain map with ground truth map
-      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
+      # Return updated Rover and the encoded image for optional saving
+      return Rover, decoder.jpeg
 
+# Define a function to score the worldmap against the ground truth map
+# Returns the percentage of the ground truth mapped, the fidelity (percentage of
+# mapped navigable cells that are really navigable) and the indices into
+# Rover.samples_pos of the known samples that have been located
+def map_statistics(Rover):
+      # Go over the worldmap block by block (the allocated tiles of a
+      # TiledWorldMap, so the cost follows the explored area)
+      truth = Rover.ground_truth[:,:,1]
+      tot_nav_pix, good_nav_pix = 0, 0
+      rock_ys, rock_xs = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)]
+      for row0, col0, block in map_blocks(Rover.worldmap):
+            # Any navigable evidence shows up as navigable on the display map
+            nav_map = block[:,:,2] > 0
+            rows, cols = nav_map.shape
+            tot_nav_pix += np.count_nonzero(nav_map)
+            good_nav_pix += np.count_nonzero(nav_map & (truth[row0:row0+rows, col0:col0+cols] > 0))
+            ys, xs = block[:,:,1].nonzero()
+            rock_ys.append(ys + row0)
+            rock_xs.append(xs + col0)
       # Check whether any rock detections are present in worldmap
-      rock_world_pos = Rover.worldmap[:,:,1].nonzero()
+      rock_world_pos = (np.concatenate(rock_ys), np.concatenate(rock_xs))
       # If there are, we'll step through the known sample positions
       # to confirm whether detections are real
-      samples_located = 0
-      if rock_world_pos[0].any():
-            
-            rock_size = 2
+      located = []
+      if rock_world_pos[0].size and Rover.samples_pos is not None:
             for idx in range(len(Rover.samples_pos[0])):
                   test_rock_x = Rover.samples_pos[0][idx]
                   test_rock_y = Rover.samples_pos[1][idx]
                   rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
                                         (test_rock_y - rock_world_pos[0])**2)
                   # If rocks were detected within 3 meters of known sample positions
-                  # consider it a success and plot the location of the known
-                  # sample on the map
+                  # consider it a success
                   if np.min(rock_sample_dists) < 3:
-                        samples_located += 1
-                        map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+                        located.append(idx)
 
       # Calculate some statistics on the map results
-      # First get the total number of pixels in the navigable terrain map
-      tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
-      # Next figure out how many of those correspond to ground truth pixels
-      good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-      # Next find how many do not correspond to ground truth pixels
-      bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
+      # The total number of pixels in the navigable terrain map and how many
+      # of those correspond to ground truth pixels were counted above
+      tot_nav_pix = np.float(tot_nav_pix)
+      good_nav_pix = np.float(good_nav_pix)
       # Grab the total number of map pixels
-      tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
+      tot_map_pix = np.float(np.count_nonzero(truth))
       # Calculate the percentage of ground truth map that has been successfully found
       perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
       # Calculate the number of good map pixel detections divided by total pixels 
@@ -125,6 +151,139 @@ def create_output_images(Rover):
             fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
       else:
             fidelity = 0
+      return perc_mapped, fidelity, located
+
+# Define a function to draw the navigation HUD (left inset) from what
+# perception_step kept on Rover (hud_source, hud_contour, hud_wall)
+def draw_hud(Rover):
+      # update an image to include our navigation data on HUD
+      # Frames perception_step skips keep the previous hud_source, so draw on
+      # a copy when frames can be skipped (see frame_change.py)
+      hud_source = Rover.hud_source if Rover.frame_change is None else np.copy(Rover.hud_source)
+      # Draw the entire contour on imgwcontour (contour wall finder only)
+      if Rover.hud_contour is not None:
+            imgwcontour = cv2.drawContours(hud_source, Rover.hud_contour,-1, (255,0,0), 1)
+      else:
+            imgwcontour = hud_source
+      
+      # highlight the wall pixels we are navigating to 
+      #(should match up exactly with a portion of the contour drawn above)
+      xpos_w, ypos_w = Rover.hud_wall
+      imgwcontour[ypos_w,xpos_w, 1:2] = 255
+      
+      # (Show the current nav angle to the wall pixels
+      cv2.putText(imgwcontour,"NavAngle To Wall: " + str(np.mean(Rover.wal_angles * 180/np.pi))[:4], (0, 20), 
+                  cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
+      
+      # Show the average distances to the masked wall pixels. [:4] limits the string to 3 significant digits
+      cv2.putText(imgwcontour,"NavPixels: " + str(len(Rover.nav_dists)), (0, 40), 
+                  cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
+      cv2.putText(imgwcontour,"Mode: " + Rover.mode, (0, 60), 
+                  cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
+      cv2.putText(imgwcontour,"Pickle: " + str(Rover.pickle), (0, 80), 
+                  cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
+      cv2.putText(imgwcontour,"col_pix: " + str(Rover.col_angles.size), (0, 100), 
+                  cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
+      cv2.putText(imgwcontour,"near_sample: " + str(Rover.near_sample), (0, 120), 
+                  cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
+      if Rover.tgt_angles.size:
+            cv2.putText(imgwcontour,"SAMPLE DETECTED", (0, 140),
+                  cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
+      Rover.vision_image = imgwcontour
+      return Rover
+
+# Define a function to JPEG encode an RGB image and convert it to a base64
+# string for sending to the server (same quality as the PIL default)
+def encode_image(img):
+      ok, buff = cv2.imencode('.jpg', cv2.cvtColor(img.astype(np.uint8), cv2.COLOR_RGB2BGR),
+                              (cv2.IMWRITE_JPEG_QUALITY, 75))
+      return base64.b64encode(buff.tobytes()).decode("utf-8")
+
+# Define a function to create a small text-only inset with the quality level,
+# sent instead of the map while the insets are shed under load (see quality.py)
+def create_status_image(Rover, frame_ms=None):
+      status = np.zeros((40, 320, 3), dtype=np.uint8)
+      text = "Quality: " + quality_names[Rover.quality_level]
+      if frame_ms is not None:
+            text += " (" + str(np.round(frame_ms, 1)) + " ms)"
+      cv2.putText(status, text, (0, 25), cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
+      return encode_image(status)
+
+# Define a function to get the part of the worldmap the map display shows:
+# the whole of a dense worldmap, or a window of Rover.map_window cells around
+# the rover of a TiledWorldMap (only the tiles in the window are read)
+# Returns the dense window and its (row0, col0) in the world
+def display_window(Rover):
+      if not isinstance(Rover.worldmap, TiledWorldMap):
+            return Rover.worldmap, 0, 0
+      rows, cols = Rover.worldmap.shape[:2]
+      height, width = min(Rover.map_window[0], rows), min(Rover.map_window[1], cols)
+      xpos, ypos = Rover.pos if Rover.pos is not None else (cols / 2., rows / 2.)
+      row0 = int(np.clip(ypos - height // 2, 0, rows - height))
+      col0 = int(np.clip(xpos - width // 2, 0, cols - width))
+      return Rover.worldmap.window(row0, row0 + height, col0, col0 + width), row0, col0
+
+# Define a function to create display output given worldmap results
+def create_output_images(Rover):
+
+      # Draw the HUD for the latest perception results
+      if Rover.hud_source is not None:
+            Rover = draw_hud(Rover)
+
+      # Dense view of the part of the worldmap shown (see display_window)
+      worldmap, row0, col0 = display_window(Rover)
+      plotmap = np.zeros(worldmap.shape, dtype=np.float)
+      if Rover.occupancy is not None:
+            # The occupancy grid keeps its display channels up to date, obstacle
+            # and navigable cells are already exclusive
+            plotmap[:, :, 0] = worldmap[:,:,0]
+            plotmap[:, :, 2] = worldmap[:,:,2]
+      else:
+            # Create a scaled map for plotting and clean up obs/nav pixels a bit
+            # (worldmap holds integer evidence counts, so scale them as floats)
+            if np.max(worldmap[:,:,2]) > 0:
+                  nav_pix = worldmap[:,:,2] > 0
+                  navigable = worldmap[:,:,2] * (255 / np.mean(worldmap[nav_pix, 2]))
+            else: 
+                  navigable = worldmap[:,:,2].astype(np.float)
+            if np.max(worldmap[:,:,0]) > 0:
+                  obs_pix = worldmap[:,:,0] > 0
+                  obstacle = worldmap[:,:,0] * (255 / np.mean(worldmap[obs_pix, 0]))
+            else:
+                  obstacle = worldmap[:,:,0].astype(np.float)
+
+            likely_nav = navigable >= obstacle
+            obstacle[likely_nav] = 0
+            plotmap[:, :, 0] = obstacle
+            plotmap[:, :, 2] = navigable
+            plotmap = plotmap.clip(0, 255)
+      # Overlay obstacle and navigable terrain map with ground truth map, when
+      # there is one for this world
+      has_truth = Rover.ground_truth is not None and Rover.ground_truth.shape == Rover.worldmap.shape
+      if has_truth:
+            truth = Rover.ground_truth[row0:row0+plotmap.shape[0], col0:col0+plotmap.shape[1]]
+            map_add = cv2.addWeighted(plotmap, 1, truth, 0.5, 0)
+      else:
+            map_add = plotmap
+
+      # Score the map and mark the known samples that have been located
+      # (kept up to date incrementally when there is a tracker)
+      if Rover.map_stats is not None:
+            perc_mapped, fidelity, located = Rover.map_stats.stats()
+      elif not has_truth:
+            perc_mapped, fidelity, located = 0, 0, []
+      else:
+            perc_mapped, fidelity, located = map_statistics(Rover)
+      samples_located = len(located)
+      rock_size = 2
+      for idx in located:
+            test_rock_x = Rover.samples_pos[0][idx] - col0
+            test_rock_y = Rover.samples_pos[1][idx] - row0
+            if not (rock_size <= test_rock_x < map_add.shape[1] and rock_size <= test_rock_y < map_add.shape[0]):
+                  continue
+            map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
+            test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+
       # Flip the map for plotting so that the y-axis points upward in the display
       map_add = np.flipud(map_add).astype(np.float32)
       # Add some text about map and rock sample detection results
@@ -141,15 +300,8 @@ def create_output_images(Rover):
       cv2.putText(map_add,"  Collected: "+str(Rover.samples_collected), (0, 120), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.6, (255, 255, 255), 1)
       # Convert map and vision image to base64 strings for sending to server
-      pil_img = Image.fromarray(map_add.astype(np.uint8))
-      buff = BytesIO()
-      pil_img.save(buff, format="JPEG")
-      encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
-      
-      pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
-      buff = BytesIO()
-      pil_img.save(buff, format="JPEG")
-      encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
+      encoded_string1 = encode_image(map_add)
+      encoded_string2 = encode_image(Rover.vision_image)
 
       return encoded_string1, encoded_string2
 
@@ -0,0 +1,214 @@
+# Parameter sweeps of perception / decision settings over recorded runs
+#
+# Replays a recorded run (see replay.py) once for every configuration of a
+# parameter grid, where a configuration sets RoverState attributes (the color
+# thresholds, wall_band, map_tolerance, decision thresholds, ...), and reports
+# the mapped %, fidelity, located rocks and per-frame cost of each one.
+# Configurations run side by side over the same frames and share a StageCache
+# (see perception.py), so a stage only runs once per frame for every distinct
+# set of the parameters it depends on: a frame is read and warped once for
+# the whole grid, labelled once per set of color thresholds, and so on. The
+# grid is split into jobs of frame batches x configuration chunks for a
+# process pool.
+#
+# Example: $ python sweep.py ../recordings/run1 --grid \
+#              '{"nav_threshold": [[190,180,160], [170,170,170]], "map_tolerance": [[1.5,1], [3,2]]}'
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from perception import perception_step, StageCache
+from decision import decision_step
+from replay import load_run, load_samples, run_frame, make_batches, set_frame, batch_rover, merge_maps, run_stats
+from rover_state import RoverState, load_ground_truth
+from event_log import log
+
+# Define a function to expand a parameter grid into configurations
+# grid:      {RoverState attribute: [values]}, lists become tuples
+# Returns a list of {attribute: value}, one per combination
+def expand_grid(grid):
+    names = sorted(grid)
+    for name in names:
+        if not hasattr(RoverState(), name):
+            raise ValueError('Unknown RoverState parameter: {}'.format(name))
+    configs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        configs.append(dict((name, tuple(value) if isinstance(value, list) else value)
+                            for name, value in zip(names, values)))
+    return configs
+
+# Define a function to replay one batch of frames for every configuration in
+# configs, frame by frame so each frame's stage results are shared across them
+# Returns the batch maps, the (configs, frames) per-frame costs in seconds, and
+# the cache (hits, misses). A cost is the time perception_step and
+# decision_step took plus the time the cached stages it reused took to
+# compute, i.e. what the configuration would cost on its own.
+def sweep_batch(run, start, stop, configs, world_shape=(200, 200), map_method='logodds'):
+    cache = StageCache()
+    rovers = []
+    for config in configs:
+        Rover = batch_rover(run, start, world_shape, map_method)
+        for name, value in config.items():
+            setattr(Rover, name, value)
+        Rover.stage_cache = cache
+        rovers.append(Rover)
+    costs = np.zeros((len(configs), stop - start))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), log.quiet():
+        for i in range(start, stop):
+            img = run_frame(run, i)
+            cache.start_frame(i)
+            for c, Rover in enumerate(rovers):
+                set_frame(Rover, run, i, start, img)
+                cache.saved = 0.
+                t0 = time.perf_counter()
+                perception_step(Rover)
+                decision_step(Rover)
+                costs[c, i - start] = time.perf_counter() - t0 + cache.saved
+    maps = [Rover.occupancy if Rover.occupancy is not None else Rover.worldmap for Rover in rovers]
+    return maps, costs, (cache.hits, cache.misses)
+
+# Unpack the arguments for sweep_batch when called through Pool.map
+# job:       (index of the first configuration, sweep_batch arguments)
+def _sweep_batch(job):
+    first, args = job
+    return first, sweep_batch(*args)
+
+# Define a function to sweep the configurations over a whole run
+# run:            loaded run (see load_run)
+# configs:        configurations (see expand_grid)
+# ground_truth:   3 channel ground truth map (see load_ground_truth), needed for stats
+# samples_pos:    optional (xs, ys) of the known samples, for the located count
+# workers:        number of processes, 1 sweeps in this process
+# batch_size:     frames per batch, see replay_run
+# chunk:          configurations per job, 0 splits them just enough to keep
+#                 every worker busy (configurations in the same job share stages)
+# Returns a list of results, one dict per configuration, and the cache hit rate
+def sweep_run(run, configs, ground_truth=None, samples_pos=None, workers=1, batch_size=None,
+              chunk=0, world_shape=(200, 200), map_method='logodds'):
+    batches = make_batches(run['n_frames'], batch_size)
+    if not chunk:
+        chunk = int(np.ceil(len(configs) / float(max(1, workers // len(batches)))))
+    jobs = []
+    for first in range(0, len(configs), chunk):
+        for start, stop in batches:
+            jobs.append((first, (run, start, stop, configs[first:first + chunk], world_shape, map_method)))
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers) as pool:
+            results = pool.map(_sweep_batch, jobs)
+    else:
+        results = [_sweep_batch(job) for job in jobs]
+
+    batch_maps = [[] for config in configs]
+    costs = [[] for config in configs]
+    hits, misses = 0, 0
+    for first, (maps, batch_costs, (batch_hits, batch_misses)) in results:
+        hits, misses = hits + batch_hits, misses + batch_misses
+        for c in range(len(maps)):
+            batch_maps[first + c].append(maps[c])
+            costs[first + c].append(batch_costs[c])
+
+    sweep = []
+    for c, config in enumerate(configs):
+        worldmap = merge_maps(batch_maps[c], world_shape, map_method)
+        cost = np.concatenate(costs[c])
+        result = {'config': config, 'mean_ms': 1e3 * np.mean(cost),
+                  'p95_ms': 1e3 * np.percentile(cost, 95)}
+        result.update(run_stats(worldmap, ground_truth, samples_pos, map_method) or {})
+        sweep.append(result)
+    return sweep, hits / float(max(1, hits + misses))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parameter sweep over a recorded run')
+    parser.add_argument(
+        'run_folder',
+        type=str,
+        help='Recorded run folder (memory-mapped recording, or robot_log.csv and IMG/).'
+    )
+    parser.add_argument(
+        '--grid',
+        type=str,
+        required=True,
+        help='JSON object of RoverState attribute -> list of values, or a .json file holding one.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of worker processes.'
+    )
+    parser.add_argument(
+        '--batch',
+        type=int,
+        default=0,
+        help='Frames per batch, 0 replays the run sequentially in one batch.'
+    )
+    parser.add_argument(
+        '--chunk',
+        type=int,
+        default=0,
+        help='Configurations per job, 0 splits them across the workers.'
+    )
+    parser.add_argument(
+        '--fps',
+        type=float,
+        default=25.,
+        help='Recording frame rate.'
+    )
+    parser.add_argument(
+        '--ground_truth',
+        type=str,
+        default='../calibration_images/map_bw.png',
+        help='Ground truth map for the mapped / fidelity stats.'
+    )
+    parser.add_argument(
+        '--samples',
+        type=str,
+        default='',
+        help='Sample positions for the located count (samples_pos.npy, or a recording holding one), default the run\'s own.'
+    )
+    parser.add_argument(
+        '--map',
+        type=str,
+        choices=['logodds', 'counts'],
+        default='logodds',
+        help='World map fusion, log-odds occupancy or per class evidence counts.'
+    )
+    parser.add_argument(
+        '--json',
+        type=str,
+        default='',
+        help='Optional file to save the results to as JSON.'
+    )
+    args = parser.parse_args()
+
+    if os.path.exists(args.grid):
+        with open(args.grid) as grid_file:
+            grid = json.load(grid_file)
+    else:
+        grid = json.loads(args.grid)
+    configs = expand_grid(grid)
+    run = load_run(args.run_folder, args.fps)
+    ground_truth = load_ground_truth(args.ground_truth) if os.path.exists(args.ground_truth) else None
+    samples_pos = load_samples(args.samples) if args.samples else run['samples_pos']
+    start = time.time()
+    sweep, hit_rate = sweep_run(run, configs, ground_truth, samples_pos, workers=args.workers,
+                                batch_size=args.batch or None, chunk=args.chunk, map_method=args.map)
+    print('Swept {} configurations over {} frames in {:.1f} s, stage cache hit rate {:.0f}%'.format(
+          len(configs), run['n_frames'], time.time() - start, 100 * hit_rate))
+    for result in sweep:
+        stats = ''
+        if 'mapped' in result:
+            stats = 'mapped {mapped:5.1f}%  fidelity {fidelity:5.1f}%  '.format(**result)
+        if 'located' in result:
+            stats += 'located {located}  '.format(**result)
+        print('{}{:6.2f} ms/frame (p95 {:6.2f})  {}'.format(stats, result['mean_ms'], result['p95_ms'],
+              ' '.join('{}={}'.format(name, value) for name, value in sorted(result['config'].items()))))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(sweep, json_file, indent=2)
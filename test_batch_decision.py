@@ -0,0 +1,91 @@
+# decision_kernel checked against decision_step, frame by frame, over the
+# features of a short synthetic recording
+import numpy as np
+
+from batch_decision import DecisionBatch, decision_kernel, frame_features, mode_names, run_features
+from benchmark import synthetic_frame
+from decision import decision_step
+from event_log import log
+from perception import perception_step
+from recorder import RunRecorder
+from replay import load_run, run_frame
+from rover_state import RoverState
+
+# Rover fields perception_step leaves for decision_step
+decision_inputs = ('vel', 'yaw', 'total_time', 'near_sample', 'picking_up', 'quality_level',
+                   'nav_angles', 'nav_dists', 'wal_angles', 'wal_dists', 'col_angles', 'col_dists',
+                   'tgt_angles', 'tgt_dists', 'frontier_heading', 'plan_heading', 'plan_goal',
+                   'plan_dist', 'rock_target')
+
+# Record n_frames of synthetic camera frames along a loop, with stretches of
+# blank frames and of standing still so every mode gets its turn
+def synthetic_run(folder, n_frames=240):
+    Rover = RoverState()
+    recorder = RunRecorder(folder, capacity=n_frames)
+    for i in range(n_frames):
+        Rover.img = synthetic_frame(i % 37) if (i // 20) % 4 else np.zeros((160, 320, 3), np.uint8)
+        Rover.total_time = i * .04
+        Rover.vel = 0. if (i // 30) % 3 == 2 else 1.
+        Rover.pos = (100 + 30 * np.cos(i / 40.), 100 + 30 * np.sin(i / 40.))
+        Rover.yaw = (i * 7.) % 360
+        Rover.pitch, Rover.roll = .3, .2
+        recorder.append(Rover)
+    recorder.close()
+    return load_run(folder)
+
+# The decision inputs of every frame, running perception_step the way
+# run_features does
+def run_inputs(run):
+    Rover = RoverState()
+    Rover.start_time = run['time'][0]
+    inputs = []
+    with log.quiet():
+        for i in range(run['n_frames']):
+            Rover.img = run_frame(run, i)
+            Rover.total_time = run['time'][i] - run['time'][0]
+            Rover.vel = run['vel'][i]
+            Rover.pos = (run['x'][i], run['y'][i])
+            Rover.yaw = run['yaw'][i]
+            Rover.pitch = run['pitch'][i]
+            Rover.roll = run['roll'][i]
+            Rover = perception_step(Rover)
+            inputs.append((frame_features(Rover), dict((name, getattr(Rover, name)) for name in decision_inputs)))
+    return inputs
+
+def same(a, b):
+    return a == b or (np.isnan(a) and np.isnan(b))
+
+def test_kernel_matches_decision_step_frame_by_frame(tmp_path):
+    run = synthetic_run(str(tmp_path / 'run'))
+    features = run_features(run)
+    inputs = run_inputs(run)
+    rng = np.random.RandomState(0)
+    n = 48
+    params = {'stop_forward': rng.choice([0, 100, 300, 2000], n),
+              'go_forward': rng.choice([200, 800], n),
+              'throttle_set': rng.choice([.1, .2, .5], n),
+              'stopped_time_limit': rng.choice([.5, 2., 6.], n),
+              'frontier_min_nav': rng.choice([0, 200, 5000], n),
+              'frontier_weight': rng.choice([0., .3, .8], n)}
+    batch = DecisionBatch(n)
+    rovers = [RoverState() for j in range(n)]
+    for name, values in params.items():
+        batch.set(name, values)
+        for j, Rover in enumerate(rovers):
+            setattr(Rover, name, float(values[j]))
+    modes = set()
+    with log.quiet():
+        for i, (frame, (expected, fields)) in enumerate(zip(features, inputs)):
+            assert frame.tobytes() == expected.tobytes(), i
+            decision_kernel(batch, frame)
+            for j, Rover in enumerate(rovers):
+                for name, value in fields.items():
+                    setattr(Rover, name, value)
+                decision_step(Rover)
+                reference = DecisionBatch(1, Rover)
+                assert mode_names[batch.mode[j]] == Rover.mode, (i, j)
+                for name in DecisionBatch.state_fields + DecisionBatch.flag_fields:
+                    assert same(getattr(batch, name)[j], getattr(reference, name)[0]), (i, j, name)
+                modes.add(Rover.mode)
+    # the run took the variants through more than just driving forward
+    assert len(modes) >= 3
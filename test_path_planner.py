@@ -0,0 +1,79 @@
+# D* Lite replanning checked against a plain Dijkstra over the same grid
+import heapq
+
+import numpy as np
+
+from path_planner import DStarLite, INF
+
+# Cost of the cheapest path between padded nodes start and goal, with the
+# same move costs DStarLite uses
+def dijkstra(grid, start, goal):
+    dist = {start: 0.}
+    heap = [(0., start)]
+    while heap:
+        d, n = heapq.heappop(heap)
+        if n == goal:
+            return d
+        if d > dist[n]:
+            continue
+        for offset, length in grid.moves:
+            s = n + offset
+            if grid.cost[s] == INF:
+                continue
+            c = d + length * (grid.cost[n] + grid.cost[s]) / 2
+            if c < dist.get(s, INF):
+                dist[s] = c
+                heapq.heappush(heap, (c, s))
+    return INF
+
+# Plan to completion (no per-frame budget)
+def plan(grid):
+    while not grid.plan(max_pops=100000):
+        pass
+    return grid.distance()
+
+def random_cell(rng, shape):
+    return int(rng.randint(shape[1])), int(rng.randint(shape[0]))
+
+def test_replans_match_dijkstra_after_moves_and_cost_changes():
+    rng = np.random.RandomState(0)
+    shape = (24, 30)
+    for trial in range(20):
+        grid = DStarLite(shape)
+        costs = dict((grid.node(x, y), float(rng.choice([1., 3., 50.])))
+                     for y in range(shape[0]) for x in range(shape[1]))
+        grid.set_costs(costs)
+        start = grid.node(*random_cell(rng, shape))
+        goal = grid.node(*random_cell(rng, shape))
+        grid.reset(start, goal)
+        assert np.isclose(plan(grid), dijkstra(grid, start, goal))
+        for step in range(15):
+            # walk a few cells down the path, as the rover does between frames
+            path = grid.path(int(rng.randint(1, 4)))
+            if path:
+                start = path[-1]
+            grid.move(start)
+            # and sometimes partly plan before the map changes under the search
+            if rng.rand() < .5:
+                grid.plan(max_pops=int(rng.randint(1, 50)))
+            changed = {}
+            for i in range(int(rng.randint(0, 20))):
+                changed[grid.node(*random_cell(rng, shape))] = float(rng.choice([1., 3., 50.]))
+            grid.set_costs(changed)
+            assert np.isclose(plan(grid), dijkstra(grid, start, goal)), (trial, step)
+
+def test_path_follows_the_planned_cost():
+    rng = np.random.RandomState(1)
+    grid = DStarLite((16, 16))
+    grid.set_costs(dict((grid.node(x, y), float(rng.choice([1., 3.])))
+                        for y in range(16) for x in range(16)))
+    start, goal = grid.node(1, 2), grid.node(14, 12)
+    grid.reset(start, goal)
+    total = plan(grid)
+    cost, n = 0., start
+    for s in grid.path(100):
+        length = [l for offset, l in grid.moves if n + offset == s][0]
+        cost += length * (grid.cost[n] + grid.cost[s]) / 2
+        n = s
+    assert n == goal
+    assert np.isclose(cost, total)
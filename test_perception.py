@@ -0,0 +1,105 @@
+# Precompiled perception paths checked against the reference functions they replace
+import numpy as np
+
+from perception import get_color_lut, color_thresh, pix_to_world, project_to_world, \
+    LABEL_NAV, LABEL_OBS, LABEL_TGT, LABEL_SAND, LABEL_COL
+from world_map import TiledWorldMap
+
+# Every mask of ColorLUT.classify the slow way: color_thresh, the 2 of 3 sand
+# vote of get_contours and color_thresh on the inverted image
+def reference_labels(img, nav_threshold, obs_threshold, tgt_threshold, tgt_tol):
+    votes = (img[:,:,0] > nav_threshold[0]).astype(int) + \
+            (img[:,:,1] > nav_threshold[1]).astype(int) + \
+            (img[:,:,2] > nav_threshold[2]).astype(int)
+    return (LABEL_NAV * color_thresh(img, nav_threshold)) \
+         | (LABEL_OBS * color_thresh(img, obs_threshold)) \
+         | (LABEL_TGT * color_thresh(img, tgt_threshold, tgt=True, tol=tgt_tol)) \
+         | (LABEL_SAND * (votes > 1).astype(np.uint8)) \
+         | (LABEL_COL * color_thresh(255 - img, obs_threshold))
+
+# Random pixels, and pixels whose channels sit on and next to every threshold
+# and tolerance edge, where a bin boundary off by one would show
+def boundary_image(rng, nav_threshold, obs_threshold, tgt_threshold, tgt_tol):
+    edges = []
+    for c in range(3):
+        points = [nav_threshold[c], obs_threshold[c], 255 - obs_threshold[c],
+                  tgt_threshold[c] - tgt_tol[c], tgt_threshold[c] + tgt_tol[c], 0, 255]
+        values = np.clip(np.add.outer(points, [-1, 0, 1]).ravel(), 0, 255)
+        edges.append(np.unique(values))
+    r, g, b = np.meshgrid(*edges, indexing='ij')
+    grid = np.stack((r.ravel(), g.ravel(), b.ravel()), axis=1)
+    noise = rng.randint(0, 256, (4096, 3))
+    return np.concatenate((grid, noise)).astype(np.uint8).reshape(1, -1, 3)
+
+def test_color_lut_matches_color_thresh():
+    rng = np.random.RandomState(0)
+    cases = [((190, 180, 160), (100, 100, 100), (185, 140, 15), (40, 40, 40))]
+    for i in range(30):
+        cases.append(tuple(tuple(int(v) for v in rng.randint(0, 256, 3)) for j in range(3)) +
+                     (tuple(int(v) for v in rng.randint(1, 60, 3)),))
+    for case in cases:
+        img = boundary_image(rng, *case)
+        labels = get_color_lut(*case).classify(img)
+        np.testing.assert_array_equal(labels, reference_labels(img, *case), err_msg=str(case))
+
+def test_color_lut_on_camera_sized_images():
+    rng = np.random.RandomState(1)
+    case = ((190, 180, 160), (100, 100, 100), (185, 140, 15), (40, 40, 40))
+    lut = get_color_lut(*case)
+    # cached per thresholds
+    assert get_color_lut(*case) is lut
+    for i in range(5):
+        img = rng.randint(0, 256, (160, 320, 3)).astype(np.uint8)
+        np.testing.assert_array_equal(lut.classify(img), reference_labels(img, *case))
+
+# project_to_world the slow way: pix_to_world on each set, then one count per
+# pixel added at its world cell, saturating at the top of the dtype
+def reference_projection(worldmap, pixel_sets, xpos, ypos, yaw, scale):
+    counts = np.zeros(worldmap.shape, dtype=np.int64)
+    for channel, xpix, ypix in pixel_sets:
+        x_world, y_world = pix_to_world(xpix, ypix, xpos, ypos, yaw, worldmap.shape, scale)
+        np.add.at(counts, (y_world, x_world, channel), 1)
+    top = np.iinfo(worldmap.dtype).max
+    return np.minimum(worldmap.astype(np.int64) + counts, top), np.flatnonzero(counts)
+
+# Rover-centric pixel sets the size of what perception_step projects
+def random_pixel_sets(rng):
+    pixel_sets = []
+    for channel in range(3):
+        n = rng.randint(0, 2000)
+        pixel_sets.append((channel, rng.uniform(0, 160, n), rng.uniform(-160, 160, n)))
+    return pixel_sets
+
+def test_project_to_world_matches_pix_to_world():
+    rng = np.random.RandomState(2)
+    for shape, dtype in (((200, 200), np.uint8), ((120, 300), np.uint16)):
+        rows, cols = shape
+        worldmap = rng.randint(0, 250, shape + (3,)).astype(dtype)
+        for trial in range(60):
+            # poses all over the map, half of them within reach of an edge
+            # so the projection gets clipped
+            if trial % 2:
+                xpos = float(rng.choice([rng.uniform(-5, 5), rng.uniform(cols - 5, cols + 5)]))
+                ypos = float(rng.choice([rng.uniform(-5, 5), rng.uniform(rows - 5, rows + 5)]))
+            else:
+                xpos, ypos = float(rng.uniform(0, cols)), float(rng.uniform(0, rows))
+            yaw = float(rng.uniform(0, 360))
+            scale = float(rng.choice([10., 100.]))
+            pixel_sets = random_pixel_sets(rng)
+            expected, hit = reference_projection(worldmap, pixel_sets, xpos, ypos, yaw, scale)
+            cells = project_to_world(worldmap, pixel_sets, xpos, ypos, yaw, scale)
+            np.testing.assert_array_equal(worldmap, expected)
+            np.testing.assert_array_equal(np.sort(cells), hit)
+
+def test_project_to_world_into_tiles_matches_dense():
+    rng = np.random.RandomState(3)
+    shape = (150, 260)
+    dense = np.zeros(shape + (3,), dtype=np.uint16)
+    tiled = TiledWorldMap(shape)
+    for trial in range(40):
+        xpos, ypos = float(rng.uniform(-3, shape[1] + 3)), float(rng.uniform(-3, shape[0] + 3))
+        yaw, scale = float(rng.uniform(0, 360)), float(rng.choice([10., 100.]))
+        pixel_sets = random_pixel_sets(rng)
+        cells = project_to_world(dense, pixel_sets, xpos, ypos, yaw, scale)
+        np.testing.assert_array_equal(project_to_world(tiled, pixel_sets, xpos, ypos, yaw, scale), cells)
+    np.testing.assert_array_equal(np.asarray(tiled), dense)
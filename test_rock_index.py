@@ -0,0 +1,50 @@
+# RockIndex checked against the brute force located test of map_statistics
+import math
+
+import numpy as np
+
+from rock_index import RockIndex
+
+# Samples with a rock cell within radius, comparing every sample with every cell
+def brute_located(cells, samples_pos, cols, radius=3.):
+    located = []
+    for idx in range(len(samples_pos[0])):
+        x, y = samples_pos[0][idx], samples_pos[1][idx]
+        if any(math.hypot(cell % cols - x, cell // cols - y) < radius for cell in cells):
+            located.append(idx)
+    return located
+
+def test_located_matches_brute_force_with_scattered_detections():
+    rng = np.random.RandomState(0)
+    cols = 200
+    for trial in range(20):
+        index = RockIndex(cols)
+        seen = set()
+        centers = rng.uniform(10, 190, (8, 2))
+        for frame in range(60):
+            # detections around a few rocks, and some scattered misclassified cells
+            cells = []
+            for cx, cy in centers[rng.rand(len(centers)) < .5]:
+                x, y = cx + rng.normal(0, 1.5), cy + rng.normal(0, 1.5)
+                cells.append(int(y) * cols + int(x))
+            for i in range(rng.randint(0, 3)):
+                cells.append(int(rng.randint(200)) * cols + int(rng.randint(200)))
+            index.add(cells, (0., 0., 0.), frame * .04)
+            seen.update(cells)
+        samples_pos = (rng.randint(0, 200, 30), rng.randint(0, 200, 30))
+        samples_pos[0][:8], samples_pos[1][:8] = centers[:, 0].astype(int), centers[:, 1].astype(int)
+        assert index.located(samples_pos) == brute_located(seen, samples_pos, cols)
+
+def test_candidate_radius_bounds_its_cells():
+    rng = np.random.RandomState(1)
+    cols = 200
+    index = RockIndex(cols, merge_radius=3.)
+    for frame in range(200):
+        x, y = 100 + rng.normal(0, 1.), 100 + rng.normal(0, 1.)
+        index.add([int(y) * cols + int(x)], (0., 0., 0.), frame * .04)
+    for candidate in index.candidates:
+        for cell in candidate.cells:
+            cy, cx = divmod(cell, cols)
+            assert math.hypot(cx + .5 - candidate.x, cy + .5 - candidate.y) <= candidate.radius + 1e-9
+            # and it can be found from every bucket its cells are in
+            assert candidate in index.buckets[index._bucket(cx + .5, cy + .5)]
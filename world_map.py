@@ -0,0 +1,161 @@
+# Sparse tiled world map
+#
+# The dense worldmap allocates and scans every cell of the world even though
+# the rover only ever sees a small part of it. TiledWorldMap splits a world of
+# any rectangular extent into square tiles that are only allocated the first
+# time something is projected into them, so memory and update cost follow the
+# explored area. It stores the same evidence counts as the dense worldmap and
+# can be used wherever Rover.worldmap is: project_to_world writes into it,
+# map_statistics reads it tile by tile (see map_blocks) and
+# create_output_images a window around the rover, and np.asarray(worldmap) /
+# worldmap[...] still give a dense (rows, cols, channels) copy.
+import numpy as np
+
+# Evidence count world map made of lazily allocated tiles
+# shape:      (rows, cols) of the world in map cells, any aspect ratio
+# channels:   evidence channels (obstacle, rock, navigable)
+# tile:       tile side in cells
+# dtype:      integer dtype of the counts, counts saturate at its maximum
+class TiledWorldMap():
+    def __init__(self, shape=(200, 200), channels=3, tile=32, dtype=np.uint16):
+        self.shape = (int(shape[0]), int(shape[1]), channels)
+        self.tile = tile
+        self.dtype = np.dtype(dtype)
+        self.tiles = {} # (tile row, tile col) -> (tile, tile, channels) counts
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def _tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = np.zeros((self.tile, self.tile, self.shape[2]), dtype=self.dtype)
+        return tile
+
+    # Split flat cell indices (y * cols + x) * channels + channel, the indices
+    # project_to_world and MapStatsTracker use, into tile keys and in-tile
+    # positions
+    def _split(self, cells):
+        pix, channel = np.divmod(cells, self.shape[2])
+        y, x = np.divmod(pix, self.shape[1])
+        ty, iy = np.divmod(y, self.tile)
+        tx, ix = np.divmod(x, self.tile)
+        return ty, tx, iy, ix, channel
+
+    # Add counts to flat cells (each cell at most once), saturating at the top
+    # of the dtype
+    def add(self, cells, counts):
+        ty, tx, iy, ix, channel = self._split(cells)
+        top = np.iinfo(self.dtype).max
+        tile_ids = ty * (self.shape[1] // self.tile + 1) + tx
+        order = np.argsort(tile_ids, kind='stable')
+        bounds = np.flatnonzero(np.diff(tile_ids[order])) + 1
+        for group in np.split(order, bounds):
+            tile = self._tile((int(ty[group[0]]), int(tx[group[0]])))
+            idx = (iy[group], ix[group], channel[group])
+            tile[idx] = np.minimum(tile[idx] + counts[group], top)
+
+    # Set flat cells (each cell at most once) to values
+    def put(self, cells, values):
+        ty, tx, iy, ix, channel = self._split(np.asarray(cells))
+        tile_ids = ty * (self.shape[1] // self.tile + 1) + tx
+        order = np.argsort(tile_ids, kind='stable')
+        bounds = np.flatnonzero(np.diff(tile_ids[order])) + 1
+        for group in np.split(order, bounds):
+            if group.size:
+                tile = self._tile((int(ty[group[0]]), int(tx[group[0]])))
+                tile[iy[group], ix[group], channel[group]] = values[group]
+
+    # Counts of flat cells, 0 for unallocated tiles
+    def values(self, cells):
+        ty, tx, iy, ix, channel = self._split(np.asarray(cells))
+        out = np.zeros(len(iy), dtype=self.dtype)
+        tile_ids = ty * (self.shape[1] // self.tile + 1) + tx
+        for tile_id in np.unique(tile_ids):
+            group = np.flatnonzero(tile_ids == tile_id)
+            tile = self.tiles.get((int(ty[group[0]]), int(tx[group[0]])))
+            if tile is not None:
+                out[group] = tile[iy[group], ix[group], channel[group]]
+        return out
+
+    # (row0, row1, col0, col1) cell bounds of the allocated tiles, None if empty
+    def bounds(self):
+        if not self.tiles:
+            return None
+        keys = np.array(list(self.tiles.keys()))
+        row0, col0 = keys.min(axis=0) * self.tile
+        row1, col1 = (keys.max(axis=0) + 1) * self.tile
+        return row0, min(row1, self.shape[0]), col0, min(col1, self.shape[1])
+
+    # Dense copy of the cells [row0:row1, col0:col1], reading only the tiles
+    # that overlap them
+    def window(self, row0, row1, col0, col1):
+        out = np.zeros((row1 - row0, col1 - col0, self.shape[2]), dtype=self.dtype)
+        for ty in range(row0 // self.tile, (row1 - 1) // self.tile + 1):
+            for tx in range(col0 // self.tile, (col1 - 1) // self.tile + 1):
+                tile = self.tiles.get((ty, tx))
+                if tile is None:
+                    continue
+                y0, x0 = ty * self.tile, tx * self.tile
+                y1, x1 = max(row0, y0), max(col0, x0)
+                y2, x2 = min(row1, y0 + self.tile), min(col1, x0 + self.tile)
+                out[y1 - row0:y2 - row0, x1 - col0:x2 - col0] = tile[y1 - y0:y2 - y0, x1 - x0:x2 - x0]
+        return out
+
+    # (row0, col0, counts) of every allocated tile, cut at the world's edge
+    def blocks(self):
+        rows, cols = self.shape[:2]
+        out = []
+        for (ty, tx), tile in self.tiles.items():
+            row0, col0 = ty * self.tile, tx * self.tile
+            out.append((row0, col0, tile[:rows - row0, :cols - col0]))
+        return out
+
+    # Dense (rows, cols, channels) copy of the map
+    def dense(self):
+        out = np.zeros(self.shape, dtype=self.dtype)
+        for (ty, tx), tile in self.tiles.items():
+            y0, x0 = ty * self.tile, tx * self.tile
+            view = out[y0:y0 + self.tile, x0:x0 + self.tile]
+            view[...] = tile[:view.shape[0], :view.shape[1]]
+        return out
+
+    def __array__(self, dtype=None):
+        out = self.dense()
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, key):
+        return self.dense()[key]
+
+    def copy(self):
+        out = TiledWorldMap(self.shape[:2], self.shape[2], self.tile, self.dtype)
+        out.tiles = dict((key, tile.copy()) for key, tile in self.tiles.items())
+        return out
+
+# Define a function to read the counts of flat cells from either a dense
+# worldmap array or a TiledWorldMap
+def cell_values(worldmap, cells):
+    if isinstance(worldmap, TiledWorldMap):
+        return worldmap.values(cells)
+    return worldmap.reshape(-1)[cells]
+
+# Define a function to set flat cells of either a dense worldmap array or a
+# TiledWorldMap
+def set_cell_values(worldmap, cells, values):
+    if isinstance(worldmap, TiledWorldMap):
+        worldmap.put(cells, values)
+    else:
+        worldmap.reshape(-1)[cells] = values
+
+# Define a function to list the parts of a worldmap that can hold evidence as
+# (row0, col0, counts) blocks: the allocated tiles of a TiledWorldMap, or the
+# whole of a dense worldmap
+def map_blocks(worldmap):
+    if isinstance(worldmap, TiledWorldMap):
+        return worldmap.blocks()
+    return [(0, 0, worldmap)]